@@ -0,0 +1,158 @@
+import math
+from typing import Optional
+
+
+class Aggregator:
+    """
+    Base class for streaming aggregates of sensor payloads.
+    Every reading is folded into the aggregate in O(1), so the controller never buffers raw payloads.
+
+    Attributes:
+        count (int): The number of readings added in the current window.
+
+    Methods:
+        add(value: int) -> None:
+            Adds a reading to the aggregate.
+        value() -> float:
+            Returns the value which drives the up/down decision.
+        close_window() -> float:
+            Returns the value of the current window and prepares the aggregate for the next one.
+        reset() -> None:
+            Clears the aggregate completely.
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def add(self, value: int):
+        raise NotImplementedError
+
+    def value(self) -> float:
+        raise NotImplementedError
+
+    def close_window(self) -> float:
+        result = self.value()
+        self.reset()
+        return result
+
+    def reset(self):
+        self.count = 0
+
+
+class MeanAggregator(Aggregator):
+    """
+    Running count/sum aggregate which also keeps min, max and variance (Welford's algorithm).
+    Its value is the arithmetic mean of the window, the same as sum(payloads) / len(payloads).
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.reset()
+
+    def add(self, value: int):
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        delta = value - self._mean
+        self._mean += delta / self.count
+        self._m2 += delta * (value - self._mean)
+
+    def value(self) -> float:
+        return self.total / self.count
+
+    def variance(self) -> float:
+        # Population variance of the current window
+        if self.count == 0:
+            return 0.0
+        return self._m2 / self.count
+
+    def stddev(self) -> float:
+        return math.sqrt(self.variance())
+
+    def reset(self):
+        super().reset()
+        self.total = 0
+        self.min: Optional[int] = None
+        self.max: Optional[int] = None
+        self._mean = 0.0
+        self._m2 = 0.0
+
+
+class MedianAggregator(Aggregator):
+    """
+    Median of the window computed from a bounded histogram of integer payloads.
+    Memory is bounded by the payload range, not by the number of readings,
+    and values outside of [min_value, max_value] are clamped into the edge bins.
+    """
+
+    def __init__(self, min_value: int = 1, max_value: int = 100):
+        if max_value < min_value:
+            raise ValueError("max_value must not be less than min_value")
+        super().__init__()
+        self.min_value = min_value
+        self.max_value = max_value
+        self.reset()
+
+    def add(self, value: int):
+        value = min(max(value, self.min_value), self.max_value)
+        self.bins[value - self.min_value] += 1
+        self.count += 1
+
+    def value(self) -> float:
+        if self.count == 0:
+            raise ZeroDivisionError("median of an empty window")
+        # Find the lower and upper middle elements by walking the cumulative histogram
+        lower_rank = (self.count - 1) // 2
+        upper_rank = self.count // 2
+        lower = upper = None
+        seen = 0
+        for offset, amount in enumerate(self.bins):
+            seen += amount
+            if lower is None and seen > lower_rank:
+                lower = offset + self.min_value
+            if seen > upper_rank:
+                upper = offset + self.min_value
+                break
+        return (lower + upper) / 2
+
+    def reset(self):
+        super().reset()
+        self.bins = [0] * (self.max_value - self.min_value + 1)
+
+
+class EwmaAggregator(Aggregator):
+    """
+    Exponentially weighted moving average of the payloads.
+    The smoothed value carries over between windows, only the window reading count is cleared.
+    """
+
+    def __init__(self, alpha: float = 0.1):
+        if not 0 < alpha <= 1:
+            raise ValueError("alpha must be in the (0, 1] interval")
+        super().__init__()
+        self.alpha = alpha
+        self.reset()
+
+    def add(self, value: int):
+        if self._value is None:
+            self._value = float(value)
+        else:
+            self._value += self.alpha * (value - self._value)
+        self.count += 1
+
+    def value(self) -> float:
+        if self._value is None:
+            raise ZeroDivisionError("EWMA of an empty stream")
+        return self._value
+
+    def close_window(self) -> float:
+        result = self.value()
+        self.count = 0
+        return result
+
+    def reset(self):
+        super().reset()
+        self._value: Optional[float] = None
@@ -0,0 +1,49 @@
+import logging
+
+from pydantic import ValidationError
+
+from components.controller.functions.controller_functions import Controller
+from invian_shared.shared_schemas import sensor_batch_adapter
+from invian_shared.utils.broker import READINGS_QUEUE, Broker, connect_with_retry
+
+
+class ReadingConsumer:
+    """
+    The ReadingConsumer feeds sensor readings published to RabbitMQ into the Controller.
+    Every message is a JSON array of readings, which is processed as one batch under a single lock acquisition.
+
+    Attributes:
+        controller (Controller): The controller which processes the readings.
+        broker (Broker): The broker the readings are consumed from.
+        queue (str): The name of the readings queue.
+        prefetch_count (int): The number of messages the broker delivers without waiting for acknowledgements.
+        logger (logging.Logger): A logger instance for logging information.
+
+    Methods:
+        start() -> None:
+            Connects to the broker and starts consuming the readings queue.
+        handle_message(body: bytes) -> None:
+            Validates a message and processes its readings.
+    """
+
+    def __init__(self, controller: Controller, broker: Broker, queue=READINGS_QUEUE, prefetch_count=64,
+                 logger=None):
+        self.controller = controller
+        self.broker = broker
+        self.queue = queue
+        self.prefetch_count = prefetch_count
+        self.logger = logger or logging.getLogger(__name__)
+
+    async def start(self):
+        await connect_with_retry(self.broker)
+        await self.broker.consume(self.queue, self.handle_message, prefetch_count=self.prefetch_count)
+        self.logger.info(f"Consuming sensor readings from {self.queue}.")
+
+    async def handle_message(self, body: bytes):
+        try:
+            batch = sensor_batch_adapter.validate_json(body)
+        except ValidationError as exc:
+            # a malformed message will never become valid, so it is acknowledged and dropped
+            self.logger.warning(f"Received malformed readings message.\nDetails: {exc}")
+            return
+        await self.controller.process_batch(batch)
@@ -1,13 +1,26 @@
 import asyncio
 import json
 import logging
-from datetime import datetime, timedelta
-from typing import List, Union
+import time
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Union
+from urllib.parse import quote
 
-from components.controller.schemas.response import Status, ControllerDecision
+from components.controller.functions.aggregators import Aggregator, MeanAggregator
+from components.controller.functions.dispatcher import DecisionDispatcher, PendingDecision
+from components.controller.functions.feed import DecisionFeed
+from components.controller.functions.groups import GroupSettings, GroupState, ShardedGroups
+from components.controller.functions.history import (BaseHistoryStore, FileHistoryStore, HistoryRenderer,
+                                                     HistoryStore, NO_DATA, render_status)
+from components.controller.functions.metrics import ControllerMetrics
+from components.controller.functions.profiling import Profiler
+from components.controller.schemas.response import Status, ControllerDecision, ControllerBatchResult
 from invian_shared.shared_exceptions import BadPayloadException
 from invian_shared.shared_schemas import SensorData
-from invian_shared.utils.network import tcp_client
+from invian_shared.utils.log_sampling import LogSampler
+from invian_shared.utils.network import WebSocketLink, tcp_client
+from invian_shared.utils.wire import encode_decision
+from invian_shared.utils.timestamps import epoch_ms_now, from_epoch_ms
 
 
 def get_current_time_without_microseconds():
@@ -33,12 +46,28 @@ class Controller(metaclass=Singleton):
         min_payload (int): The minimum value of payload that the controller considers valid.
         max_payload (int): The maximum value of payload that the controller considers valid.
         decision_interval_seconds (int): The time interval (in seconds) between each decision.
-        latest_data (list): The list of latest payloads received.
-        history (list): The history of statuses and their respective time intervals.
+        aggregator (Aggregator): The streaming aggregate of the payloads received in the current window.
+        dispatcher (DecisionDispatcher): The background dispatcher which delivers decisions to the manipulator.
+        manipulator_link (WebSocketLink): The persistent connection decisions are delivered over.
+            Decisions are posted over HTTP if it isn't set.
+        window_coordinator (WindowCoordinator): The coordinator of the decision windows shared by several workers.
+            If it is set, readings are accumulated into it and it makes the decisions.
+        window_scheduler (WindowScheduler): The background scheduler which closes the decision windows.
+            If it is set, readings are only accumulated. Otherwise a window is closed by the first reading after it.
+        feed (DecisionFeed): The push feed of decisions and history updates for streaming clients.
+        history (BaseHistoryStore): The history of statuses and their respective time intervals.
+            It is kept in a bounded ring buffer, or in an append-only file if history_path is given.
+        history_retention (int): The maximum number of history entries kept in memory.
+        history_path (str): The path of the persistent history file, which survives restarts.
         last_decision_time (datetime): The time when the last decision was made.
         previous_status (str): The previous status of the controller.
         lock (asyncio.Lock): A lock to ensure thread safety.
-        logger (logging.Logger): A logger instance for logging information.
+        logger (logging.Logger): A logger instance for logging information. Its level is left to the logging
+            configuration unless log_level is given.
+        request_log (LogSampler): The sampler of the per-reading debug logs.
+        metrics (ControllerMetrics): The counters and histograms served at /metrics.
+        profiler (Profiler): The opt-in sampled timing and profile captures of the hot paths.
+        rejection_log (LogSampler): The sampler of the warnings about rejected readings.
 
     Methods:
         reset() -> None:
@@ -46,33 +75,157 @@ class Controller(metaclass=Singleton):
         process_request(data: SensorData) -> ControllerDecision | None:
             Processes a request containing sensor data and makes a decision based on it.
             Returns the decision if a new one is made, or None otherwise.
-        get_history() -> List[str]:
-            Returns the history of statuses in a formatted manner.
-        get_history_as_string() -> str:
-            Returns the history of statuses as a string.
+        process_batch(batch: List[SensorData]) -> ControllerBatchResult:
+            Processes a batch of sensor data under a single lock acquisition.
+            Returns the number of received and rejected readings and the decisions made.
+        get_history(start: datetime | None, end: datetime | None, limit: int | None) -> List[str]:
+            Returns the history of statuses in a formatted manner, optionally limited to a time range.
+        get_history_as_string(start: datetime | None, end: datetime | None, limit: int | None) -> str:
+            Returns the history of statuses as a string, optionally limited to a time range.
+        history_renderer -> HistoryRenderer:
+            The incrementally rendered and cached view of the whole history.
     """
 
-    def __init__(self, status_threshold=50, log_level=logging.DEBUG, min_payload=1, max_payload=100,
-                 decision_interval_seconds=5):
+    def __init__(self, status_threshold=50, log_level: int = None, min_payload=1, max_payload=100,
+                 decision_interval_seconds=5, aggregator: Aggregator = None, history_retention=10000,
+                 history_path: str = None, group_shards=16):
         # Initialize instance variables
         self.status_threshold = status_threshold
-        self._init_state(log_level)
+        self.history_retention = history_retention
+        self.history_path = history_path
+        self.group_settings: Dict[str, GroupSettings] = {}
+        self.window_coordinator = None
+        self.window_scheduler = None
+        self.feed = DecisionFeed()
+        # the history isn't part of the resettable state, so a persistent history survives the initialization
+        self.default_group = self._create_group(None, aggregator or MeanAggregator())
+        self.groups = ShardedGroups(self._create_group, shards=group_shards)
+        self.logger = logging.getLogger(__name__)
+        if log_level is not None:
+            self.logger.setLevel(log_level)
+        # the logs of single readings are sampled, so enabling them doesn't slow down a busy controller
+        self.request_log = LogSampler(rate=10)
+        self.rejection_log = LogSampler(rate=10)
+        self.profiler = Profiler(lambda: self.metrics.spans)
+        self._init_state()
         self.min_payload = min_payload
         self.max_payload = max_payload
         self.decision_interval_seconds = decision_interval_seconds
 
-    def _init_state(self, log_level: int):
+    def _init_state(self):
         # Reset the state of the controller
-        self.latest_data = []
-        self.history = []
-        self.last_decision_time = get_current_time_without_microseconds()
-        self.previous_status = None
-        self.lock = asyncio.Lock()
-        self.logger = logging.getLogger(__name__)
-        self.logger.setLevel(log_level)
+        self.default_group.reset()
+        self.groups.clear(keep=self.default_group)
+        self.metrics = ControllerMetrics(self)
 
     def reset(self):
-        self._init_state(logging.DEBUG)
+        for state in self.groups:
+            if state is not self.default_group:
+                self._close_group(state)
+        self.history.clear()
+        self._init_state()
+
+    def _create_history_store(self, group: str = None) -> BaseHistoryStore:
+        if self.history_path:
+            # every group has its own history file next to the default one
+            path = self.history_path if group is None else f"{self.history_path}.{quote(group, safe='')}"
+            return FileHistoryStore(path)
+        return HistoryStore(self.history_retention)
+
+    def _create_group(self, group: Optional[str], aggregator: Aggregator = None) -> GroupState:
+        settings = self.group_settings.get(group, GroupSettings())
+        # a manipulator of the group is reached over a persistent link (ws://) or over HTTP (http://)
+        websocket = bool(settings.manipulator_url) and settings.manipulator_url.startswith(('ws://', 'wss://'))
+        state = GroupState(group, aggregator or MeanAggregator(), self._create_history_store(group),
+                           status_threshold=settings.status_threshold,
+                           manipulator_url=None if websocket else settings.manipulator_url)
+        state.dispatcher = DecisionDispatcher(lambda pending: self._send_decision(pending, state))
+        if group is not None:
+            if websocket:
+                state.manipulator_link = WebSocketLink(settings.manipulator_url)
+            # groups which appear while the controller delivers decisions start delivering right away
+            if self.default_group.dispatcher.is_running:
+                self._start_group(state)
+        return state
+
+    def _start_group(self, state: GroupState):
+        if state.manipulator_link is not None:
+            state.manipulator_link.start()
+        state.dispatcher.start()
+
+    def _close_group(self, state: GroupState):
+        # Stop delivering the decisions of a removed group. reset() isn't a coroutine,
+        # so the dispatcher and the link are cancelled without waiting for them to end.
+        state.dispatcher.cancel()
+        if state.manipulator_link is not None:
+            state.manipulator_link.cancel()
+        if isinstance(state.history, FileHistoryStore):
+            state.history.close()
+
+    def configure_group(self, group: str, status_threshold: int = None, manipulator_url: str = None):
+        # Set the threshold and the manipulator of a group. Readings of groups which aren't configured are rejected.
+        self.group_settings[group] = GroupSettings(status_threshold, manipulator_url)
+
+    def start_delivery(self):
+        # Start delivering the decisions of every group
+        for state in self.groups:
+            self._start_group(state)
+
+    async def stop_delivery(self):
+        # Stop delivering decisions and close the connections of the groups
+        for state in self.groups:
+            await state.dispatcher.stop()
+            if state.group is not None and state.manipulator_link is not None:
+                await state.manipulator_link.close()
+
+    # the default group's state is the controller's own
+    @property
+    def aggregator(self) -> Aggregator:
+        return self.default_group.aggregator
+
+    @aggregator.setter
+    def aggregator(self, aggregator: Aggregator):
+        self.default_group.aggregator = aggregator
+
+    @property
+    def history(self) -> BaseHistoryStore:
+        return self.default_group.history
+
+    @history.setter
+    def history(self, history: BaseHistoryStore):
+        self.default_group.history = history
+
+    @property
+    def dispatcher(self) -> DecisionDispatcher:
+        return self.default_group.dispatcher
+
+    @property
+    def manipulator_link(self) -> Optional[WebSocketLink]:
+        return self.default_group.manipulator_link
+
+    @manipulator_link.setter
+    def manipulator_link(self, link: Optional[WebSocketLink]):
+        self.default_group.manipulator_link = link
+
+    @property
+    def last_decision_time(self) -> datetime:
+        return self.default_group.last_decision_time
+
+    @last_decision_time.setter
+    def last_decision_time(self, moment: datetime):
+        self.default_group.last_decision_time = moment
+
+    @property
+    def previous_status(self) -> Optional[str]:
+        return self.default_group.previous_status
+
+    @previous_status.setter
+    def previous_status(self, status: Optional[str]):
+        self.default_group.previous_status = status
+
+    @property
+    def lock(self) -> asyncio.Lock:
+        return self.groups.lock_for(None)
 
     def _validate_payload(self, payload: int):
         # Validate the payload value
@@ -82,77 +235,199 @@ class Controller(metaclass=Singleton):
             raise BadPayloadException(f"Received unrealistically low payload: {payload}. Ignoring.")
 
     async def process_request(self, data: SensorData) -> Union[ControllerDecision, None]:
-        self.logger.debug('Processing request...')
-        async with self.lock:
-            self.logger.debug('Lock acquired.')
+        profiler = self.profiler
+        span = profiler.start('process_request') if profiler.enabled else None
+        started = time.perf_counter()
+        try:
+            async with self.groups.lock_for(data.group):
+                self.metrics.lock_wait.observe(time.perf_counter() - started)
+                return await self._process_reading(data)
+        finally:
+            if span is not None:
+                profiler.finish('process_request', span)
+
+    async def process_batch(self, batch: List[SensorData]) -> ControllerBatchResult:
+        # Process a whole batch of readings with a single lock acquisition per shard.
+        # Readings of a group are handled one by one in the order they were received, so decisions
+        # are exactly the same as if every reading had been sent in its own request.
+        self.logger.debug('Processing batch of %d readings...', len(batch))
+        by_shard = {}
+        for data in batch:
+            by_shard.setdefault(self.groups.shard_of(data.group), []).append(data)
+        decisions = []
+        rejected = 0
+        for shard, readings in by_shard.items():
+            started = time.perf_counter()
+            async with self.groups.locks[shard]:
+                self.metrics.lock_wait.observe(time.perf_counter() - started)
+                for data in readings:
+                    try:
+                        decision = await self._process_reading(data)
+                    except BadPayloadException as exc:
+                        rejected += 1
+                        self.rejection_log.log(self.logger, logging.WARNING, "Received bad payload.\nDetails: %s",
+                                               exc)
+                        continue
+                    if decision:
+                        decisions.append(decision)
+        return ControllerBatchResult(received=len(batch), rejected=rejected, decisions=decisions)
+
+    async def _process_reading(self, data: SensorData) -> Union[ControllerDecision, None]:
+        # Process a single reading. The caller must hold the lock of the reading's group.
+        try:
             self._validate_payload(data.payload)
-            data.datetime = datetime.fromisoformat(data.datetime)
-            # Ignore outdated data
-            if data.datetime <= self.last_decision_time:
-                self.logger.debug('Ignoring outdated data.')
-                return
-            self.latest_data.append(data.payload)
-
-            now = get_current_time_without_microseconds()
-            time_difference = now - self.last_decision_time
-            self.logger.debug(
-                f"Now: {now}, Last decision time: {self.last_decision_time}, Time difference: {time_difference}")
-
-            now_str = now.isoformat()
-            self.logger.debug('Checking decision time...')
-            # if the time difference is less than the decision interval, return early
-            if time_difference < timedelta(seconds=self.decision_interval_seconds):
-                self.logger.debug('Returning early due to decision time.')
-                return
-
-            self.logger.info("Начало принятия решения.")
-            last_decision_time_str = self.last_decision_time.isoformat()
-
-            total_payload = sum(self.latest_data)
-            average_payload = total_payload / len(self.latest_data)
-
-            status = "up" if average_payload > self.status_threshold else "down"
-            self.logger.info(f"Status: {status}")
-            # if the status has changed, print a message, make a new decision and send it
-            if status != self.previous_status:
-                print(f"Status changed: {self.previous_status} -> {status}")
-                decision = ControllerDecision(datetime=now, status=status)
-                self.logger.info(f"Decision made: {decision}")
-                await tcp_client(json.dumps(decision.model_dump(mode='json')))
-            # if the last status in history is the same as the current status, update the end time
-            # otherwise, add a new status to the history
-            if self.history and self.history[-1].status == status:
-                self.history[-1].end = now
-            else:
-                self.history.append(
-                    Status(start=datetime.fromisoformat(last_decision_time_str), end=datetime.fromisoformat(now_str),
-                           status=status))
-            # update the last decision time, clear the latest data and set the previous status
-            self.last_decision_time = now
-
-            self.latest_data.clear()
-            self.previous_status = status
-            self.logger.debug('Finished processing request.')
-            return ControllerDecision(datetime=now, status=status)
-
-    def _format_history(self, history: List[Status]) -> List[str]:
+            # only configured groups get a state, so clients can't create windows, histories and dispatchers
+            if data.group is not None and data.group not in self.group_settings:
+                raise BadPayloadException(f"Received reading of unknown group: {data.group}. Ignoring.")
+        except BadPayloadException:
+            self.metrics.readings_bad_payload.inc()
+            raise
+        state = self.groups.get(data.group)
+        # Ignore outdated data, timestamps are compared as epoch milliseconds
+        if data.epoch_ms() <= state.last_decision_ms:
+            self.metrics.readings_outdated.inc()
+            self.request_log.log(self.logger, logging.DEBUG, "Ignoring outdated reading of %s.", data.datetime)
+            return
+        self.metrics.readings_accepted.inc()
+        if self.window_coordinator is not None and state is self.default_group:
+            # with several workers the windows are closed by the coordinator, readings are only accumulated
+            self.window_coordinator.add(data.payload)
+            return
+        state.aggregator.add(data.payload)
+        if self.window_scheduler is not None:
+            # the windows are closed by the scheduler, processing a reading ends with accumulating it
+            return
+
+        # the window is checked in epoch milliseconds, the decision time is only built when the window ends
+        now_ms = epoch_ms_now()
+        if now_ms < state.last_decision_ms + round(self.decision_interval_seconds * 1000):
+            self.request_log.log(self.logger, logging.DEBUG, "Reading accumulated, %d ms since the last decision.",
+                                 now_ms - state.last_decision_ms)
+            return
+
+        # the aggregate is closed for this window and is ready to accept the next one
+        readings = state.aggregator.count
+        return self._decide(state.aggregator.close_window(), from_epoch_ms(now_ms), state, readings)
+
+    def _decide(self, aggregated_payload: float, now: datetime, state: GroupState = None,
+                readings: int = None) -> ControllerDecision:
+        # Make the decision of a closed window of `readings` readings. The caller must hold the lock of the group.
+        profiler = self.profiler
+        span = profiler.start('decide') if profiler.enabled else None
+        state = state or self.default_group
+        if readings is not None:
+            self.metrics.window_readings.observe(readings)
+        self.metrics.window_average.observe(aggregated_payload)
+        threshold = self.status_threshold if state.status_threshold is None else state.status_threshold
+        status = "up" if aggregated_payload > threshold else "down"
+        self.logger.debug("Window closed with aggregate %.2f, status: %s.", aggregated_payload, status)
+        # if the status has changed, make a new decision and hand it over to the dispatcher
+        if status != state.previous_status:
+            decision = ControllerDecision(datetime=now, status=status)
+            self.metrics.decisions[status].inc()
+            self.logger.info("Status changed: %s -> %s at %s (group: %s).", state.previous_status, status, now,
+                             state.group)
+            state.dispatcher.submit(decision)
+            self.feed.publish("decision", {**decision.model_dump(mode='json'), "group": state.group})
+        # if the previous status is the same as the current status, update the end time of the last entry
+        # otherwise, add a new status to the history (a restored history is never extended over the downtime,
+        # and with several workers the history of a worker may not hold the entry of the previous decision)
+        if state.previous_status == status and state.history.last_status() == status:
+            state.history.update_last_end(now)
+        else:
+            state.history.append(start=state.last_decision_time, end=now, status=status)
+        tail = state.history[-1]
+        self.feed.publish("history", {**tail.model_dump(mode='json'), "segment": render_status(tail),
+                                      "group": state.group})
+        # update the last decision time and set the previous status
+        state.last_decision_time = now
+        state.previous_status = status
+        if span is not None:
+            profiler.finish('decide', span)
+        return ControllerDecision(datetime=now, status=status)
+
+    def _close_empty_window(self, now: datetime, state: GroupState = None, mark_no_data=False):
+        # Record a window without readings. The caller must hold the lock of the group.
+        # The last status is held over the window, or the window is recorded as a "no data" gap.
+        state = state or self.default_group
+        self.metrics.window_readings.observe(0)
+        last_status = state.history.last_status()
+        if mark_no_data and last_status != NO_DATA:
+            state.history.append(start=state.last_decision_time, end=now, status=NO_DATA)
+        elif last_status is not None and (last_status == NO_DATA or last_status == state.previous_status):
+            state.history.update_last_end(now)
+        state.last_decision_time = now
+        if len(state.history):
+            tail = state.history[-1]
+            self.feed.publish("history", {**tail.model_dump(mode='json'), "segment": render_status(tail),
+                                          "group": state.group})
+
+    async def _send_decision(self, pending: PendingDecision, state: GroupState = None) -> bool:
+        # Deliver a decision to the manipulator of its group, called by the dispatcher outside of the locks.
+        # The dispatcher's sequence number is the idempotency key of the decision, and it identifies it
+        # in the acknowledgements of the persistent link, over which the decision is a compact binary frame.
+        # Groups without a manipulator of their own use the default one.
+        state = state or self.default_group
+        link = state.manipulator_link
+        if link is None and state.manipulator_url is None:
+            link = self.manipulator_link
+        transport = 'http' if link is None else 'websocket'
+        started = time.perf_counter()
+        try:
+            delivered = await self._deliver(pending, state, link)
+        except Exception:
+            self.metrics.send_failures[transport].inc()
+            raise
+        self.metrics.send_latency[transport].observe(time.perf_counter() - started)
+        if not delivered:
+            self.metrics.send_failures[transport].inc()
+        return delivered
+
+    async def _deliver(self, pending: PendingDecision, state: GroupState, link: Optional[WebSocketLink]) -> bool:
+        if link is not None:
+            return await link.send(
+                pending.seq, encode_decision(pending.decision.status, pending.decision.datetime, pending.seq))
+        message = json.dumps({'seq': pending.seq, **pending.decision.model_dump(mode='json')})
+        if state.manipulator_url is not None:
+            return await tcp_client(message, url=state.manipulator_url)
+        return await tcp_client(message)
+
+    def _format_history(self, history: Iterable[Status]) -> List[str]:
         # Format the history list into a list of strings
-        return [f"[{status.start.strftime('%H:%M:%S')} - {status.end.strftime('%H:%M:%S')} {status.status.upper()}]" for status in history]
+        return [render_status(status) for status in history]
 
-    def _format_history_as_string(self, history: List[Status]) -> str:
+    def _format_history_as_string(self, history: Iterable[Status]) -> str:
         # Format the history list into a string
-        formatted_history = [
-            f"[{record.start.strftime('%H:%M:%S')} - {record.end.strftime('%H:%M:%S')} {record.status.upper()}]" for
-            record in history]
-        return ', '.join(formatted_history)
-
-    def get_history(self) -> List[str]:
-        # Get the formatted history list
-        return self._format_history(self.history)
-
-    def get_history_as_string(self) -> str:
-        # Get the formatted history string
-        return self._format_history_as_string(self.history)
+        return ', '.join(self._format_history(history))
+
+    @property
+    def history_renderer(self) -> HistoryRenderer:
+        return self.default_group.history_renderer
+
+    def history_renderer_for(self, group: str = None) -> Optional[HistoryRenderer]:
+        # The rendered history of a group, None if the group has no readings yet
+        state = self.groups.find(group)
+        return state.history_renderer if state is not None else None
+
+    def get_history(self, start: datetime = None, end: datetime = None, limit: int = None,
+                    group: str = None) -> List[str]:
+        # Get the formatted history list, the whole history is served from the rendered cache
+        state = self.groups.find(group)
+        if state is None:
+            return []
+        if start is None and end is None and limit is None:
+            return state.history_renderer.as_list()
+        return self._format_history(state.history.query(start, end, limit))
+
+    def get_history_as_string(self, start: datetime = None, end: datetime = None, limit: int = None,
+                              group: str = None) -> str:
+        # Get the formatted history string, the whole history is served from the rendered cache
+        state = self.groups.find(group)
+        if state is None:
+            return ''
+        if start is None and end is None and limit is None:
+            return state.history_renderer.as_string()
+        return self._format_history_as_string(state.history.query(start, end, limit))
 
 
 def get_controller():
@@ -0,0 +1,197 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from typing import Awaitable, Callable, NamedTuple, Optional
+
+from components.controller.schemas.response import ControllerDecision
+from invian_shared.shared_exceptions import DeliveryRejected
+from invian_shared.utils.stats import percentile
+from invian_shared.utils.timestamps import epoch_ms_now
+
+
+# The low bits of a sequence number hold the process id, Linux pids are below 2 ** 22
+SEQUENCE_PID_BITS = 22
+
+_last_sequence_ms = 0
+
+
+def next_sequence_number() -> int:
+    # Sequence numbers are shared by every dispatcher of the process, so the manipulator never takes a decision
+    # of another dispatcher for an already applied one. The high bits count milliseconds, from a clock which
+    # doesn't go backwards while the process runs, and are bumped by one when several numbers are taken in the
+    # same millisecond. The low bits are the process id, so worker processes never take the same number.
+    # Across restarts the numbers only keep growing if the system clock wasn't set back while the controller was down.
+    global _last_sequence_ms
+    _last_sequence_ms = max(_last_sequence_ms + 1, epoch_ms_now())
+    return (_last_sequence_ms << SEQUENCE_PID_BITS) | (os.getpid() & ((1 << SEQUENCE_PID_BITS) - 1))
+
+
+class PendingDecision(NamedTuple):
+    seq: int
+    decision: ControllerDecision
+    enqueued_at: float
+
+
+class DecisionDispatcher:
+    """
+    The DecisionDispatcher delivers the controller's decisions to the manipulator in a background task,
+    so request processing never waits for the manipulator.
+
+    Attributes:
+        send (Callable[[PendingDecision], Awaitable[bool]]): Coroutine function which delivers a decision.
+            It returns True if the decision was delivered and False if it has to be retried.
+            It raises DeliveryRejected if the manipulator rejected the decision, which is then not retried.
+        max_queue_size (int): The maximum number of decisions waiting for delivery.
+            The oldest decision is dropped when the queue is full.
+        coalesce (bool): If True, a new decision replaces every pending one, because only the latest matters.
+        retry_initial_delay (float): The delay (in seconds) before the first retry.
+        retry_max_delay (float): The maximum delay (in seconds) between retries.
+        max_retries (int | None): The number of retries before a decision is given up. None means no limit.
+        logger (logging.Logger): A logger instance for logging information.
+        recent_lags (deque): The delivery lags (in seconds) of the latest LAG_SAMPLES delivered decisions.
+
+    Methods:
+        submit(decision: ControllerDecision) -> PendingDecision:
+            Puts a decision into the outbound queue without waiting for its delivery.
+        start() -> None:
+            Starts the background delivery task in the running event loop.
+        stop() -> None:
+            Stops the background delivery task.
+        cancel() -> None:
+            Cancels the background delivery task without waiting for it to end.
+        clear() -> None:
+            Drops all pending decisions and resets the metrics.
+        metrics() -> dict:
+            Returns queue depth, delivery counters and delivery lag.
+    """
+    LAG_SAMPLES = 1024
+
+    def __init__(self, send: Callable[[PendingDecision], Awaitable[bool]], max_queue_size=16, coalesce=True,
+                 retry_initial_delay=0.1, retry_max_delay=5.0, max_retries: Optional[int] = None, logger=None):
+        if max_queue_size <= 0:
+            raise ValueError("max_queue_size must be a positive number")
+        self.send = send
+        self.max_queue_size = max_queue_size
+        self.coalesce = coalesce
+        self.retry_initial_delay = retry_initial_delay
+        self.retry_max_delay = retry_max_delay
+        self.max_retries = max_retries
+        self.logger = logger or logging.getLogger(__name__)
+        self._task = None
+        self._wakeup = None
+        self.clear()
+
+    def clear(self):
+        self.queue = deque(maxlen=self.max_queue_size)
+        self.submitted = 0
+        self.delivered = 0
+        self.failed_attempts = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.superseded = 0
+        self.rejected = 0
+        self.last_delivery_lag = None
+        self.max_delivery_lag = None
+        self.recent_lags = deque(maxlen=self.LAG_SAMPLES)
+
+    @property
+    def is_running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def submit(self, decision: ControllerDecision) -> PendingDecision:
+        pending = PendingDecision(seq=next_sequence_number(), decision=decision, enqueued_at=time.monotonic())
+        if self.coalesce:
+            # only the latest decision matters, so every pending one is replaced
+            self.coalesced += len(self.queue)
+            self.queue.clear()
+        elif len(self.queue) == self.max_queue_size:
+            # the deque drops the oldest decision by itself
+            self.dropped += 1
+        self.queue.append(pending)
+        self.submitted += 1
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return pending
+
+    def start(self):
+        if self.is_running:
+            return
+        self._wakeup = asyncio.Event()
+        if self.queue:
+            self._wakeup.set()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        task = self._task
+        if task is None:
+            return
+        self.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    def cancel(self):
+        if self._task is not None:
+            self._task.cancel()
+        self._task = None
+        self._wakeup = None
+
+    async def _run(self):
+        while True:
+            if not self.queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            await self._deliver(self.queue.popleft())
+
+    async def _deliver(self, pending: PendingDecision):
+        delay = self.retry_initial_delay
+        attempt = 0
+        while True:
+            try:
+                delivered = await self.send(pending)
+            except DeliveryRejected as exc:
+                self.rejected += 1
+                self.logger.warning(f"Decision #{pending.seq} was rejected.\nDetails: {exc}")
+                return
+            except Exception as exc:
+                self.logger.warning(f"Failed to deliver decision #{pending.seq}.\nDetails: {exc}")
+                delivered = False
+            if delivered:
+                lag = time.monotonic() - pending.enqueued_at
+                self.delivered += 1
+                self.last_delivery_lag = lag
+                self.recent_lags.append(lag)
+                if self.max_delivery_lag is None or lag > self.max_delivery_lag:
+                    self.max_delivery_lag = lag
+                return
+            self.failed_attempts += 1
+            attempt += 1
+            if self.max_retries is not None and attempt > self.max_retries:
+                self.logger.warning(f"Giving up decision #{pending.seq} after {attempt} attempts.")
+                return
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.retry_max_delay)
+            # a newer decision makes retrying this one pointless
+            if self.coalesce and self.queue:
+                self.superseded += 1
+                return
+
+    def metrics(self) -> dict:
+        return {
+            "queue_depth": len(self.queue),
+            "submitted": self.submitted,
+            "delivered": self.delivered,
+            "failed_attempts": self.failed_attempts,
+            "coalesced": self.coalesced,
+            "dropped": self.dropped,
+            "superseded": self.superseded,
+            "rejected": self.rejected,
+            "last_delivery_lag_seconds": self.last_delivery_lag,
+            "max_delivery_lag_seconds": self.max_delivery_lag,
+            "p50_delivery_lag_seconds": percentile(self.recent_lags, 0.5),
+            "p99_delivery_lag_seconds": percentile(self.recent_lags, 0.99),
+        }
@@ -0,0 +1,108 @@
+import asyncio
+import itertools
+import json
+from collections import deque
+from typing import NamedTuple, Optional
+
+from invian_shared.utils.timestamps import epoch_ms_now
+
+
+class FeedEvent(NamedTuple):
+    seq: int
+    event: str
+    data: str
+
+
+class FeedSubscription:
+    """
+    A subscriber of the DecisionFeed with a bounded buffer of undelivered events.
+    A subscriber whose buffer overflows is dropped: it receives the events already buffered and then its
+    iteration ends, after which it can resume from the sequence number of the last event it received.
+    """
+
+    def __init__(self, buffer_size: int):
+        self.queue = asyncio.Queue(maxsize=buffer_size)
+        self.dropped = False
+        self.closed = False
+
+    def offer(self, event: FeedEvent) -> bool:
+        if self.dropped or self.closed:
+            return False
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.dropped = True
+            return False
+        return True
+
+    async def get(self, timeout: float = None) -> Optional[FeedEvent]:
+        # Returns None on timeout and raises StopAsyncIteration when the subscription is over
+        if self.queue.empty() and (self.dropped or self.closed):
+            raise StopAsyncIteration
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> FeedEvent:
+        return await self.get()
+
+
+class DecisionFeed:
+    """
+    The DecisionFeed pushes the controller's decisions and history updates to its subscribers.
+    Sequence numbers start from the time the feed is created, in microseconds, so the events of a restarted
+    controller follow the ones clients received before the restart. The feed belongs to one process: with several
+    workers, each worker streams the decisions it made with its own numbers, so resumable feeds need a single worker.
+
+    Attributes:
+        backlog_size (int): The number of recent events kept for subscribers which resume.
+        subscriber_buffer (int): The number of undelivered events a subscriber may have before it is dropped.
+        subscribers (set): The active subscriptions.
+        dropped (int): The number of subscribers dropped for being too slow.
+
+    Methods:
+        publish(event: str, payload: dict) -> int:
+            Sends an event to every subscriber and returns its sequence number.
+        subscribe(last_seq: int | None) -> FeedSubscription:
+            Creates a subscription. Events after last_seq which are still in the backlog are replayed first.
+        unsubscribe(subscription: FeedSubscription) -> None:
+            Closes a subscription.
+    """
+
+    def __init__(self, backlog_size=1000, subscriber_buffer=256):
+        self.backlog_size = backlog_size
+        self.subscriber_buffer = subscriber_buffer
+        self.backlog = deque(maxlen=backlog_size)
+        self.subscribers = set()
+        self.dropped = 0
+        self._sequence = itertools.count(epoch_ms_now() * 1000 + 1)
+
+    def publish(self, event: str, payload: dict) -> int:
+        feed_event = FeedEvent(seq=next(self._sequence), event=event, data=json.dumps(payload, default=str))
+        self.backlog.append(feed_event)
+        for subscription in list(self.subscribers):
+            if not subscription.offer(feed_event):
+                self._drop(subscription)
+        return feed_event.seq
+
+    def subscribe(self, last_seq: int = None) -> FeedSubscription:
+        subscription = FeedSubscription(self.subscriber_buffer)
+        if last_seq is not None:
+            for feed_event in self.backlog:
+                if feed_event.seq > last_seq and not subscription.offer(feed_event):
+                    self.dropped += 1
+                    return subscription
+        self.subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: FeedSubscription):
+        subscription.closed = True
+        self.subscribers.discard(subscription)
+
+    def _drop(self, subscription: FeedSubscription):
+        self.subscribers.discard(subscription)
+        self.dropped += 1
@@ -0,0 +1,138 @@
+import asyncio
+from datetime import datetime
+from typing import Callable, Dict, Hashable, Iterator, List, NamedTuple, Optional
+
+from components.controller.functions.aggregators import Aggregator
+from components.controller.functions.dispatcher import DecisionDispatcher
+from components.controller.functions.history import BaseHistoryStore, HistoryRenderer
+from invian_shared.utils.network import WebSocketLink
+from invian_shared.utils.timestamps import to_epoch_ms
+
+
+class GroupSettings(NamedTuple):
+    status_threshold: Optional[int] = None
+    manipulator_url: Optional[str] = None
+
+
+class GroupState:
+    """
+    The decision state of one sensor group: its window, history and manipulator target.
+    Readings without a group id belong to the default group, whose state is the controller's own.
+
+    Attributes:
+        group (str | None): The group id.
+        status_threshold (int | None): The threshold of the group. None means the controller's threshold.
+        aggregator (Aggregator): The aggregate of the group's current window.
+        history (BaseHistoryStore): The history of the group's statuses.
+        dispatcher (DecisionDispatcher): The dispatcher which delivers the group's decisions.
+        manipulator_link (WebSocketLink | None): The persistent connection to the group's manipulator.
+        manipulator_url (str | None): The HTTP URL of the group's manipulator, if it isn't reached over a link.
+            Without a link and a URL of their own, decisions go to the default manipulator.
+        last_decision_time (datetime): The time when the group's last decision was made.
+        last_decision_ms (int): The same time in epoch milliseconds, which readings are compared with.
+        previous_status (str | None): The previous status of the group.
+    """
+
+    def __init__(self, group: Optional[str], aggregator: Aggregator, history: BaseHistoryStore,
+                 status_threshold: Optional[int] = None, manipulator_url: Optional[str] = None):
+        self.group = group
+        self.status_threshold = status_threshold
+        self.aggregator = aggregator
+        self.history = history
+        self.dispatcher: Optional[DecisionDispatcher] = None
+        self.manipulator_link: Optional[WebSocketLink] = None
+        self.manipulator_url = manipulator_url
+        self._history_renderer = None
+        self.reset()
+
+    def reset(self):
+        self.aggregator.reset()
+        if self.dispatcher is not None:
+            self.dispatcher.clear()
+        if len(self.history):
+            # a persistent history outlives the process, so a restarted group carries on from its last record
+            self.last_decision_time = self.history[-1].end
+            self.previous_status = self.history.last_decided_status()
+        else:
+            self.last_decision_time = datetime.now().replace(microsecond=0)
+            self.previous_status = None
+
+    @property
+    def last_decision_time(self) -> datetime:
+        return self._last_decision_time
+
+    @last_decision_time.setter
+    def last_decision_time(self, moment: datetime):
+        self._last_decision_time = moment
+        self.last_decision_ms = to_epoch_ms(moment)
+
+    @property
+    def history_renderer(self) -> HistoryRenderer:
+        # The renderer follows the history store, which may be replaced
+        if self._history_renderer is None or self._history_renderer.store is not self.history:
+            self._history_renderer = HistoryRenderer(self.history)
+        return self._history_renderer
+
+
+class ShardedGroups:
+    """
+    The states of the sensor groups, hash-sharded by group id. Every shard has its own lock,
+    so readings of groups in different shards are processed without contending for a single lock.
+    States are created on the first reading of a group.
+
+    Attributes:
+        shards (int): The number of shards.
+        locks (List[asyncio.Lock]): The lock of every shard.
+
+    Methods:
+        shard_of(group: str | None) -> int:
+            Returns the shard of a group.
+        lock_for(group: str | None) -> asyncio.Lock:
+            Returns the lock of the group's shard. It must be held while the group's state is changed.
+        get(group: str | None) -> GroupState:
+            Returns the state of a group, creating it if needed.
+        find(group: str | None) -> GroupState | None:
+            Returns the state of a group if it exists.
+        clear(keep: GroupState) -> None:
+            Drops every group except the given one and replaces the locks.
+    """
+
+    def __init__(self, create: Callable[[Optional[str]], GroupState], shards=16):
+        if shards <= 0:
+            raise ValueError("shards must be a positive number")
+        self.shards = shards
+        self._create = create
+        self._states: List[Dict[Hashable, GroupState]] = [{} for _ in range(shards)]
+        self.locks = [asyncio.Lock() for _ in range(shards)]
+
+    def shard_of(self, group: Optional[str]) -> int:
+        return hash(group) % self.shards
+
+    def lock_for(self, group: Optional[str]) -> asyncio.Lock:
+        return self.locks[self.shard_of(group)]
+
+    def add(self, state: GroupState):
+        self._states[self.shard_of(state.group)][state.group] = state
+
+    def get(self, group: Optional[str]) -> GroupState:
+        states = self._states[self.shard_of(group)]
+        state = states.get(group)
+        if state is None:
+            state = states[group] = self._create(group)
+        return state
+
+    def find(self, group: Optional[str]) -> Optional[GroupState]:
+        return self._states[self.shard_of(group)].get(group)
+
+    def __iter__(self) -> Iterator[GroupState]:
+        for states in self._states:
+            yield from list(states.values())
+
+    def __len__(self) -> int:
+        return sum(len(states) for states in self._states)
+
+    def clear(self, keep: GroupState):
+        for states in self._states:
+            states.clear()
+        self.add(keep)
+        self.locks = [asyncio.Lock() for _ in range(self.shards)]
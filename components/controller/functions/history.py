@@ -0,0 +1,424 @@
+import json
+import mmap
+import os
+import struct
+import threading
+from array import array
+from collections import deque
+from datetime import datetime
+from typing import Iterator, List, Optional
+
+from components.controller.schemas.response import Status
+from invian_shared.utils.timestamps import from_epoch_ms, to_epoch_ms
+from invian_shared.utils.wire import STATUS_CODES
+
+# The status of a window without readings, which is recorded in the history but never sent to the manipulator
+NO_DATA = 'no data'
+HISTORY_STATUS_CODES = {**STATUS_CODES, NO_DATA: 3}
+HISTORY_STATUSES_BY_CODE = {code: status for status, code in HISTORY_STATUS_CODES.items()}
+
+
+def render_status(status: Status) -> str:
+    return f"[{status.start.strftime('%H:%M:%S')} - {status.end.strftime('%H:%M:%S')} {status.status.upper()}]"
+
+
+class BaseHistoryStore:
+    """
+    Base class of the decision history stores.
+    Entries are contiguous intervals, so both their starts and ends are sorted
+    and time-range queries are answered by binary search.
+
+    Attributes:
+        retention (int | None): The maximum number of entries kept, None if the store is unbounded.
+        evicted (int): The number of entries dropped so far, i.e. the absolute index of the first entry.
+        generation (int): The number of times the store was cleared.
+
+    Methods:
+        append(start: datetime, end: datetime, status: str) -> None:
+            Adds a new entry.
+        last_status() -> str | None:
+            Returns the status of the latest entry.
+        last_decided_status() -> str | None:
+            Returns the status of the latest entry which isn't a "no data" gap.
+        update_last_end(end: datetime) -> None:
+            Moves the end of the latest entry.
+        query(start: datetime | None, end: datetime | None, limit: int | None) -> List[Status]:
+            Returns the entries overlapping the [start, end] interval, oldest first.
+        clear() -> None:
+            Removes all entries.
+    """
+    retention = None
+    evicted = 0
+    generation = 0
+
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+    def _start_ms(self, index: int) -> int:
+        raise NotImplementedError
+
+    def _end_ms(self, index: int) -> int:
+        raise NotImplementedError
+
+    def _status_code(self, index: int) -> int:
+        raise NotImplementedError
+
+    def append(self, start: datetime, end: datetime, status: str):
+        raise NotImplementedError
+
+    def update_last_end(self, end: datetime):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def __iter__(self) -> Iterator[Status]:
+        return (self._status_at(index) for index in range(len(self)))
+
+    def __getitem__(self, index: int) -> Status:
+        size = len(self)
+        if index < 0:
+            index += size
+        if not 0 <= index < size:
+            raise IndexError("history index out of range")
+        return self._status_at(index)
+
+    def _status_at(self, index: int) -> Status:
+        return Status(start=from_epoch_ms(self._start_ms(index)), end=from_epoch_ms(self._end_ms(index)),
+                      status=HISTORY_STATUSES_BY_CODE[self._status_code(index)])
+
+    def last_status(self) -> Optional[str]:
+        size = len(self)
+        if not size:
+            return None
+        return HISTORY_STATUSES_BY_CODE[self._status_code(size - 1)]
+
+    def last_decided_status(self) -> Optional[str]:
+        # consecutive gaps are merged, so this looks back at two entries at most
+        no_data = HISTORY_STATUS_CODES[NO_DATA]
+        for index in range(len(self) - 1, -1, -1):
+            code = self._status_code(index)
+            if code != no_data:
+                return HISTORY_STATUSES_BY_CODE[code]
+        return None
+
+    def _bisect(self, key, value: int, size: int, right: bool) -> int:
+        # The first index whose value is not less than (right=False) or greater than (right=True) the given one
+        low, high = 0, size
+        while low < high:
+            middle = (low + high) // 2
+            middle_value = key(middle)
+            if middle_value < value or (right and middle_value == value):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def query(self, start: datetime = None, end: datetime = None, limit: int = None) -> List[Status]:
+        size = len(self)
+        first = 0 if start is None else self._bisect(self._end_ms, to_epoch_ms(start), size, right=False)
+        last = size if end is None else self._bisect(self._start_ms, to_epoch_ms(end), size, right=True)
+        if limit is not None:
+            last = min(last, first + limit)
+        return [self._status_at(index) for index in range(first, last)]
+
+
+class HistoryStore(BaseHistoryStore):
+    """
+    Bounded in-memory store of the decision history.
+    Entries are kept in a ring buffer of columns (epoch milliseconds of start and end, status code),
+    so memory doesn't grow beyond the retention.
+
+    Attributes:
+        retention (int): The maximum number of entries kept. The oldest entry is dropped when the store is full.
+        evicted (int): The number of entries dropped so far.
+    """
+
+    def __init__(self, retention=10000):
+        if retention <= 0:
+            raise ValueError("retention must be a positive number")
+        self.retention = retention
+        self.clear()
+
+    def clear(self):
+        self._starts = array('q', bytes(8 * self.retention))
+        self._ends = array('q', bytes(8 * self.retention))
+        self._statuses = bytearray(self.retention)
+        self._head = 0
+        self._size = 0
+        self.evicted = 0
+        self.generation += 1
+
+    def __len__(self) -> int:
+        return self._size
+
+    def _physical(self, index: int) -> int:
+        return (self._head + index) % self.retention
+
+    def _start_ms(self, index: int) -> int:
+        return self._starts[self._physical(index)]
+
+    def _end_ms(self, index: int) -> int:
+        return self._ends[self._physical(index)]
+
+    def _status_code(self, index: int) -> int:
+        return self._statuses[self._physical(index)]
+
+    def append(self, start: datetime, end: datetime, status: str):
+        if self._size == self.retention:
+            # the ring is full, the oldest entry is overwritten
+            position = self._head
+            self._head = (self._head + 1) % self.retention
+            self.evicted += 1
+        else:
+            position = self._physical(self._size)
+            self._size += 1
+        self._starts[position] = to_epoch_ms(start)
+        self._ends[position] = to_epoch_ms(end)
+        self._statuses[position] = HISTORY_STATUS_CODES[status]
+
+    def update_last_end(self, end: datetime):
+        if not self._size:
+            raise IndexError("history is empty")
+        self._ends[self._physical(self._size - 1)] = to_epoch_ms(end)
+
+
+class FileHistoryStore(BaseHistoryStore):
+    """
+    Persistent store of the decision history.
+    Entries are fixed-size records (start, end, status code) appended to a file. Only the end of the latest
+    record is ever rewritten in place. Reads go through a memory map, so the history isn't loaded into RAM,
+    and reopening the file after a restart only has to drop a torn record at its end.
+    Writes are synced to disk by a background thread, so the event loop never waits for fsync.
+
+    Attributes:
+        path (str): The path of the history file.
+        fsync_every (int): The number of unsynced writes which wake the background sync before its interval ends.
+        fsync_interval (float): The interval (in seconds) of the background sync of the unsynced writes.
+    """
+    RECORD = struct.Struct('<qqB7x')
+
+    def __init__(self, path: str, fsync_every=64, fsync_interval=1.0):
+        self.path = path
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self._map = None
+        self._mapped_size = 0
+        # each counter has a single writer: the event loop counts the writes, the syncer the synced ones
+        self._writes = 0
+        self._synced_writes = 0
+        self._sync_requested = threading.Event()
+        self._closing = threading.Event()
+        self._syncer = None
+        self._recover()
+
+    def _recover(self):
+        # A crash in the middle of a write may leave a partial record, which is dropped
+        size = os.fstat(self._fd).st_size
+        torn = size % self.RECORD.size
+        if torn:
+            os.ftruncate(self._fd, size - torn)
+
+    def __len__(self) -> int:
+        # The file size is checked on every call, so records written by other processes are visible too
+        return os.fstat(self._fd).st_size // self.RECORD.size
+
+    def _record(self, index: int):
+        offset = index * self.RECORD.size
+        if offset + self.RECORD.size > self._mapped_size:
+            self._remap()
+        return self.RECORD.unpack_from(self._map, offset)
+
+    def _remap(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._mapped_size = os.fstat(self._fd).st_size
+        if self._mapped_size:
+            self._map = mmap.mmap(self._fd, self._mapped_size, access=mmap.ACCESS_READ)
+
+    def _start_ms(self, index: int) -> int:
+        return self._record(index)[0]
+
+    def _end_ms(self, index: int) -> int:
+        return self._record(index)[1]
+
+    def _status_code(self, index: int) -> int:
+        return self._record(index)[2]
+
+    def _write(self, offset: int, data: bytes):
+        os.lseek(self._fd, offset, os.SEEK_SET)
+        os.write(self._fd, data)
+        self._writes += 1
+        if self._syncer is None:
+            self._syncer = threading.Thread(target=self._run_syncer, name='history-fsync', daemon=True)
+            self._syncer.start()
+        if self._writes - self._synced_writes >= self.fsync_every:
+            self._sync_requested.set()
+
+    def _run_syncer(self):
+        while not self._closing.is_set():
+            self._sync_requested.wait(self.fsync_interval)
+            self._sync_requested.clear()
+            if self._writes != self._synced_writes and not self._closing.is_set():
+                self.flush()
+
+    def append(self, start: datetime, end: datetime, status: str):
+        self._write(len(self) * self.RECORD.size,
+                    self.RECORD.pack(to_epoch_ms(start), to_epoch_ms(end), HISTORY_STATUS_CODES[status]))
+
+    def update_last_end(self, end: datetime):
+        size = len(self)
+        if not size:
+            raise IndexError("history is empty")
+        # the end is the second field of the record
+        self._write((size - 1) * self.RECORD.size + 8, struct.pack('<q', to_epoch_ms(end)))
+
+    def flush(self):
+        # Sync the writes made so far, blocking until they are on disk
+        writes = self._writes
+        os.fsync(self._fd)
+        self._synced_writes = writes
+
+    def clear(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+            self._mapped_size = 0
+        os.ftruncate(self._fd, 0)
+        self.flush()
+        self.generation += 1
+
+    def close(self):
+        if self._fd is None:
+            return
+        if self._syncer is not None:
+            self._closing.set()
+            self._sync_requested.set()
+            self._syncer.join()
+            self._syncer = None
+        self.flush()
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        os.close(self._fd)
+        self._fd = None
+
+
+class HistoryRenderer:
+    """
+    Keeps the rendered "[HH:MM:SS - HH:MM:SS STATUS]" segments of a bounded history store in sync with it.
+    Only new entries and the latest entry (whose end moves) are rendered, and the joined string
+    and the JSON bodies are cached until the history changes.
+    An unbounded store (the file-backed one) isn't cached, so memory doesn't grow with the history:
+    it is rendered from the store on every call, and iter_json() renders it chunk by chunk.
+
+    Attributes:
+        store (BaseHistoryStore): The rendered history store.
+        cached (bool): Whether the rendering is kept, which is the case for bounded stores.
+
+    Methods:
+        version() -> str:
+            Returns a tag which changes whenever the history changes. It is used as the ETag of the responses.
+        as_list() -> List[str]:
+            Returns the rendered segments.
+        as_string() -> str:
+            Returns the rendered segments joined into one string.
+        as_json(as_string: bool) -> bytes:
+            Returns the JSON body of the list or of the string.
+        iter_json(as_string: bool) -> Iterator[bytes]:
+            Returns the same JSON body in chunks.
+    """
+    # The number of entries of an unbounded store rendered into one chunk
+    CHUNK_ENTRIES = 1024
+
+    def __init__(self, store: BaseHistoryStore):
+        self.store = store
+        self.cached = store.retention is not None
+        self._segments = deque()
+        self._first_index = 0
+        self._generation = store.generation
+        self._tail_end = None
+        self._version = None
+        self._cache = {}
+
+    def _sync(self):
+        store = self.store
+        if not self.cached:
+            size = len(store)
+            self._version = (f'"{store.generation}-{store.evicted + size}-'
+                             f'{store._end_ms(size - 1) if size else None}"')
+            return
+        size = len(store)
+        offset = store.evicted
+        if store.generation != self._generation or offset + size < self._first_index + len(self._segments):
+            # the store was cleared, everything is rendered again
+            self._segments.clear()
+            self._generation = store.generation
+            self._tail_end = None
+        # forget the segments of the evicted entries
+        while self._segments and self._first_index < offset:
+            self._segments.popleft()
+            self._first_index += 1
+        if not self._segments:
+            self._first_index = offset
+        rendered = self._first_index + len(self._segments) - offset
+        # only the latest rendered entry may have changed since the last sync
+        if rendered and store._end_ms(rendered - 1) != self._tail_end:
+            self._segments[-1] = render_status(store[rendered - 1])
+        for index in range(rendered, size):
+            self._segments.append(render_status(store[index]))
+        self._tail_end = store._end_ms(size - 1) if size else None
+        version = f'"{self._generation}-{offset + size}-{self._tail_end}"'
+        if version != self._version:
+            self._version = version
+            self._cache.clear()
+
+    def version(self) -> str:
+        self._sync()
+        return self._version
+
+    def as_list(self) -> List[str]:
+        self._sync()
+        if not self.cached:
+            return [render_status(entry) for entry in self.store]
+        return list(self._segments)
+
+    def as_string(self) -> str:
+        self._sync()
+        if not self.cached:
+            return ', '.join(self.as_list())
+        if 'string' not in self._cache:
+            self._cache['string'] = ', '.join(self._segments)
+        return self._cache['string']
+
+    def as_json(self, as_string: bool = False) -> bytes:
+        if not self.cached:
+            return b''.join(self.iter_json(as_string))
+        key = 'string_json' if as_string else 'list_json'
+        self._sync()
+        if key not in self._cache:
+            self._cache[key] = json.dumps(self.as_string() if as_string else list(self._segments)).encode()
+        return self._cache[key]
+
+    def iter_json(self, as_string: bool = False) -> Iterator[bytes]:
+        if self.cached:
+            yield self.as_json(as_string)
+            return
+        store = self.store
+        size = len(store)
+        yield b'"' if as_string else b'['
+        for first in range(0, size, self.CHUNK_ENTRIES):
+            # the store may be cleared between two chunks
+            last = min(first + self.CHUNK_ENTRIES, size, len(store))
+            segments = [render_status(store[index]) for index in range(first, last)]
+            if not segments:
+                break
+            separator = ', ' if first else ''
+            if as_string:
+                # the escaped text without its quotes
+                yield json.dumps(separator + ', '.join(segments))[1:-1].encode()
+            else:
+                yield (separator + json.dumps(segments)[1:-1]).encode()
+        yield b'"' if as_string else b']'
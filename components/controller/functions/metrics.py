@@ -0,0 +1,63 @@
+from invian_shared.utils.metrics import Counter, Gauge, Histogram, MetricsRegistry
+
+# Bucket bounds for the number of readings of a decision window
+WINDOW_READINGS_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+# Bucket bounds for the average payload of a decision window
+WINDOW_AVERAGE_BUCKETS = (10, 20, 30, 40, 50, 60, 70, 80, 90, 100)
+
+
+class ControllerMetrics:
+    """
+    The metrics of a controller, served in the Prometheus text format.
+    The instruments which are updated for every reading are created once and kept as attributes,
+    so updating them is an attribute lookup and an increment.
+
+    Attributes:
+        registry (MetricsRegistry): The registry every metric is rendered from.
+        readings_accepted, readings_bad_payload, readings_outdated: The counters of the readings by result.
+        window_readings (Histogram): The number of readings of every closed decision window.
+        window_average (Histogram): The aggregated payload of every decided window.
+        lock_wait (Histogram): The time (in seconds) spent waiting for the lock of a group.
+        decisions (Dict[str, counter]): The counters of the decisions made, by status.
+        send_latency (Dict[str, histogram]): The time of a delivery to the manipulator, by transport.
+        send_failures (Dict[str, counter]): The failed deliveries to the manipulator, by transport.
+        spans (Histogram): The sampled durations of the profiled sections, by span.
+    """
+
+    def __init__(self, controller):
+        self.registry = MetricsRegistry()
+        register = self.registry.register
+
+        readings = register(Counter('controller_readings_total', 'Sensor readings received, by result.',
+                                    ('result',)))
+        self.readings_accepted = readings.labels('accepted')
+        self.readings_bad_payload = readings.labels('bad_payload')
+        self.readings_outdated = readings.labels('outdated')
+
+        self.window_readings = register(Histogram(
+            'controller_window_readings', 'Readings in a closed decision window.', WINDOW_READINGS_BUCKETS))
+        self.window_average = register(Histogram(
+            'controller_window_average', 'Aggregated payload of a decided window.', WINDOW_AVERAGE_BUCKETS))
+        self.lock_wait = register(Histogram(
+            'controller_lock_wait_seconds', 'Time spent waiting for the lock of a sensor group.'))
+
+        decisions = register(Counter('controller_decisions_total', 'Decisions made, by status.', ('status',)))
+        self.decisions = {status: decisions.labels(status) for status in ('up', 'down')}
+
+        send_latency = register(Histogram('controller_manipulator_send_seconds',
+                                          'Time of a decision delivery to the manipulator.', labelnames=('transport',)))
+        send_failures = register(Counter('controller_manipulator_send_failures_total',
+                                         'Failed decision deliveries to the manipulator.', ('transport',)))
+        self.send_latency = {transport: send_latency.labels(transport) for transport in ('websocket', 'http')}
+        self.send_failures = {transport: send_failures.labels(transport) for transport in ('websocket', 'http')}
+
+        self.spans = register(Histogram('controller_span_seconds',
+                                        'Sampled duration of a profiled section of the controller.',
+                                        labelnames=('span',)))
+
+        # values the controller keeps anyway are read when the metrics are rendered
+        register(Gauge('controller_history_entries', 'Entries in the history of a sensor group.', ('group',),
+                       collect=lambda: (((state.group or '',), len(state.history)) for state in controller.groups)))
+        register(Gauge('controller_dispatcher_queue_depth', 'Decisions waiting for delivery.', ('group',),
+                       collect=lambda: (((state.group or '',), len(state.dispatcher.queue))
+                                        for state in controller.groups)))
@@ -0,0 +1,146 @@
+import asyncio
+import cProfile
+import marshal
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Callable, Dict, Optional
+
+from invian_shared.utils.metrics import Histogram
+
+
+class StackSampler:
+    """
+    A statistical profiler of one thread. A background thread takes the thread's stack every `interval` seconds
+    and counts the stacks, which are rendered in the collapsed format read by flamegraph tools.
+
+    Methods:
+        start() -> None:
+            Starts sampling.
+        stop() -> None:
+            Stops sampling.
+        collapsed() -> str:
+            Returns one "frame;frame;frame count" line per distinct stack, outermost frame first.
+    """
+
+    def __init__(self, thread_id: int, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def collapsed(self) -> str:
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+
+class Profiler:
+    """
+    Opt-in profiling of the controller's hot paths.
+
+    While span timing is enabled, one call in `sample_every` of every instrumented section (the request handler,
+    process_request and the decision with its dispatch) is timed, and the durations are observed in the
+    controller_span_seconds histogram served at /metrics. While it is disabled, an instrumented section
+    costs a single attribute check.
+
+    A capture profiles the event loop's thread for a number of seconds, with cProfile (a pstats file)
+    or with a StackSampler (a collapsed-stack file for flamegraphs). One capture runs at a time.
+
+    Attributes:
+        enabled (bool): Whether span timing is enabled.
+        sample_every (int): One call in this many is timed.
+        capturing (bool): Whether a capture is running.
+
+    Methods:
+        enable(sample_every: int | None) -> None:
+            Enables span timing.
+        disable() -> None:
+            Disables span timing.
+        start(span: str) -> float | None:
+            Returns the start time of the call if it is sampled, None otherwise.
+        finish(span: str, started: float) -> None:
+            Records the duration of a sampled call.
+        capture(seconds: float, mode: str) -> bytes:
+            Profiles the event loop for a number of seconds and returns the profile.
+    """
+    SPANS = ('recieve_request', 'process_request', 'decide')
+    CAPTURE_MODES = ('cprofile', 'sample')
+
+    def __init__(self, spans: Callable[[], Histogram], enabled=False, sample_every=100):
+        if sample_every <= 0:
+            raise ValueError("sample_every must be a positive number")
+        self._spans = spans
+        self.enabled = enabled
+        self.sample_every = sample_every
+        self.capturing = False
+        self._calls: Dict[str, int] = dict.fromkeys(self.SPANS, 0)
+
+    def enable(self, sample_every: int = None):
+        if sample_every is not None:
+            if sample_every <= 0:
+                raise ValueError("sample_every must be a positive number")
+            self.sample_every = sample_every
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def start(self, span: str) -> Optional[float]:
+        calls = self._calls[span] = self._calls[span] + 1
+        if calls % self.sample_every:
+            return None
+        return time.perf_counter()
+
+    def finish(self, span: str, started: float):
+        self._spans().labels(span).observe(time.perf_counter() - started)
+
+    async def capture(self, seconds: float, mode='cprofile', interval=0.005) -> bytes:
+        if mode not in self.CAPTURE_MODES:
+            raise ValueError(f"mode must be one of {self.CAPTURE_MODES}")
+        if self.capturing:
+            raise RuntimeError("A capture is already running.")
+        self.capturing = True
+        try:
+            if mode == 'cprofile':
+                profile = cProfile.Profile()
+                profile.enable()
+                try:
+                    await asyncio.sleep(seconds)
+                finally:
+                    profile.disable()
+                # the same content as Profile.dump_stats(), which pstats.Stats() loads
+                profile.create_stats()
+                return marshal.dumps(profile.stats)
+            sampler = StackSampler(threading.get_ident(), interval)
+            sampler.start()
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                sampler.stop()
+            return sampler.collapsed().encode()
+        finally:
+            self.capturing = False
@@ -0,0 +1,98 @@
+import asyncio
+import logging
+import time
+from typing import List
+
+from components.controller.functions.controller_functions import Controller
+from components.controller.schemas.response import ControllerDecision
+from invian_shared.utils.timestamps import epoch_ms_now, from_epoch_ms
+
+
+class WindowScheduler:
+    """
+    Closes the decision windows of every sensor group in a background task, at exact boundaries of a monotonic clock.
+    While it runs, processing a reading only validates and accumulates it, and a window is decided even if
+    no reading arrives after its end.
+
+    Attributes:
+        controller (Controller): The controller whose windows are closed.
+        empty_windows (str): What is recorded for a window without readings:
+            "hold" extends the last status over it, "no_data" records it as a "no data" gap in the history.
+        closed (int): The number of times the windows were closed.
+        missed (int): The number of boundaries skipped because the event loop was blocked for a whole window.
+
+    Methods:
+        start() -> None:
+            Starts the background task.
+        stop() -> None:
+            Stops the background task.
+        close_windows() -> List[ControllerDecision]:
+            Closes the current window of every group and returns the decisions made.
+    """
+    EMPTY_WINDOW_POLICIES = ('hold', 'no_data')
+
+    def __init__(self, controller: Controller, empty_windows='hold', clock=time.monotonic, sleep=asyncio.sleep,
+                 logger=None):
+        if empty_windows not in self.EMPTY_WINDOW_POLICIES:
+            raise ValueError(f"empty_windows must be one of {self.EMPTY_WINDOW_POLICIES}")
+        self.controller = controller
+        self.empty_windows = empty_windows
+        self.closed = 0
+        self.missed = 0
+        self.logger = logger or logging.getLogger(__name__)
+        self._clock = clock
+        self._sleep = sleep
+        self._task = None
+
+    @property
+    def is_running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        if not self.is_running:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def close_windows(self) -> List[ControllerDecision]:
+        controller = self.controller
+        now = from_epoch_ms(epoch_ms_now())
+        decisions = []
+        for state in list(controller.groups):
+            if state is controller.default_group and controller.window_coordinator is not None:
+                # the default group's windows are closed by the coordinator of the workers
+                continue
+            async with controller.groups.lock_for(state.group):
+                readings = state.aggregator.count
+                if readings:
+                    decisions.append(controller._decide(state.aggregator.close_window(), now, state, readings))
+                else:
+                    controller._close_empty_window(now, state, mark_no_data=self.empty_windows == 'no_data')
+        self.closed += 1
+        return decisions
+
+    async def _run(self):
+        interval = self.controller.decision_interval_seconds
+        boundary = self._clock() + interval
+        while True:
+            # the next boundary is fixed in advance, so the time spent closing windows doesn't make them drift
+            await self._sleep(max(0.0, boundary - self._clock()))
+            try:
+                await self.close_windows()
+            except Exception as exc:
+                self.logger.error(f"Failed to close the decision windows.\nDetails: {exc}")
+            boundary += interval
+            now = self._clock()
+            if now >= boundary:
+                missed = int((now - boundary) // interval) + 1
+                self.missed += missed
+                boundary += missed * interval
+                # the readings of the skipped windows are decided with the next one
+                self.logger.warning(f"Skipped {missed} window boundaries, the event loop was blocked.")
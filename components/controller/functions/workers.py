@@ -0,0 +1,259 @@
+import asyncio
+import fcntl
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import NamedTuple, Optional, Tuple
+
+from components.controller.functions.aggregators import MeanAggregator
+from components.controller.functions.scheduler import WindowScheduler
+from components.controller.schemas.response import ControllerDecision
+from invian_shared.utils.timestamps import from_epoch_ms, to_epoch_ms
+from invian_shared.utils.wire import STATUS_CODES, STATUSES_BY_CODE
+
+
+def default_shared_state_path() -> str:
+    # /dev/shm keeps the segment in memory on Linux
+    directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(directory, 'invian_controller_windows')
+
+
+class WindowClaim(NamedTuple):
+    window: int
+    count: int
+    total: int
+    previous_status: Optional[str]
+    last_decision_time: Optional[datetime]
+
+
+class SharedWindowState:
+    """
+    Shared-memory segment in which the workers of the controller merge the partial aggregates of decision windows.
+    The segment is a memory-mapped file (in /dev/shm by default) guarded by an exclusive file lock. It holds the
+    count and sum of the latest windows in a ring of slots, the latest decided window and the previous decision,
+    so the worker which claims a window makes the same decision a single process would.
+
+    Attributes:
+        path (str): The path of the segment.
+        slots (int): The number of windows kept in the ring.
+        late (int): The number of partial aggregates this worker added after their window was decided.
+
+    Methods:
+        create(path: str, slots: int) -> SharedWindowState:
+            Creates or resets the segment. It is called once, before the workers start.
+        add_partial(window: int, count: int, total: int) -> bool:
+            Adds a worker's partial aggregate of a window. Returns False if the window is already decided.
+        claim(window: int) -> WindowClaim | None:
+            Marks a window as decided and returns its merged aggregate and the previous decision.
+            Exactly one claim of a window succeeds, the others return None.
+        record_decision(status: str, moment: datetime) -> None:
+            Stores the decision made for the claimed window.
+        last_decision() -> Tuple[str | None, datetime | None]:
+            Returns the status and the time of the latest decision.
+    """
+    # decided window, status code of the latest decision, time of the latest decision in epoch milliseconds
+    HEADER = struct.Struct('<qqq')
+    # window, count, sum
+    SLOT = struct.Struct('<qqq')
+
+    def __init__(self, path: str, slots=8):
+        self.path = path
+        self.slots = slots
+        self.late = 0
+        self._fd = os.open(path, os.O_RDWR)
+        self._map = mmap.mmap(self._fd, self.HEADER.size + slots * self.SLOT.size)
+
+    @classmethod
+    def create(cls, path: str, slots=8) -> 'SharedWindowState':
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            os.write(fd, cls.HEADER.pack(-1, 0, 0) + cls.SLOT.pack(-1, 0, 0) * slots)
+        finally:
+            os.close(fd)
+        return cls(path, slots)
+
+    @contextmanager
+    def _locked(self):
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _slot_offset(self, window: int) -> int:
+        return self.HEADER.size + (window % self.slots) * self.SLOT.size
+
+    def add_partial(self, window: int, count: int, total: int) -> bool:
+        offset = self._slot_offset(window)
+        with self._locked():
+            decided_window = self.HEADER.unpack_from(self._map)[0]
+            slot_window, slot_count, slot_total = self.SLOT.unpack_from(self._map, offset)
+            if window <= decided_window or slot_window > window:
+                self.late += 1
+                return False
+            if slot_window != window:
+                # the slot still holds an older window, which was decided already
+                slot_count, slot_total = 0, 0
+            self.SLOT.pack_into(self._map, offset, window, slot_count + count, slot_total + total)
+        return True
+
+    def claim(self, window: int) -> Optional[WindowClaim]:
+        with self._locked():
+            decided_window, status_code, last_decision_ms = self.HEADER.unpack_from(self._map)
+            if window <= decided_window:
+                return None
+            slot_window, count, total = self.SLOT.unpack_from(self._map, self._slot_offset(window))
+            if slot_window != window:
+                count, total = 0, 0
+            self.HEADER.pack_into(self._map, 0, window, status_code, last_decision_ms)
+        return WindowClaim(window, count, total, STATUSES_BY_CODE.get(status_code),
+                           from_epoch_ms(last_decision_ms) if status_code else None)
+
+    def record_decision(self, status: str, moment: datetime):
+        with self._locked():
+            decided_window = self.HEADER.unpack_from(self._map)[0]
+            self.HEADER.pack_into(self._map, 0, decided_window, STATUS_CODES[status], to_epoch_ms(moment))
+
+    def last_decision(self) -> Tuple[Optional[str], Optional[datetime]]:
+        with self._locked():
+            _, status_code, last_decision_ms = self.HEADER.unpack_from(self._map)
+        if not status_code:
+            return None, None
+        return STATUSES_BY_CODE[status_code], from_epoch_ms(last_decision_ms)
+
+    def close(self):
+        if self._fd is None:
+            return
+        self._map.close()
+        os.close(self._fd)
+        self._fd = None
+
+
+class WindowCoordinator:
+    """
+    Closes the decision windows of a controller which runs in several worker processes.
+    Every worker accumulates the count and sum of its readings locally and flushes them to the SharedWindowState
+    once per window. A grace period after the end of a window, every worker tries to claim it, and the one
+    which succeeds makes the decision from the merged aggregate. The others only pick up the decision,
+    so that they ignore the readings which are outdated by it.
+
+    Windows are aligned to the wall clock: window N covers [N * interval, (N + 1) * interval) seconds since the epoch.
+
+    Attributes:
+        controller (Controller): The controller of this worker.
+        state (SharedWindowState): The state shared by the workers.
+        grace_seconds (float): The time after the end of a window given to the workers to flush their aggregates.
+        empty_windows (str): What is recorded for a window without readings, as in WindowScheduler.
+        partial (MeanAggregator): The readings of this worker which aren't flushed yet.
+
+    Methods:
+        add(payload: int) -> None:
+            Adds a reading to the partial aggregate of the current window.
+        flush() -> None:
+            Adds the partial aggregate to the shared state.
+        close_window(window: int) -> ControllerDecision | None:
+            Claims a window and makes its decision, or records it as an empty window.
+            Returns None if another worker claimed it or it had no readings.
+        start() -> None:
+            Starts the background task which closes the windows.
+        stop() -> None:
+            Stops the background task.
+    """
+
+    def __init__(self, controller, state: SharedWindowState, grace_seconds=0.5, empty_windows='hold',
+                 clock=time.time, sleep=asyncio.sleep, logger=None):
+        if empty_windows not in WindowScheduler.EMPTY_WINDOW_POLICIES:
+            raise ValueError(f"empty_windows must be one of {WindowScheduler.EMPTY_WINDOW_POLICIES}")
+        self.controller = controller
+        self.state = state
+        self.grace_seconds = grace_seconds
+        self.empty_windows = empty_windows
+        self.partial = MeanAggregator()
+        self.logger = logger or logging.getLogger(__name__)
+        self._clock = clock
+        self._sleep = sleep
+        self._window = None
+        self._task = None
+
+    def window_at(self, moment: float) -> int:
+        return int(moment // self.controller.decision_interval_seconds)
+
+    def add(self, payload: int):
+        window = self.window_at(self._clock())
+        if window != self._window:
+            self.flush()
+            self._window = window
+        self.partial.add(payload)
+
+    def flush(self):
+        if self.partial.count:
+            if not self.state.add_partial(self._window, self.partial.count, self.partial.total):
+                self.logger.warning(f"Dropped {self.partial.count} readings of the already decided window "
+                                    f"{self._window}.")
+        self.partial.reset()
+
+    async def close_window(self, window: int) -> Optional[ControllerDecision]:
+        self.flush()
+        claim = self.state.claim(window)
+        if claim is None:
+            return None
+        controller = self.controller
+        async with controller.lock:
+            # the decision continues from the latest one, whichever worker made it
+            if claim.last_decision_time is not None:
+                controller.previous_status = claim.previous_status
+                controller.last_decision_time = claim.last_decision_time
+            now = datetime.fromtimestamp((window + 1) * controller.decision_interval_seconds)
+            if not claim.count:
+                self.logger.debug(f"No readings in window {window}.")
+                controller._close_empty_window(now, mark_no_data=self.empty_windows == 'no_data')
+                decision = None
+            else:
+                decision = controller._decide(claim.total / claim.count, now, readings=claim.count)
+            status = controller.previous_status
+        # an empty window moves the last decision time too, so the other workers ignore readings from before its end
+        if status is not None:
+            self.state.record_decision(status, now)
+        return decision
+
+    def sync(self):
+        # Pick up the latest decision, which may have been made by another worker
+        previous_status, last_decision_time = self.state.last_decision()
+        if last_decision_time is not None and last_decision_time > self.controller.last_decision_time:
+            self.controller.previous_status = previous_status
+            self.controller.last_decision_time = last_decision_time
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.flush()
+
+    async def _run(self):
+        interval = self.controller.decision_interval_seconds
+        while True:
+            now = self._clock()
+            window = self.window_at(now)
+            window_end = (window + 1) * interval
+            # every worker flushes halfway through the grace period, and the window is claimed at its end
+            await self._sleep(window_end + self.grace_seconds / 2 - now)
+            self.flush()
+            await self._sleep(self.grace_seconds / 2)
+            try:
+                await self.close_window(window)
+            except Exception as exc:
+                self.logger.error(f"Failed to close window {window}.\nDetails: {exc}")
+            self.sync()
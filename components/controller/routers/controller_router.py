@@ -1,13 +1,20 @@
+import asyncio
 import logging
-from typing import Optional, List
+from datetime import datetime
+from typing import AsyncIterator, Iterator, Optional, List
 
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
 from fastapi import FastAPI
+from fastapi.exceptions import RequestValidationError
+from pydantic import ValidationError
 
 from components.controller.functions.controller_functions import Controller
-from components.controller.schemas.response import ControllerDecision
+from components.controller.functions.feed import DecisionFeed, FeedSubscription
+from components.controller.functions.profiling import Profiler
+from components.controller.schemas.response import ControllerDecision, ControllerBatchResult
 from invian_shared.shared_exceptions import BadPayloadException
-from invian_shared.shared_schemas import SensorData
+from invian_shared.shared_schemas import SensorData, sensor_batch_adapter
 
 logger = logging.getLogger()
 
@@ -18,23 +25,154 @@ def get_controller(app: FastAPI = Depends()):
 
 controller_router = APIRouter()
 
+NDJSON_CONTENT_TYPES = ('application/x-ndjson', 'application/ndjson', 'application/jsonl')
+
+
+def _batch_body_to_json_array(body: bytes, content_type: str) -> bytes:
+    # NDJSON lines are joined into a single JSON array, so the whole batch is validated in one pass
+    if content_type.split(';')[0].strip() in NDJSON_CONTENT_TYPES:
+        lines = [line for line in body.splitlines() if line.strip()]
+        return b'[' + b','.join(lines) + b']'
+    return body
+
 
 @controller_router.post("/controller/data", response_model=Optional[ControllerDecision])
 async def recieve_request(data: SensorData):
     controller = Controller()
+    profiler = controller.profiler
+    span = profiler.start('recieve_request') if profiler.enabled else None
     try:
         response = await controller.process_request(data)
         if response:
             return response
     except BadPayloadException as exc:
-        logger.warning(f"Received bad payload.\nDetails: {exc}")
+        controller.rejection_log.log(logger, logging.WARNING, "Received bad payload.\nDetails: %s", exc)
+    finally:
+        if span is not None:
+            profiler.finish('recieve_request', span)
+
+
+@controller_router.post("/controller/data/batch", response_model=ControllerBatchResult)
+async def recieve_batch(request: Request):
+    body = await request.body()
+    try:
+        batch = sensor_batch_adapter.validate_json(
+            _batch_body_to_json_array(body, request.headers.get('content-type', '')))
+    except ValidationError as exc:
+        raise RequestValidationError(exc.errors())
+    controller = Controller()
+    return await controller.process_batch(batch)
+
+
+async def _stream_chunks(chunks: Iterator[bytes]) -> AsyncIterator[bytes]:
+    # the chunks are rendered on the event loop, as the history store isn't shared with the threadpool
+    for chunk in chunks:
+        yield chunk
+        await asyncio.sleep(0)
+
+
+def _cached_history_response(request: Request, as_string: bool, group: Optional[str] = None) -> Response:
+    # The whole history is served from the version-keyed cache, unchanged history gets 304 Not Modified
+    renderer = Controller().history_renderer_for(group)
+    if renderer is None:
+        # the group has no readings yet
+        return Response(content=b'""' if as_string else b'[]', media_type='application/json')
+    etag = renderer.version()
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match and (if_none_match.strip() == '*' or etag in
+                          [tag.strip().replace('W/', '', 1) for tag in if_none_match.split(',')]):
+        return Response(status_code=304, headers={'ETag': etag})
+    if not renderer.cached:
+        # a file-backed history is rendered chunk by chunk while it is sent, without keeping it in memory
+        return StreamingResponse(_stream_chunks(renderer.iter_json(as_string)), media_type='application/json',
+                                 headers={'ETag': etag})
+    return Response(content=renderer.as_json(as_string), media_type='application/json', headers={'ETag': etag})
+
 
 @controller_router.get("/controller/history", response_model=List[str])
-async def get_history():
+async def get_history(request: Request, start: Optional[datetime] = None, end: Optional[datetime] = None,
+                      limit: Optional[int] = Query(None, ge=1), group: Optional[str] = None):
+    if start is None and end is None and limit is None:
+        return _cached_history_response(request, as_string=False, group=group)
     controller = Controller()
-    return controller.get_history()
+    return controller.get_history(start, end, limit, group=group)
+
 
 @controller_router.get("/controller/history_string", response_model=str)
-async def get_history_string():
+async def get_history_string(request: Request, start: Optional[datetime] = None, end: Optional[datetime] = None,
+                             limit: Optional[int] = Query(None, ge=1), group: Optional[str] = None):
+    if start is None and end is None and limit is None:
+        return _cached_history_response(request, as_string=True, group=group)
+    controller = Controller()
+    return controller.get_history_as_string(start, end, limit, group=group)
+
+
+@controller_router.get("/controller/dispatcher/metrics", response_model=dict)
+async def get_dispatcher_metrics(group: Optional[str] = None):
+    controller = Controller()
+    state = controller.groups.find(group)
+    if state is None:
+        raise HTTPException(status_code=404, detail=f"Unknown group: {group}")
+    return state.dispatcher.metrics()
+
+
+def _profiler_status(profiler: Profiler) -> dict:
+    return {"enabled": profiler.enabled, "sample_every": profiler.sample_every, "capturing": profiler.capturing}
+
+
+@controller_router.get("/controller/profiling", response_model=dict)
+async def get_profiling():
+    return _profiler_status(Controller().profiler)
+
+
+@controller_router.put("/controller/profiling", response_model=dict)
+async def set_profiling(enabled: bool, sample_every: Optional[int] = Query(None, ge=1)):
+    # Turn the sampled span timing on or off, the timings are served at /metrics
+    profiler = Controller().profiler
+    if enabled:
+        profiler.enable(sample_every)
+    else:
+        profiler.disable()
+    return _profiler_status(profiler)
+
+
+@controller_router.post("/controller/profiling/capture")
+async def capture_profile(seconds: float = Query(10.0, gt=0, le=300), mode: str = 'cprofile'):
+    # Profile the controller for a number of seconds and download the profile:
+    # a pstats file (mode=cprofile) or a collapsed-stack file for flamegraphs (mode=sample)
+    if mode not in Profiler.CAPTURE_MODES:
+        raise HTTPException(status_code=422, detail=f"mode must be one of {Profiler.CAPTURE_MODES}")
+    profiler = Controller().profiler
+    if profiler.capturing:
+        raise HTTPException(status_code=409, detail="A capture is already running.")
+    profile = await profiler.capture(seconds, mode)
+    filename, media_type = (('controller.pstats', 'application/octet-stream') if mode == 'cprofile'
+                            else ('controller.collapsed', 'text/plain'))
+    return Response(profile, media_type=media_type,
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+
+async def _sse_stream(feed: DecisionFeed, subscription: FeedSubscription, keepalive_seconds=15.0):
+    # Server-Sent Events: every event carries its sequence number as the id, so clients can resume
+    try:
+        while True:
+            try:
+                event = await subscription.get(timeout=keepalive_seconds)
+            except StopAsyncIteration:
+                return
+            if event is None:
+                yield b": keep-alive\n\n"
+                continue
+            yield f"id: {event.seq}\nevent: {event.event}\ndata: {event.data}\n\n".encode()
+    finally:
+        feed.unsubscribe(subscription)
+
+
+@controller_router.get("/controller/feed")
+async def get_feed(since: Optional[int] = None, last_event_id: Optional[int] = Header(None)):
+    # Resume from the Last-Event-ID header sent by reconnecting EventSource clients or from ?since=
     controller = Controller()
-    return controller.get_history_as_string()
\ No newline at end of file
+    last_seq = last_event_id if last_event_id is not None else since
+    subscription = controller.feed.subscribe(last_seq)
+    return StreamingResponse(_sse_stream(controller.feed, subscription), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache'})
@@ -0,0 +1,12 @@
+from fastapi import APIRouter, Response
+
+from components.controller.functions.controller_functions import Controller
+from invian_shared.utils.metrics import PROMETHEUS_CONTENT_TYPE
+
+metrics_router = APIRouter()
+
+
+@metrics_router.get("/metrics", response_class=Response)
+async def get_metrics():
+    # Prometheus scrapes the metrics of the controller in the text exposition format
+    return Response(Controller().metrics.registry.render(), media_type=PROMETHEUS_CONTENT_TYPE)
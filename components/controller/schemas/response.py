@@ -1,4 +1,5 @@
 from datetime import datetime
+from typing import List
 
 from pydantic import BaseModel
 
@@ -18,3 +19,9 @@ class ControllerHistory(BaseModel):
     start: datetime
     end: datetime
     status: str
+
+
+class ControllerBatchResult(BaseModel):
+    received: int
+    rejected: int
+    decisions: List[ControllerDecision]
@@ -1,10 +1,29 @@
 import asyncio
 import logging
+from collections import OrderedDict, deque
+from datetime import datetime
+from typing import NamedTuple, Optional
 from unittest.mock import AsyncMock
 
-from aiohttp import web
+from aiohttp import WSCloseCode, WSMsgType, web
+
+from invian_shared.utils.log_sampling import LogSampler
+from invian_shared.utils.wire import DECISION_FRAME, DECISION_FRAMES_CONTENT_TYPE, decode_decisions
+
+try:
+    # orjson is an optional faster drop-in for decoding JSON decisions
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+
+class Transition(NamedTuple):
+    at: datetime
+    previous: Optional[str]
+    status: str
+    seq: Optional[int]
+
 
-logging.basicConfig(level=logging.DEBUG)
 class MockServer:
     def __init__(self):
         self.start = AsyncMock()
@@ -13,27 +32,62 @@ class MockServer:
 
 class Manipulator:
     """
-        This class represents a Manipulator which receives status updates from a Controller via HTTP requests.
+        This class represents a Manipulator which receives status updates from a Controller via HTTP requests
+        or over a persistent WebSocket connection.
 
         The Manipulator runs an aiohttp server and listens for incoming requests on a specified endpoint.
         When a request is received, it validates the status and updates its current status accordingly.
+        Decisions received over the WebSocket carry a sequence number, which is acknowledged once they are applied.
+        Besides JSON, decisions can be sent as compact binary frames (see invian_shared.utils.wire),
+        and the logging of status updates is rate-limited, so high decision rates don't bottleneck on logging.
+        The sequence number of a decision is its idempotency key: a retried or duplicated decision isn't reapplied.
 
         Attributes:
             VALID_STATUSES (tuple): Valid statuses that can be received.
             SERVER_ADDRESS (str): Address where the server is running.
             SERVER_PORT (int): Port where the server is listening.
             ENDPOINT (str): Endpoint where the server receives status updates.
+            BATCH_ENDPOINT (str): Endpoint where the server receives batches of status updates.
+            WS_ENDPOINT (str): Endpoint of the WebSocket connection.
+            WS_HEARTBEAT (float): Interval (in seconds) of the pings which detect a dead WebSocket connection.
+            STATUS_ENDPOINT (str): Endpoint which returns the current status.
+            TRANSITIONS_ENDPOINT (str): Endpoint which returns the recent status transitions.
+            COUNTERS_ENDPOINT (str): Endpoint which returns the decision counters.
+            TRANSITIONS_RETENTION (int): Number of recent status transitions kept.
+            DEDUPLICATION_WINDOW (int): Number of recently applied sequence numbers remembered to detect duplicates.
             current_status (str): Current status of the manipulator.
             server (web.AppRunner): The aiohttp server.
             stop_event (asyncio.Event): Event to signal the server to stop.
             server_run_event (asyncio.Event): Event to signal when the server is running.
             logger (logging.Logger): A logger instance for logging information.
+            update_log (LogSampler): The rate limit of the status update logs.
+            rejection_log (LogSampler): The rate limit of the invalid status logs.
+            transitions (deque): The recent status transitions.
+            counters (dict): The number of received, applied, duplicate and rejected decisions and of transitions.
+            last_seq (int): The sequence number of the latest applied decision.
 
         Methods:
             handle_request(request: web.Request) -> web.Response:
                 Handle incoming requests, validate the status, and update the current_status.
+            handle_batch(request: web.Request) -> web.Response:
+                Handle a batch of decisions and return the number of applied and rejected ones.
+            handle_websocket(request: web.Request) -> web.WebSocketResponse:
+                Handle a WebSocket connection, apply and acknowledge every received decision. A malformed message
+                is acknowledged with an error, or the connection is closed if its sequence number can't be read.
+            apply_decision(data: dict) -> str | None:
+                Validate the status and update the current_status. Return the error if the status is invalid.
+            apply_status(received_status: str, details, seq: int | None) -> str | None:
+                Same as apply_decision for an already decoded status.
+            handle_get_status(request: web.Request) -> web.Response:
+                Return the current status.
+            handle_get_transitions(request: web.Request) -> web.Response:
+                Return the recent status transitions.
+            handle_get_counters(request: web.Request) -> web.Response:
+                Return the decision counters.
             get_status() -> str:
                 Return the current status.
+            create_app() -> web.Application:
+                Create the aiohttp application with the HTTP and WebSocket endpoints.
             run_server() -> None:
                 Run the aiohttp server.
             stop_server() -> None:
@@ -42,6 +96,14 @@ class Manipulator:
     VALID_STATUSES = ('up', 'down')
     SERVER_PORT = 8080
     ENDPOINT = '/'
+    BATCH_ENDPOINT = '/batch'
+    WS_ENDPOINT = '/ws'
+    WS_HEARTBEAT = 10.0
+    STATUS_ENDPOINT = '/status'
+    TRANSITIONS_ENDPOINT = '/transitions'
+    COUNTERS_ENDPOINT = '/counters'
+    TRANSITIONS_RETENTION = 1000
+    DEDUPLICATION_WINDOW = 4096
     SERVER_ADDRESS = 'manipulator'
 
     def __init__(self, server=None, mock=False):
@@ -51,29 +113,164 @@ class Manipulator:
         self.stop_event = asyncio.Event()
         self.server_run_event = asyncio.Event()
         self.logger = logging.getLogger('manipulator')
+        self.update_log = LogSampler(rate=1, interval=1.0)
+        self.transitions = deque(maxlen=self.TRANSITIONS_RETENTION)
+        self.counters = {'received': 0, 'applied': 0, 'duplicates': 0, 'rejected': 0, 'transitions': 0}
+        self.last_seq = None
+        # sequence numbers of the recently applied decisions, the oldest is forgotten first
+        self._applied_seqs = OrderedDict()
+        self.rejection_log = LogSampler(rate=10, interval=1.0)
 
     async def handle_request(self, request):
         """Handle incoming requests, validate the status, and update the current_status."""
+        if request.content_type == DECISION_FRAMES_CONTENT_TYPE:
+            try:
+                frames = list(decode_decisions(await request.read()))
+            except ValueError as e:
+                self.logger.error("Error parsing request: %s", e)
+                return web.json_response({"error": "Error parsing request."}, status=400)
+            error = None
+            for frame in frames:
+                error = self.apply_status(frame.status, frame, frame.seq)
+        else:
+            try:
+                data = await request.json(loads=json_loads)
+            except Exception as e:
+                self.logger.error("Error parsing request: %s", e)
+                return web.json_response({"error": "Error parsing request."}, status=400)
+            error = self.apply_decision(data)
+        if error:
+            return web.json_response({"error": error}, status=400)
+        return web.Response()
+
+    async def handle_batch(self, request):
+        """Handle a batch of decisions, which are applied in order. The latest valid one sets the current_status."""
         try:
-            data = await request.json()
-        except Exception as e:
-            self.logger.error(f"Error parsing request: {e}")
+            if request.content_type == DECISION_FRAMES_CONTENT_TYPE:
+                frames = list(decode_decisions(await request.read()))
+                results = [self.apply_status(frame.status, frame, frame.seq) for frame in frames]
+            else:
+                batch = await request.json(loads=json_loads)
+                if not isinstance(batch, list):
+                    raise ValueError("Expected a JSON array of decisions.")
+                results = [self.apply_decision(data) if isinstance(data, dict) else "Decision is not an object."
+                           for data in batch]
+        except ValueError as e:
+            self.logger.error("Error parsing request: %s", e)
             return web.json_response({"error": "Error parsing request."}, status=400)
+        rejected = sum(1 for error in results if error)
+        return web.json_response({"applied": len(results) - rejected, "rejected": rejected})
+
+    async def handle_websocket(self, request):
+        """Handle a persistent WebSocket connection, acknowledging every decision by its sequence number."""
+        ws = web.WebSocketResponse(heartbeat=self.WS_HEARTBEAT)
+        await ws.prepare(request)
+        self.logger.info("Controller connected over WebSocket.")
+        async for message in ws:
+            try:
+                if message.type == WSMsgType.BINARY:
+                    # a message may hold several frames, the acknowledgement of the last one covers them all
+                    frames = list(decode_decisions(message.data))
+                    error = None
+                    for frame in frames:
+                        error = self.apply_status(frame.status, frame, frame.seq)
+                    seq = frames[-1].seq
+                elif message.type == WSMsgType.TEXT:
+                    data = json_loads(message.data)
+                    seq = data['seq']
+                    error = self.apply_decision(data)
+                else:
+                    continue
+            except (ValueError, KeyError, TypeError) as e:
+                seq = self._malformed_seq(message)
+                if seq is None:
+                    # the message can't be acknowledged, the controller sends it again after reconnecting
+                    self.logger.error("Error parsing message: %s. Closing the connection.", e)
+                    await ws.close(code=WSCloseCode.UNSUPPORTED_DATA, message=b'malformed message')
+                    break
+                self.logger.error("Error parsing message %s: %s", seq, e)
+                self.counters['rejected'] += 1
+                error = f"Malformed message: {e}"
+            ack = {"ack": seq}
+            if error:
+                # a rejected decision is acknowledged too, sending it again wouldn't make it valid
+                ack["error"] = error
+            await ws.send_json(ack)
+        self.logger.info("Controller disconnected.")
+        return ws
+
+    @staticmethod
+    def _malformed_seq(message) -> Optional[int]:
+        # The sequence number of a message which failed to parse, if it can still be read
+        try:
+            if message.type == WSMsgType.BINARY:
+                if message.data and not len(message.data) % DECISION_FRAME.size:
+                    return DECISION_FRAME.unpack_from(message.data, len(message.data) - DECISION_FRAME.size)[1]
+                return None
+            seq = json_loads(message.data).get('seq')
+        except (ValueError, AttributeError):
+            return None
+        return seq if isinstance(seq, int) and not isinstance(seq, bool) else None
+
+    def apply_decision(self, data):
+        """Validate the status of a decision and update the current_status. Returns the error if it's invalid."""
+        return self.apply_status(data.get('status'), data, data.get('seq'))
+
+    def apply_status(self, received_status, details=None, seq=None):
+        """Validate a status and update the current_status. Returns the error if it's invalid."""
+        self.counters['received'] += 1
+        # a decision which was already applied is acknowledged again without being reapplied
+        if seq and seq in self._applied_seqs:
+            self.counters['duplicates'] += 1
+            self.logger.debug("Ignoring duplicate decision %s.", seq)
+            return None
 
-        received_status = data.get('status')
         if not received_status:
-            self.logger.warning("Didn't receive any status. Ignoring.")
-            return web.json_response({"error": "No status received."}, status=400)
+            self.counters['rejected'] += 1
+            self.rejection_log.log(self.logger, logging.WARNING, "Didn't receive any status. Ignoring.")
+            return "No status received."
 
         if received_status not in self.VALID_STATUSES:
-            self.logger.warning(f"Received unusual status: {received_status}. Ignoring.")
-            return web.json_response(
-                {"error": f"Invalid status received: {received_status}. Expected one of {self.VALID_STATUSES}."},
-                status=400)
+            self.counters['rejected'] += 1
+            self.rejection_log.log(self.logger, logging.WARNING,
+                                   "Received unusual status: %s. Ignoring.", received_status)
+            return f"Invalid status received: {received_status}. Expected one of {self.VALID_STATUSES}."
 
+        if received_status != self.current_status:
+            self.transitions.append(Transition(at=datetime.now(), previous=self.current_status or None,
+                                               status=received_status, seq=seq))
+            self.counters['transitions'] += 1
         self.current_status = received_status
-        self.logger.info(f"Received data: {data}")
-        return web.Response()
+        self.counters['applied'] += 1
+        if seq:
+            self.last_seq = seq
+            self._applied_seqs[seq] = None
+            if len(self._applied_seqs) > self.DEDUPLICATION_WINDOW:
+                self._applied_seqs.popitem(last=False)
+        self.update_log.log(self.logger, logging.INFO, "Received data: %s", details)
+        return None
+
+    async def handle_get_status(self, request):
+        """Return the current status, when it was set and the sequence number of the latest decision."""
+        since = self.transitions[-1].at.isoformat() if self.transitions else None
+        return web.json_response({"status": self.current_status or None, "since": since, "seq": self.last_seq})
+
+    async def handle_get_transitions(self, request):
+        """Return the recent status transitions, oldest first. The number can be limited with ?limit=."""
+        transitions = list(self.transitions)
+        try:
+            limit = int(request.query.get('limit', len(transitions)))
+        except ValueError:
+            return web.json_response({"error": "limit must be an integer."}, status=400)
+        if limit < 0:
+            return web.json_response({"error": "limit must not be negative."}, status=400)
+        selected = transitions[len(transitions) - limit:] if limit else []
+        return web.json_response([{**transition._asdict(), "at": transition.at.isoformat()}
+                                  for transition in selected])
+
+    async def handle_get_counters(self, request):
+        """Return the decision counters."""
+        return web.json_response(self.counters)
 
     def get_status(self):
         """Return the current status."""
@@ -101,12 +298,20 @@ class Manipulator:
         await self.server_run_event.wait()
         self.logger.info("Mock server is stopping.")
 
-    async def real_run_server(self):
-        """Run as a real server."""
+    def create_app(self):
+        """Create the aiohttp application with the HTTP and WebSocket endpoints."""
         app = web.Application()
-        app.add_routes([web.post(self.ENDPOINT, self.handle_request)])
+        app.add_routes([web.post(self.ENDPOINT, self.handle_request),
+                        web.post(self.BATCH_ENDPOINT, self.handle_batch),
+                        web.get(self.WS_ENDPOINT, self.handle_websocket),
+                        web.get(self.STATUS_ENDPOINT, self.handle_get_status),
+                        web.get(self.TRANSITIONS_ENDPOINT, self.handle_get_transitions),
+                        web.get(self.COUNTERS_ENDPOINT, self.handle_get_counters)])
+        return app
 
-        runner = web.AppRunner(app)
+    async def real_run_server(self):
+        """Run as a real server."""
+        runner = web.AppRunner(self.create_app())
         await runner.setup()
         site = web.TCPSite(runner, self.SERVER_ADDRESS, self.SERVER_PORT)
         await site.start()
@@ -2,6 +2,9 @@ import asyncio
 import logging
 
 from functions.manipulator_functions import Manipulator
+from invian_shared.utils.log_config import configure_logging, stop_logging
+
+configure_logging()
 logger = logging.getLogger()
 
 async def main():
@@ -18,6 +21,7 @@ async def main():
         logger.warning(f"Error: {exc}")
     finally:
         await manipulator.stop_server()
+        stop_logging()
 
 
 if __name__ == "__main__":
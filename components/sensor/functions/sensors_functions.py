@@ -1,13 +1,89 @@
 import asyncio
+import json
 import logging
 import random
+import time
+from collections import deque
 from datetime import datetime
+from typing import List, Union
 from urllib.parse import urlparse
 
 import httpx
 import pika
 
-from invian_shared.shared_schemas import SensorData
+from invian_shared.shared_exceptions import BrokerConnectionError
+from invian_shared.utils.broker import READINGS_QUEUE, Broker, connect_with_retry
+from invian_shared.utils.timestamps import epoch_ms_now
+
+
+class RateScheduler:
+    """
+        This class schedules sends on an absolute timeline, so the achieved rate doesn't depend on request latency.
+
+        The n-th send is due at start + n / rate. If the sender falls behind, up to `burst` sends are let through
+        without waiting, older missed slots are skipped instead of being caught up all at once.
+
+        Attributes:
+            rate (float): The target number of sends per second.
+            burst (int): The number of sends which may go out back to back after a stall.
+            sent (int): The number of sends scheduled so far.
+            skipped (int): The number of missed slots dropped because they exceeded the burst allowance.
+
+        Methods:
+            wait() -> None:
+                Wait until the next send is due.
+            achieved_rate() -> float:
+                Return the achieved number of sends per second.
+            stats() -> dict:
+                Return the target and achieved rates.
+        """
+
+    def __init__(self, rate: float, burst: int = 1, clock=time.monotonic, sleep=asyncio.sleep):
+        if rate <= 0:
+            raise ValueError("rate must be a positive number")
+        if burst < 1:
+            raise ValueError("burst must be at least 1")
+        self.rate = rate
+        self.burst = burst
+        self.interval = 1 / rate
+        self.clock = clock
+        self.sleep = sleep
+        self.sent = 0
+        self.skipped = 0
+        self._started_at = None
+        self._next_send = None
+
+    async def wait(self):
+        now = self.clock()
+        if self._next_send is None:
+            self._started_at = now
+            self._next_send = now
+        # the sender may lag behind the timeline by at most burst - 1 slots
+        earliest = now - (self.burst - 1) * self.interval
+        if self._next_send < earliest:
+            self.skipped += round((earliest - self._next_send) / self.interval)
+            self._next_send = earliest
+        delay = self._next_send - now
+        if delay > 0:
+            await self.sleep(delay)
+        self._next_send += self.interval
+        self.sent += 1
+
+    def achieved_rate(self) -> float:
+        if self._started_at is None:
+            return 0.0
+        elapsed = self.clock() - self._started_at
+        if elapsed <= 0:
+            return 0.0
+        return self.sent / elapsed
+
+    def stats(self) -> dict:
+        return {
+            "target_rate": self.rate,
+            "achieved_rate": self.achieved_rate(),
+            "sent": self.sent,
+            "skipped": self.skipped,
+        }
 
 
 class Sensor:
@@ -21,59 +97,233 @@ class Sensor:
             messages_per_second (int): The rate at which each sensor generates data.
             logger (logging.Logger): A logger instance for logging information.
             controller_endpoint (str): The URL endpoint to which sensor data is sent.
+            controller_batch_endpoint (str): The URL endpoint to which batches of sensor data are sent.
+            max_in_flight (int): The maximum number of requests a sensor waits for at the same time.
+            batch_size (int): The number of readings sent in one request. 1 disables batching.
+            batch_interval (float): The maximum time (in seconds) a reading waits in an unfilled batch.
+            max_connections (int): The maximum number of connections a sensor keeps open.
+            burst (int): The number of readings which may be sent back to back after a stall.
+            report_interval (float): The time (in seconds) between achieved rate reports in the log.
+            rate_schedulers (list): The rate schedulers of the running simulated sensors.
+            payload_distribution (str): The distribution of the payloads: "uniform", "normal" or "constant".
+            payload_mean (float): The mean of the "normal" distribution and the value of the "constant" one.
+            payload_stddev (float): The standard deviation of the "normal" distribution.
+            transport (str): How readings are sent: "http" to the controller's endpoints or "amqp" to RabbitMQ.
+            broker (Broker): The connected broker used by the "amqp" transport.
+            readings_queue (str): The queue the "amqp" transport publishes readings to.
+            reconnect_backoff (float): The first delay (in seconds) between the attempts to reconnect to the broker.
+            group (str | None): The sensor group id sent with every reading. None sends readings without a group.
+            latencies (deque | None): The latencies (in seconds) of the latest `latency_samples` requests,
+                None if they aren't recorded.
+            acknowledged (int): The number of readings the controller answered with 200 OK.
+            timestamp_format (str): The timestamp of a reading: "iso" for an ISO 8601 string with second precision,
+                "epoch_ms" for integer epoch milliseconds following the monotonic clock.
 
         Methods:
             generate_sensor_data(iterations: Optional[int] = None) -> None:
                 Simulate sensor data generation and send data to the specified endpoint.
 
+            rate_report() -> List[dict]:
+                Return target vs. achieved rate of every simulated sensor.
+
             _is_valid_url(url: str) -> bool:
                 Check if a given string is a valid URL.
         """
     # Class level constants
     PAYLOAD_MIN = 1
     PAYLOAD_MAX = 100
+    PAYLOAD_DISTRIBUTIONS = ('uniform', 'normal', 'constant')
+    TRANSPORTS = ('http', 'amqp')
+    TIMESTAMP_FORMATS = ('iso', 'epoch_ms')
 
     def __init__(self, messages_per_second=300, logger=None,
-                 controller_endpoint="http://controller:8000/api/v1/controller/data"):
+                 controller_endpoint="http://controller:8000/api/v1/controller/data", controller_batch_endpoint=None,
+                 max_in_flight=1, batch_size=1, batch_interval=0.1, max_connections=None, burst=1,
+                 report_interval=10.0, sensor_count=8, payload_distribution='uniform', payload_mean=None,
+                 payload_stddev=15.0, transport='http', broker: Broker = None, readings_queue=READINGS_QUEUE,
+                 group: str = None, latency_samples=0, timestamp_format='iso', reconnect_backoff=1.0):
         if messages_per_second <= 0:
             raise ValueError("messages_per_second must be a positive number")
         if not self._is_valid_url(controller_endpoint):
             raise ValueError("controller_endpoint must be a valid URL")
-        self.sensor_count = 8
+        if controller_batch_endpoint is None:
+            controller_batch_endpoint = controller_endpoint.rstrip('/') + '/batch'
+        if not self._is_valid_url(controller_batch_endpoint):
+            raise ValueError("controller_batch_endpoint must be a valid URL")
+        if max_in_flight <= 0:
+            raise ValueError("max_in_flight must be a positive number")
+        if batch_size <= 0:
+            raise ValueError("batch_size must be a positive number")
+        if sensor_count <= 0:
+            raise ValueError("sensor_count must be a positive number")
+        if payload_distribution not in self.PAYLOAD_DISTRIBUTIONS:
+            raise ValueError(f"payload_distribution must be one of {self.PAYLOAD_DISTRIBUTIONS}")
+        if transport not in self.TRANSPORTS:
+            raise ValueError(f"transport must be one of {self.TRANSPORTS}")
+        if timestamp_format not in self.TIMESTAMP_FORMATS:
+            raise ValueError(f"timestamp_format must be one of {self.TIMESTAMP_FORMATS}")
+        if transport == 'amqp' and broker is None:
+            raise ValueError("the amqp transport requires a broker")
+        self.sensor_count = sensor_count
         self.messages_per_second = messages_per_second
         self.logger = logger or logging.getLogger()
         self.controller_endpoint = controller_endpoint
+        self.controller_batch_endpoint = controller_batch_endpoint
+        self.max_in_flight = max_in_flight
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.max_connections = max_connections or max_in_flight
+        self.burst = burst
+        self.report_interval = report_interval
+        self.rate_schedulers = []
+        self.payload_distribution = payload_distribution
+        self.payload_mean = (self.PAYLOAD_MIN + self.PAYLOAD_MAX) / 2 if payload_mean is None else payload_mean
+        self.payload_stddev = payload_stddev
+        self.transport = transport
+        self.broker = broker
+        self.readings_queue = readings_queue
+        self.reconnect_backoff = reconnect_backoff
+        self._reconnecting = None
+        self.group = group
+        self.latencies = deque(maxlen=latency_samples) if latency_samples else None
+        self.acknowledged = 0
+        self.timestamp_format = timestamp_format
 
     async def generate_sensor_data(self, iterations: int = None):
-        while iterations is None or iterations > 0:
-            # self.logger.info(f'Iterations left: {iterations}')
-            try:
-                # Generate sensor reading
-                payload = random.randint(self.PAYLOAD_MIN, self.PAYLOAD_MAX)
-
-                # Format sensor reading
-                data = SensorData(datetime=datetime.now().replace(microsecond=0).isoformat(), payload=payload)
-                headers = {'Content-Type': 'application/json'}
-                async with httpx.AsyncClient() as client:
-                    request = await client.post(self.controller_endpoint, json=data.model_dump(mode='json'),
-                                                headers=headers)
-                    if request.status_code == 200:
-                        self.logger.debug("Request successful!")
+        # One keep-alive client is used for the whole run instead of a new connection per request
+        limits = httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections)
+        async with httpx.AsyncClient(limits=limits, headers={'Content-Type': 'application/json'}) as client:
+            in_flight = asyncio.Semaphore(self.max_in_flight)
+            scheduler = RateScheduler(self.messages_per_second, burst=self.burst)
+            self.rate_schedulers.append(scheduler)
+            sensor_id = len(self.rate_schedulers)
+            last_report = time.monotonic()
+            pending = set()
+            batch = []
+            batch_started = None
+            while iterations is None or iterations > 0:
+                # self.logger.info(f'Iterations left: {iterations}')
+                try:
+                    # Wait for the next slot of the send timeline
+                    await scheduler.wait()
+                    if time.monotonic() - last_report >= self.report_interval:
+                        last_report = time.monotonic()
+                        self.logger.info(f"Sensor #{sensor_id} rate: {scheduler.stats()}")
+
+                    # Generate sensor reading
+                    payload = self._generate_payload()
+
+                    # Format sensor reading
+                    data = self._reading(payload)
+                    if self.batch_size == 1:
+                        await self._dispatch(client, self.controller_endpoint, data, in_flight, pending)
                     else:
-                        self.logger.warning("Request unsuccessful.")
-                # ...and wait
-                await asyncio.sleep(1 / self.messages_per_second)
+                        # Flush the batch when it is full or when its oldest reading waited for too long
+                        if not batch:
+                            batch_started = time.monotonic()
+                        batch.append(data)
+                        if len(batch) >= self.batch_size or time.monotonic() - batch_started >= self.batch_interval:
+                            await self._dispatch(client, self.controller_batch_endpoint, batch, in_flight, pending)
+                            batch = []
 
-            except httpx.ConnectError:
-                self.logger.warning("Connection error, retrying...")
-                await asyncio.sleep(5)
+                except Exception as exc:
+                    self.logger.warning(f"Unknown error, retrying...\nDetails: {exc}")
+                    await asyncio.sleep(5)
+                finally:
+                    if iterations is not None:
+                        iterations -= 1
+            if batch:
+                await self._dispatch(client, self.controller_batch_endpoint, batch, in_flight, pending)
+            if pending:
+                await asyncio.wait(pending)
+
+    def _reading(self, payload: int) -> dict:
+        # The body of a SensorData reading. It is built directly, because a validated SensorData
+        # holds the timestamp as epoch milliseconds whatever the sensor's timestamp format is
+        reading = {'datetime': self._timestamp(), 'payload': payload}
+        if self.group is not None:
+            reading['group'] = self.group
+        return reading
+
+    def _timestamp(self) -> Union[int, str]:
+        if self.timestamp_format == 'epoch_ms':
+            return epoch_ms_now()
+        return datetime.now().replace(microsecond=0).isoformat()
+
+    def _generate_payload(self) -> int:
+        if self.payload_distribution == 'uniform':
+            return random.randint(self.PAYLOAD_MIN, self.PAYLOAD_MAX)
+        if self.payload_distribution == 'normal':
+            value = round(random.gauss(self.payload_mean, self.payload_stddev))
+        else:
+            value = round(self.payload_mean)
+        return min(max(value, self.PAYLOAD_MIN), self.PAYLOAD_MAX)
+
+    def rate_report(self) -> List[dict]:
+        return [scheduler.stats() for scheduler in self.rate_schedulers]
+
+    async def _dispatch(self, client: httpx.AsyncClient, url: str, body, in_flight: asyncio.Semaphore,
+                        pending: set):
+        # Send right away when only one request may be in flight, otherwise pipeline the requests
+        if self.max_in_flight == 1:
+            await self._send(client, url, body)
+            return
+        await in_flight.acquire()
+        task = asyncio.ensure_future(self._send(client, url, body))
+        pending.add(task)
+
+        def on_done(done):
+            pending.discard(done)
+            in_flight.release()
+
+        task.add_done_callback(on_done)
+
+    async def _send(self, client: httpx.AsyncClient, url: str, body):
+        if self.transport == 'amqp':
+            await self._publish(body)
+            return
+        try:
+            started = time.perf_counter()
+            request = await client.post(url, json=body)
+            if self.latencies is not None:
+                self.latencies.append(time.perf_counter() - started)
+            if request.status_code == 200:
+                self.acknowledged += len(body) if isinstance(body, list) else 1
+                self.logger.debug("Request successful!")
+            else:
+                self.logger.warning("Request unsuccessful.")
+        except httpx.ConnectError:
+            self.logger.warning("Connection error, retrying...")
+            await asyncio.sleep(5)
+        except Exception as exc:
+            self.logger.warning(f"Unknown error, retrying...\nDetails: {exc}")
+            await asyncio.sleep(5)
+
+    async def _publish(self, body):
+        # Every message is a JSON array of readings, publish() returns when the broker has confirmed it
+        readings = body if isinstance(body, list) else [body]
+        message = json.dumps(readings).encode()
+        while True:
+            try:
+                await self.broker.publish(self.readings_queue, message)
+                self.logger.debug("Readings published!")
+                return
+            except BrokerConnectionError as exc:
+                self.logger.warning(f"Lost the connection to RabbitMQ, publishing again...\nDetails: {exc}")
             except Exception as exc:
-                self.logger.warning(f"Unknown error, retrying...\nDetails: {exc}")
+                self.logger.warning(f"Failed to publish readings.\nDetails: {exc}")
                 await asyncio.sleep(5)
-            finally:
-                if iterations is not None:
-                    iterations -= 1
-
+                return
+            # the readings are published again once the connection is back, the pipelined publishes
+            # share a single reconnection
+            if self._reconnecting is None:
+                self._reconnecting = asyncio.Lock()
+            async with self._reconnecting:
+                if not self.broker.connected:
+                    await connect_with_retry(self.broker, initial_backoff=self.reconnect_backoff)
+                    continue
+            # a robust connection is being restored by the broker client
+            await asyncio.sleep(self.reconnect_backoff)
 
     @staticmethod
     def _is_valid_url(url: str) -> bool:
@@ -1,38 +1,66 @@
-import asyncio
+import argparse
 import logging
 import os
-import threading
 import time
 import traceback
 
 import pika
 
-from components.sensor.functions.sensors_functions import Sensor
+from components.sensor.functions.fleet import FleetConfig, run_fleet
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 
-def callback(ch, method, properties, body):
-    logger.debug(" [x] Received %r" % body)
-    sensor = Sensor(logger=logger)
-    logging.info('We are sensors and we are starting!!!')
-    tasks = [sensor.generate_sensor_data() for _ in range(sensor.sensor_count)]
-    asyncio.run(asyncio.wait(tasks))
+def parse_args(argv=None) -> argparse.Namespace:
+    # Command line options override the SENSOR_* environment variables
+    parser = argparse.ArgumentParser(description="Simulated sensor fleet.")
+    parser.add_argument('--count', type=int, help="Number of sensors.")
+    parser.add_argument('--messages-per-second', type=float, help="Rate of every sensor.")
+    parser.add_argument('--payload-distribution', choices=('uniform', 'normal', 'constant'))
+    parser.add_argument('--payload-mean', type=float)
+    parser.add_argument('--payload-stddev', type=float)
+    parser.add_argument('--controller-endpoint', help="URL of the controller's data endpoint.")
+    parser.add_argument('--processes', type=int, help="Number of processes, 0 means one per CPU core.")
+    parser.add_argument('--max-in-flight', type=int)
+    parser.add_argument('--batch-size', type=int)
+    parser.add_argument('--batch-interval', type=float)
+    parser.add_argument('--burst', type=int)
+    parser.add_argument('--transport', choices=('http', 'amqp'), help="Send readings by HTTP or through RabbitMQ.")
+    parser.add_argument('--rabbitmq-url', help="RabbitMQ URL of the amqp transport.")
+    parser.add_argument('--group', help="Sensor group id sent with every reading.")
+    parser.add_argument('--timestamp-format', choices=('iso', 'epoch_ms'),
+                        help="Send timestamps as ISO strings or as integer epoch milliseconds.")
+    parser.add_argument('--rabbitmq-host', default=os.getenv('RABBITMQ_HOST', 'rabbitmq'))
+    return parser.parse_args(argv)
 
 
-def wait_for_start_message():
+def build_config(args: argparse.Namespace) -> FleetConfig:
+    overrides = {name: value for name, value in vars(args).items() if name in FleetConfig.model_fields}
+    return FleetConfig.from_env(**overrides)
+
+
+def make_callback(config: FleetConfig):
+    def callback(ch, method, properties, body):
+        logger.debug(" [x] Received %r" % body)
+        logging.info('We are sensors and we are starting!!!')
+        run_fleet(config)
+
+    return callback
+
+
+def wait_for_start_message(config: FleetConfig, rabbitmq_host='rabbitmq'):
     backoff = 1
     while True:
         try:
-            connection = pika.BlockingConnection(pika.ConnectionParameters('rabbitmq'))
+            connection = pika.BlockingConnection(pika.ConnectionParameters(rabbitmq_host))
             channel = connection.channel()
 
             channel.queue_declare(queue='start_queue')
 
             logger.debug(' [*] Waiting for start messages. To exit press CTRL+C')
 
-            channel.basic_consume(queue='start_queue', on_message_callback=callback, auto_ack=True)
+            channel.basic_consume(queue='start_queue', on_message_callback=make_callback(config), auto_ack=True)
 
             channel.start_consuming()
             break  # If we've gotten this far, the connection was successful, so we can exit the loop.
@@ -46,5 +74,7 @@ def wait_for_start_message():
 
 
 if __name__ == '__main__':
+    arguments = parse_args()
+    fleet_config = build_config(arguments)
     while True:
-        wait_for_start_message()
+        wait_for_start_message(fleet_config, arguments.rabbitmq_host)
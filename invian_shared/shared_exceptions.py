@@ -1,2 +1,11 @@
 class BadPayloadException(BaseException):
     pass
+
+
+class BrokerConnectionError(Exception):
+    pass
+
+
+class DeliveryRejected(Exception):
+    # The receiver processed a message and rejected it, so sending it again is pointless
+    pass
@@ -1,6 +1,26 @@
-from pydantic import BaseModel
+from typing import List, Optional, Union
+
+from pydantic import BaseModel, StrictInt, TypeAdapter, field_validator
+
+from invian_shared.utils.timestamps import parse_timestamp
 
 
 class SensorData(BaseModel):
-    datetime: str
+    # an ISO 8601 string or integer epoch milliseconds, stored as epoch milliseconds
+    datetime: Union[StrictInt, str]
     payload: int
+    # readings of a sensor group drive their own decisions, readings without a group drive the default ones
+    group: Optional[str] = None
+
+    @field_validator('datetime')
+    @classmethod
+    def _to_epoch_ms(cls, value: Union[int, str]) -> int:
+        # malformed timestamps fail the validation of the request, before any reading of it is processed
+        return parse_timestamp(value)
+
+    def epoch_ms(self) -> int:
+        return self.datetime
+
+
+# Validates a whole JSON array of readings in one pass
+sensor_batch_adapter = TypeAdapter(List[SensorData])
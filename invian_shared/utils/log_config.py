@@ -0,0 +1,86 @@
+import json
+import logging
+import os
+import queue
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Optional, TextIO
+
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s %(message)s'
+
+_listener: Optional[QueueListener] = None
+_queue_handler: Optional[QueueHandler] = None
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats a record as a single-line JSON object, so the logs of the components can be parsed by a collector.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def parse_levels(spec: str) -> Dict[str, str]:
+    # "components.controller=INFO,httpx=WARNING" -> {"components.controller": "INFO", "httpx": "WARNING"}
+    levels = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        name, separator, level = item.partition('=')
+        if not separator or not name.strip() or not level.strip():
+            raise ValueError(f"Invalid logger level: {item!r}, expected <logger>=<level>.")
+        levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def configure_logging(level: str = None, component_levels: Dict[str, str] = None, json_format: bool = None,
+                      stream: TextIO = None) -> QueueListener:
+    """
+    Sets up non-blocking logging for a component. Records are put on a queue by the logging calls, and a
+    background listener thread formats and writes them, so a slow stream never blocks the event loop.
+    Records below the level of their logger are dropped before they are formatted.
+
+    The defaults are read from the environment:
+        LOG_LEVEL: The level of the root logger, INFO by default.
+        LOG_LEVELS: The levels of single components, e.g. "components.controller.functions=DEBUG,httpx=WARNING".
+        LOG_FORMAT: "json" writes every record as a JSON object, "text" (the default) as a line of text.
+
+    Calling it again replaces the previous setup. Returns the started listener.
+    """
+    global _listener, _queue_handler
+    stop_logging()
+    level = (level or os.getenv('LOG_LEVEL', 'INFO')).upper()
+    if component_levels is None:
+        component_levels = parse_levels(os.getenv('LOG_LEVELS', ''))
+    if json_format is None:
+        json_format = os.getenv('LOG_FORMAT', 'text') == 'json'
+
+    stream_handler = logging.StreamHandler(stream)
+    stream_handler.setFormatter(JsonFormatter() if json_format else logging.Formatter(LOG_FORMAT))
+    records = queue.SimpleQueue()
+    _queue_handler = QueueHandler(records)
+    root = logging.getLogger()
+    root.addHandler(_queue_handler)
+    root.setLevel(level)
+    for name, component_level in component_levels.items():
+        logging.getLogger(name).setLevel(component_level)
+    _listener = QueueListener(records, stream_handler, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+
+def stop_logging():
+    # Write the queued records and remove the queue handler
+    global _listener, _queue_handler
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+    if _queue_handler is not None:
+        logging.getLogger().removeHandler(_queue_handler)
+        _queue_handler = None
@@ -0,0 +1,45 @@
+import logging
+import time
+
+
+class LogSampler:
+    """
+    Rate-limits a frequent log message, so logging doesn't become the bottleneck of a hot path.
+    At most `rate` records are emitted per `interval` seconds. The rest are dropped before they are formatted,
+    and the number of dropped records is appended to the next emitted one.
+
+    Attributes:
+        rate (int): The number of records emitted per interval.
+        interval (float): The length (in seconds) of the interval.
+        suppressed (int): The number of records dropped since the last emitted one.
+
+    Methods:
+        log(logger: logging.Logger, level: int, msg: str, *args) -> bool:
+            Logs a record if the rate allows it. Returns whether it was emitted.
+    """
+
+    def __init__(self, rate=1, interval=1.0, clock=time.monotonic):
+        self.rate = rate
+        self.interval = interval
+        self.suppressed = 0
+        self._clock = clock
+        self._window_start = None
+        self._emitted = 0
+
+    def log(self, logger: logging.Logger, level: int, msg: str, *args) -> bool:
+        if not logger.isEnabledFor(level):
+            return False
+        now = self._clock()
+        if self._window_start is None or now - self._window_start >= self.interval:
+            self._window_start = now
+            self._emitted = 0
+        if self._emitted >= self.rate:
+            self.suppressed += 1
+            return False
+        self._emitted += 1
+        if self.suppressed:
+            msg += " (%d similar messages suppressed)"
+            args += (self.suppressed,)
+            self.suppressed = 0
+        logger.log(level, msg, *args)
+        return True
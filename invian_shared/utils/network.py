@@ -1,17 +1,289 @@
+import asyncio
+import json
 import logging
+from collections import OrderedDict
+from typing import Optional, Union
 
+import aiohttp
 import httpx
 
+from invian_shared.shared_exceptions import DeliveryRejected
+
 logger = logging.getLogger()
 
-async def tcp_client(message: str, server_address='manipulator', server_port=8080):
-    url = f"http://{server_address}:{server_port}/"
+
+class SharedHttpClient:
+    """
+    A long-lived pooled httpx.AsyncClient which is shared by everything that talks to the same services.
+    Connections are kept alive between requests, so a request doesn't pay TCP connect, pool setup and teardown.
+
+    Attributes:
+        max_connections (int): The maximum number of concurrent connections.
+        max_keepalive_connections (int): The maximum number of idle connections kept alive in the pool.
+        keepalive_expiry (float): The time (in seconds) an idle connection is kept alive.
+        timeout (float): The default timeout (in seconds) for reading, writing and acquiring a connection.
+        connect_timeout (float): The timeout (in seconds) for establishing a connection.
+        http2 (bool): Whether HTTP/2 should be used. Requires the optional `h2` package.
+
+    Methods:
+        configure(**settings) -> None:
+            Updates the settings. Must be called before start().
+        start() -> httpx.AsyncClient:
+            Creates the pooled client.
+        close() -> None:
+            Closes the pooled client and all of its connections.
+        client -> httpx.AsyncClient:
+            The pooled client. Raises RuntimeError if it isn't started.
+    """
+
+    def __init__(self, max_connections=100, max_keepalive_connections=20, keepalive_expiry=30.0, timeout=5.0,
+                 connect_timeout=2.0, http2=False):
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.keepalive_expiry = keepalive_expiry
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.http2 = http2
+        self._client: Optional[httpx.AsyncClient] = None
+
+    @property
+    def is_started(self) -> bool:
+        return self._client is not None and not self._client.is_closed
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if not self.is_started:
+            raise RuntimeError("The shared HTTP client is not started.")
+        return self._client
+
+    def configure(self, **settings):
+        if self.is_started:
+            raise RuntimeError("The shared HTTP client can't be configured after it was started.")
+        for name, value in settings.items():
+            if not hasattr(self, name) or name.startswith('_'):
+                raise AttributeError(f"Unknown HTTP client setting: {name}")
+            setattr(self, name, value)
+
+    async def start(self) -> httpx.AsyncClient:
+        if self.is_started:
+            return self._client
+        limits = httpx.Limits(max_connections=self.max_connections,
+                              max_keepalive_connections=self.max_keepalive_connections,
+                              keepalive_expiry=self.keepalive_expiry)
+        timeout = httpx.Timeout(self.timeout, connect=self.connect_timeout)
+        try:
+            self._client = httpx.AsyncClient(limits=limits, timeout=timeout, http2=self.http2)
+        except ImportError:
+            # HTTP/2 support is an optional dependency of httpx
+            logger.warning("HTTP/2 was requested, but the h2 package is not installed. Falling back to HTTP/1.1.")
+            self._client = httpx.AsyncClient(limits=limits, timeout=timeout)
+        logger.debug("Shared HTTP client started.")
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+            logger.debug("Shared HTTP client closed.")
+
+
+shared_http_client = SharedHttpClient()
+
+
+async def tcp_client(message: str, server_address='manipulator', server_port=8080,
+                     client: httpx.AsyncClient = None, url: str = None) -> bool:
+    # Returns True if the message was delivered and False if it's worth retrying.
+    # The message is posted to url as it is given, or to the root of server_address:server_port over HTTP.
+    # The given client or the started shared client is reused, otherwise a one-shot client is created.
+    url = url or f"http://{server_address}:{server_port}/"
+    if client is None and shared_http_client.is_started:
+        client = shared_http_client.client
+    if client is None:
+        async with httpx.AsyncClient() as one_shot_client:
+            return await _post_message(one_shot_client, url, message)
+    return await _post_message(client, url, message)
+
+
+async def _post_message(client: httpx.AsyncClient, url: str, message: str) -> bool:
     logger.debug(f"Connecting to {url}")
-    async with httpx.AsyncClient() as client:
+    try:
+        response = await client.post(url, data=message)
+    except httpx.ConnectError:
+        logger.warning("Failed to connect to the server.")
+        return False
+    except httpx.HTTPError as exc:
+        logger.warning(f"Failed to send the message.\nDetails: {exc}")
+        return False
+    logger.debug(f"Sending {message}")
+    return not response.is_server_error
+
+
+class WebSocketLink:
+    """
+    A persistent WebSocket connection to the manipulator, which acknowledges every message by its sequence number.
+    The connection is kept open in a background task and re-established with exponential backoff when it drops,
+    after which every unacknowledged message is sent again in order.
+
+    Every message (a JSON text with a "seq" field or binary decision frames) carries its sequence number,
+    and the manipulator answers it with {"ack": seq}, or {"ack": seq, "error": ...} if it rejected the message.
+    Messages are sent in the order they are added and processed and acknowledged in that order,
+    so an acknowledgement also covers every earlier message.
+
+    Attributes:
+        url (str): The WebSocket URL of the manipulator.
+        ack_timeout (float): The time (in seconds) send() waits for an acknowledgement.
+        heartbeat (float): The interval (in seconds) of the pings which detect a dead connection.
+        reconnect_initial_delay (float): The delay (in seconds) before the first reconnection attempt.
+        reconnect_max_delay (float): The maximum delay (in seconds) between reconnection attempts.
+        connects (int): The number of connections established so far.
+        resent (int): The number of unacknowledged messages sent when a connection was established.
+
+    Methods:
+        start() -> None:
+            Starts the background task which keeps the connection open.
+        send(seq: int, message: str | bytes) -> bool:
+            Sends an encoded message and waits for its acknowledgement. Returns False if it isn't acknowledged in time,
+            the message is then still sent again after a reconnection. Sending a sequence number which
+            is still unacknowledged waits for the same acknowledgement and doesn't send the message twice.
+            Raises DeliveryRejected if the manipulator rejected the message.
+        close() -> None:
+            Closes the connection and stops reconnecting.
+        cancel() -> None:
+            Stops reconnecting without waiting for the connection to close.
+    """
+
+    def __init__(self, url='ws://manipulator:8080/ws', ack_timeout=5.0, heartbeat=10.0,
+                 reconnect_initial_delay=0.1, reconnect_max_delay=5.0):
+        self.url = url
+        self.ack_timeout = ack_timeout
+        self.heartbeat = heartbeat
+        self.reconnect_initial_delay = reconnect_initial_delay
+        self.reconnect_max_delay = reconnect_max_delay
+        self.connects = 0
+        self.resent = 0
+        # unacknowledged messages by sequence number: (encoded message, acknowledgement future)
+        self._unacked = OrderedDict()
+        self._ws: Optional[aiohttp.ClientWebSocketResponse] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def is_connected(self) -> bool:
+        return self._ws is not None and not self._ws.closed
+
+    @property
+    def unacked(self) -> int:
+        return len(self._unacked)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def close(self):
+        task = self._task
+        self.cancel()
+        if task is not None:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    def cancel(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for _, future in self._unacked.values():
+            if not future.done():
+                future.set_result(False)
+        self._unacked.clear()
+
+    async def send(self, seq: int, message: Union[str, bytes]) -> bool:
+        entry = self._unacked.get(seq)
+        if entry is None:
+            future = asyncio.get_running_loop().create_future()
+            self._unacked[seq] = (message, future)
+            if self.is_connected:
+                try:
+                    await self._send_message(self._ws, message)
+                except (aiohttp.ClientError, ConnectionError) as exc:
+                    # the connection is re-established by the background task, which sends the message again
+                    logger.warning(f"Failed to send the message over WebSocket.\nDetails: {exc}")
+        else:
+            future = entry[1]
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), self.ack_timeout)
+        except asyncio.TimeoutError:
+            return False
+
+    async def _run(self):
+        delay = self.reconnect_initial_delay
+        async with aiohttp.ClientSession() as session:
+            while True:
+                try:
+                    ws = await session.ws_connect(self.url, heartbeat=self.heartbeat)
+                except (aiohttp.ClientError, OSError) as exc:
+                    logger.warning(f"Failed to connect to {self.url}.\nDetails: {exc}\n"
+                                   f"Waiting for {delay} seconds, then reconnecting...")
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, self.reconnect_max_delay)
+                    continue
+                delay = self.reconnect_initial_delay
+                self.connects += 1
+                logger.info(f"Connected to {self.url}.")
+                try:
+                    await self._resend(ws)
+                    self._ws = ws
+                    async for message in ws:
+                        if message.type == aiohttp.WSMsgType.TEXT:
+                            self._handle_ack(message.data)
+                        elif message.type == aiohttp.WSMsgType.ERROR:
+                            break
+                except (aiohttp.ClientError, ConnectionError) as exc:
+                    logger.warning(f"WebSocket connection failed.\nDetails: {exc}")
+                finally:
+                    self._ws = None
+                    await ws.close()
+                logger.warning(f"Lost connection to {self.url}, reconnecting...")
+
+    async def _resend(self, ws: aiohttp.ClientWebSocketResponse):
+        # Messages added while resending are picked up too, so everything is sent in the order it was added
+        resent = set()
+        while True:
+            pending = [(seq, message) for seq, (message, _) in self._unacked.items() if seq not in resent]
+            if not pending:
+                return
+            for seq, message in pending:
+                await self._send_message(ws, message)
+                self.resent += 1
+                resent.add(seq)
+
+    @staticmethod
+    async def _send_message(ws: aiohttp.ClientWebSocketResponse, message: Union[str, bytes]):
+        if isinstance(message, bytes):
+            await ws.send_bytes(message)
+        else:
+            await ws.send_str(message)
+
+    def _handle_ack(self, data: str):
         try:
-            await client.post(url, data=message)
-        except httpx.ConnectError:
-            logger.warning("Failed to connect to the server.")
+            ack = json.loads(data)
+            seq = int(ack['ack'])
+        except (ValueError, KeyError, TypeError):
+            logger.warning(f"Received malformed acknowledgement: {data}")
+            return
+        error = ack.get('error')
+        if error:
+            logger.warning(f"Manipulator rejected message {seq}.\nDetails: {error}")
+        # acknowledgements are cumulative, the messages added earlier were sent and processed before this one
+        if seq not in self._unacked:
             return
-        logger.debug(f"Sending {message}")
-        logger.debug("Closing socket")
+        while self._unacked:
+            first_seq, (_, future) = self._unacked.popitem(last=False)
+            if first_seq == seq:
+                if not future.done():
+                    if error:
+                        future.set_exception(DeliveryRejected(f"Manipulator rejected message {seq}: {error}"))
+                    else:
+                        future.set_result(True)
+                break
+            if not future.done():
+                future.set_result(True)
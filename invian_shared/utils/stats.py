@@ -0,0 +1,11 @@
+import math
+from typing import Iterable, Optional
+
+
+def percentile(values: Iterable[float], fraction: float) -> Optional[float]:
+    # The nearest-rank percentile, e.g. fraction=0.99 for p99. Returns None if there are no values.
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    rank = max(1, math.ceil(fraction * len(ordered)))
+    return ordered[min(rank, len(ordered)) - 1]
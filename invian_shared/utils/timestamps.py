@@ -0,0 +1,34 @@
+import time
+from datetime import datetime
+from functools import lru_cache
+from typing import Union
+
+# The wall clock is read once, later times follow the monotonic clock, so timestamps taken
+# by epoch_ms_now() never go backwards when the system clock is adjusted
+_WALL_ANCHOR_NS = time.time_ns()
+_MONOTONIC_ANCHOR_NS = time.monotonic_ns()
+
+
+def epoch_ms_now() -> int:
+    return (_WALL_ANCHOR_NS + time.monotonic_ns() - _MONOTONIC_ANCHOR_NS) // 1_000_000
+
+
+def to_epoch_ms(moment: datetime) -> int:
+    return round(moment.timestamp() * 1000)
+
+
+def from_epoch_ms(epoch_ms: int) -> datetime:
+    return datetime.fromtimestamp(epoch_ms / 1000)
+
+
+@lru_cache(maxsize=1024)
+def _iso_to_epoch_ms(value: str) -> int:
+    # Readings sent within the same second share their ISO timestamp, so it is parsed once
+    return to_epoch_ms(datetime.fromisoformat(value))
+
+
+def parse_timestamp(value: Union[int, str]) -> int:
+    # Epoch milliseconds are used as they are, ISO 8601 strings are converted to epoch milliseconds
+    if isinstance(value, int):
+        return value
+    return _iso_to_epoch_ms(value)
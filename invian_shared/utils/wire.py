@@ -0,0 +1,34 @@
+import struct
+from datetime import datetime
+from typing import Iterator, NamedTuple
+
+# Statuses are sent and stored as single-byte codes
+STATUS_CODES = {'up': 1, 'down': 2}
+STATUSES_BY_CODE = {code: status for status, code in STATUS_CODES.items()}
+
+# Content type of HTTP bodies made of binary decision frames
+DECISION_FRAMES_CONTENT_TYPE = 'application/octet-stream'
+
+# A decision frame: status code, sequence number, decision time in epoch milliseconds
+DECISION_FRAME = struct.Struct('<BQq')
+
+
+class DecisionFrame(NamedTuple):
+    status: str
+    seq: int
+    epoch_ms: int
+
+
+def encode_decision(status: str, moment: datetime, seq: int = 0) -> bytes:
+    return DECISION_FRAME.pack(STATUS_CODES[status], seq, round(moment.timestamp() * 1000))
+
+
+def decode_decisions(data: bytes) -> Iterator[DecisionFrame]:
+    # Decodes a body made of one or more concatenated frames. Raises ValueError if it is malformed.
+    if not data or len(data) % DECISION_FRAME.size:
+        raise ValueError(f"Decision frames must be a non-empty multiple of {DECISION_FRAME.size} bytes, "
+                         f"got {len(data)}.")
+    for code, seq, epoch_ms in DECISION_FRAME.iter_unpack(data):
+        if code not in STATUSES_BY_CODE:
+            raise ValueError(f"Invalid status code received: {code}.")
+        yield DecisionFrame(STATUSES_BY_CODE[code], seq, epoch_ms)
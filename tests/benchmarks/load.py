@@ -0,0 +1,264 @@
+"""
+End-to-end load benchmark of the sensor -> controller -> manipulator pipeline.
+
+Simulated sensors drive the controller at fixed offered loads, and decisions are delivered to a stub manipulator
+over the WebSocket link. Every load level runs against a freshly started controller and reports:
+    - the sustained rate of readings acknowledged by the controller,
+    - p50/p99 ingestion latency (the sensors' request round trips),
+    - p50/p99 decision delivery lag (from the decision to the manipulator's acknowledgement),
+    - CPU time per reading.
+The results are written as JSON, so runs of different commits can be compared.
+
+The controller runs in the benchmark's event loop ("inprocess", CPU time covers the sensors and the manipulator too)
+or in a uvicorn child process ("uvicorn", CPU time of the controller's processes only, read from /proc).
+With several workers, the delivery lag is that of the worker which answers the metrics request.
+
+Usage (from the repository root):
+    python -m tests.benchmarks.load --rates 500 1000 2000 --duration 10 --output load.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import List, Literal, Optional
+
+import httpx
+from aiohttp import web
+from pydantic import BaseModel, Field
+
+from components.manipulator.functions.manipulator_functions import Manipulator
+from components.sensor.functions.sensors_functions import Sensor
+from invian_shared.utils.stats import percentile
+
+API_PREFIX = '/api/v1/controller'
+
+
+class LoadBenchmarkConfig(BaseModel):
+    rates: List[float] = Field(default=[500, 1000, 2000], min_length=1)
+    duration: float = Field(default=10, gt=0)
+    sensors: int = Field(default=8, gt=0)
+    max_in_flight: int = Field(default=4, gt=0)
+    batch_size: int = Field(default=1, gt=0)
+    mode: Literal['inprocess', 'uvicorn'] = 'inprocess'
+    workers: int = Field(default=1, gt=0)
+    decision_interval: float = Field(default=1, gt=0)
+    latency_samples: int = Field(default=100000, gt=0)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def process_tree_cpu_seconds(pid: int) -> Optional[float]:
+    # User and system CPU time of a process and its children, None where /proc isn't available
+    try:
+        with open(f'/proc/{pid}/stat') as stat:
+            fields = stat.read().rsplit(')', 1)[1].split()
+        with open(f'/proc/{pid}/task/{pid}/children') as children:
+            child_pids = [int(child) for child in children.read().split()]
+    except OSError:
+        return None
+    # utime and stime are the 14th and 15th fields of the stat line
+    seconds = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    for child in child_pids:
+        seconds += process_tree_cpu_seconds(child) or 0.0
+    return seconds
+
+
+def _milliseconds(seconds: Optional[float]) -> Optional[float]:
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+class StubManipulator:
+    # The manipulator's WebSocket and HTTP endpoints on a local port
+    def __init__(self):
+        self.port = free_port()
+        self.manipulator = Manipulator()
+        self._runner = None
+
+    async def start(self):
+        self._runner = web.AppRunner(self.manipulator.create_app())
+        await self._runner.setup()
+        await web.TCPSite(self._runner, '127.0.0.1', self.port).start()
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+
+class InProcessController:
+    # The controller app served by uvicorn in the benchmark's event loop
+    def __init__(self, port: int):
+        import uvicorn
+        from components.controller.main import app
+        self.port = port
+        self.server = uvicorn.Server(uvicorn.Config(app, host='127.0.0.1', port=port, log_level='warning',
+                                                    access_log=False))
+        self._task = None
+
+    async def start(self):
+        self._task = asyncio.get_running_loop().create_task(self.server.serve())
+        while not self.server.started:
+            if self._task.done():
+                self._task.result()
+            await asyncio.sleep(0.01)
+
+    async def stop(self):
+        from components.controller.functions.controller_functions import Controller
+        self.server.should_exit = True
+        await self._task
+        # the next level starts from a clean controller
+        Controller().reset()
+
+    def cpu_seconds(self) -> Optional[float]:
+        return time.process_time()
+
+
+class UvicornController:
+    # The controller app served by uvicorn in a child process
+    def __init__(self, port: int, workers: int):
+        self.port = port
+        self.workers = workers
+        self.process = None
+
+    async def start(self):
+        env = dict(os.environ)
+        if self.workers > 1:
+            from components.controller.functions.workers import SharedWindowState
+            path = os.path.join(tempfile.gettempdir(), f'invian_benchmark_windows_{self.port}')
+            SharedWindowState.create(path).close()
+            env['CONTROLLER_SHARED_STATE_PATH'] = path
+            env['CONTROLLER_HISTORY_PATH'] = os.path.join(tempfile.gettempdir(),
+                                                          f'invian_benchmark_history_{self.port}')
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'uvicorn', 'components.controller.main:app', '--host', '127.0.0.1',
+             '--port', str(self.port), '--workers', str(self.workers), '--log-level', 'warning', '--no-access-log'],
+            env=env)
+        async with httpx.AsyncClient() as client:
+            while True:
+                if self.process.poll() is not None:
+                    raise RuntimeError(f"The controller exited with code {self.process.returncode}.")
+                try:
+                    await client.get(f'http://127.0.0.1:{self.port}{API_PREFIX}/history')
+                    return
+                except httpx.TransportError:
+                    await asyncio.sleep(0.1)
+
+    async def stop(self):
+        self.process.terminate()
+        await asyncio.get_running_loop().run_in_executor(None, self.process.wait)
+
+    def cpu_seconds(self) -> Optional[float]:
+        return process_tree_cpu_seconds(self.process.pid)
+
+
+async def run_level(config: LoadBenchmarkConfig, rate: float) -> dict:
+    manipulator = StubManipulator()
+    await manipulator.start()
+    os.environ.update({
+        'BROKER': 'memory',
+        'MANIPULATOR_TRANSPORT': 'websocket',
+        'MANIPULATOR_WS_URL': f'ws://127.0.0.1:{manipulator.port}/ws',
+        'CONTROLLER_DECISION_INTERVAL': str(config.decision_interval),
+        'LOG_LEVEL': os.getenv('LOG_LEVEL', 'WARNING'),
+    })
+    port = free_port()
+    if config.mode == 'inprocess':
+        controller = InProcessController(port)
+    else:
+        controller = UvicornController(port, config.workers)
+    await controller.start()
+    try:
+        sensor = Sensor(messages_per_second=rate / config.sensors, sensor_count=config.sensors,
+                        controller_endpoint=f'http://127.0.0.1:{port}{API_PREFIX}/data',
+                        max_in_flight=config.max_in_flight, batch_size=config.batch_size,
+                        report_interval=float('inf'), latency_samples=config.latency_samples)
+        iterations = max(1, round(rate / config.sensors * config.duration))
+        cpu_before = controller.cpu_seconds()
+        started = time.perf_counter()
+        await asyncio.gather(*(sensor.generate_sensor_data(iterations) for _ in range(config.sensors)))
+        elapsed = time.perf_counter() - started
+        cpu_after = controller.cpu_seconds()
+        # let the decision of the last window reach the manipulator
+        await asyncio.sleep(config.decision_interval * 1.5)
+        async with httpx.AsyncClient() as client:
+            dispatcher = (await client.get(f'http://127.0.0.1:{port}{API_PREFIX}/dispatcher/metrics')).json()
+    finally:
+        await controller.stop()
+        await manipulator.stop()
+
+    cpu_seconds = None if cpu_before is None or cpu_after is None else cpu_after - cpu_before
+    latencies = list(sensor.latencies)
+    return {
+        'offered_rate': rate,
+        'sent': sum(report['sent'] for report in sensor.rate_report()),
+        'acknowledged': sensor.acknowledged,
+        'elapsed_seconds': round(elapsed, 3),
+        'sustained_rate': round(sensor.acknowledged / elapsed, 1),
+        'ingestion_latency_p50_ms': _milliseconds(percentile(latencies, 0.5)),
+        'ingestion_latency_p99_ms': _milliseconds(percentile(latencies, 0.99)),
+        'decisions_delivered': dispatcher['delivered'],
+        'manipulator_applied': manipulator.manipulator.counters['applied'],
+        'delivery_lag_p50_ms': _milliseconds(dispatcher['p50_delivery_lag_seconds']),
+        'delivery_lag_p99_ms': _milliseconds(dispatcher['p99_delivery_lag_seconds']),
+        'cpu_seconds': None if cpu_seconds is None else round(cpu_seconds, 3),
+        'cpu_us_per_reading': (round(cpu_seconds / sensor.acknowledged * 1e6, 1)
+                               if cpu_seconds is not None and sensor.acknowledged else None),
+    }
+
+
+def _commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run_benchmark(config: LoadBenchmarkConfig) -> dict:
+    results = []
+    for rate in config.rates:
+        result = await run_level(config, rate)
+        print(json.dumps(result), flush=True)
+        results.append(result)
+    return {
+        'benchmark': 'load',
+        'started_at': datetime.now().isoformat(timespec='seconds'),
+        'commit': _commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'config': config.model_dump(),
+        'results': results,
+    }
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rates', type=float, nargs='+', help='Offered loads in readings per second.')
+    parser.add_argument('--duration', type=float, help='Duration (in seconds) of every load level.')
+    parser.add_argument('--sensors', type=int, help='Number of simulated sensors sharing the load.')
+    parser.add_argument('--max-in-flight', type=int, help='Pipelined requests per sensor.')
+    parser.add_argument('--batch-size', type=int, help='Readings per request.')
+    parser.add_argument('--mode', choices=['inprocess', 'uvicorn'])
+    parser.add_argument('--workers', type=int, help='Controller worker processes (uvicorn mode).')
+    parser.add_argument('--decision-interval', type=float, help='Decision window (in seconds).')
+    parser.add_argument('--output', default='load_benchmark.json', help='Path of the JSON results.')
+    args = parser.parse_args(argv)
+    overrides = {name: value for name, value in vars(args).items() if name != 'output' and value is not None}
+    report = asyncio.run(run_benchmark(LoadBenchmarkConfig(**overrides)))
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
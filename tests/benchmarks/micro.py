@@ -0,0 +1,278 @@
+"""
+Micro-benchmarks of the controller's hot functions, compared against stored baselines.
+
+Every case is timed like timeit: the number of calls per run is calibrated to take at least --min-time seconds,
+and the fastest of --repeats runs gives the time per call. Slow cases stop repeating once their runs took
+--max-time seconds. A case regresses when it is slower than its baseline by more than the threshold
+(--threshold, or the "threshold" stored with the case's baseline), and then the command exits with code 1.
+
+Baselines are kept in tests/benchmarks/micro_baseline.json and depend on the machine, so compare runs made on
+the same machine and refresh the baselines with --save-baseline after an intended change.
+
+Usage (from the repository root):
+    python -m tests.benchmarks.micro                    # run every case and compare with the baselines
+    python -m tests.benchmarks.micro -k format_history  # run the cases whose name contains a string
+    python -m tests.benchmarks.micro --save-baseline    # store the results as the new baselines
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import sys
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+from components.controller.functions.controller_functions import Controller
+from components.controller.functions.history import HistoryStore
+from invian_shared.shared_schemas import SensorData
+from invian_shared.utils.timestamps import parse_timestamp
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'micro_baseline.json')
+DEFAULT_THRESHOLD = 0.2
+
+# The size of a history in the history formatting cases
+HISTORY_SIZES = (10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6)
+# The number of tasks calling process_request in turns. The lock is never held across an await,
+# so the tasks don't contend for it: the case measures a request among interleaved tasks
+INTERLEAVED_TASKS = 16
+
+READING_TIME = '2023-07-01T11:21:30'
+
+
+class Case(NamedTuple):
+    name: str
+    # Returns a function which runs the measured code `number` times
+    setup: Callable[[], Callable[[int], None]]
+
+
+class Measurement(NamedTuple):
+    name: str
+    seconds_per_call: float
+    calls: int
+
+
+def _controller() -> Controller:
+    controller = Controller()
+    controller.reset()
+    # decisions are queued for delivery, but never sent
+    controller.window_scheduler = None
+    controller.window_coordinator = None
+    return controller
+
+
+def _process_request(tasks: int) -> Callable[[int], None]:
+    controller = _controller()
+    # readings from the future are never outdated
+    reading = SensorData(datetime=(datetime.now() + timedelta(days=1)).isoformat(timespec='seconds'), payload=50)
+    loop = asyncio.new_event_loop()
+
+    async def caller(calls: int):
+        for _ in range(calls):
+            await controller.process_request(reading)
+            if tasks > 1:
+                # hand over to the next task, like a request handler waiting for its next request
+                await asyncio.sleep(0)
+
+    async def run_callers(calls: int):
+        await asyncio.gather(*(caller(calls) for _ in range(tasks)))
+
+    def run(number: int):
+        loop.run_until_complete(run_callers(max(1, number // tasks)))
+
+    return run
+
+
+def _validate_payload() -> Callable[[int], None]:
+    validate = _controller()._validate_payload
+
+    def run(number: int):
+        for _ in range(number):
+            validate(50)
+
+    return run
+
+
+def _sensor_data_validation() -> Callable[[int], None]:
+    reading = {'datetime': READING_TIME, 'payload': 50}
+
+    def run(number: int):
+        for _ in range(number):
+            SensorData.model_validate(reading)
+
+    return run
+
+
+def _sensor_data_json_validation() -> Callable[[int], None]:
+    body = json.dumps({'datetime': READING_TIME, 'payload': 50}).encode()
+
+    def run(number: int):
+        for _ in range(number):
+            SensorData.model_validate_json(body)
+
+    return run
+
+
+def _fromisoformat() -> Callable[[int], None]:
+    def run(number: int):
+        for _ in range(number):
+            datetime.fromisoformat(READING_TIME)
+
+    return run
+
+
+def _parse_timestamp(value) -> Callable[[], Callable[[int], None]]:
+    def setup():
+        def run(number: int):
+            for _ in range(number):
+                parse_timestamp(value)
+
+        return run
+
+    return setup
+
+
+def _history(size: int) -> HistoryStore:
+    history = HistoryStore(size)
+    start = datetime(2023, 7, 1)
+    for index in range(size):
+        history.append(start + timedelta(seconds=5 * index), start + timedelta(seconds=5 * (index + 1)),
+                       'up' if index % 2 else 'down')
+    return history
+
+
+def _format_history(size: int, as_string: bool) -> Callable[[], Callable[[int], None]]:
+    def setup():
+        controller = _controller()
+        history = _history(size)
+        format_history = controller._format_history_as_string if as_string else controller._format_history
+
+        def run(number: int):
+            for _ in range(number):
+                format_history(history)
+
+        return run
+
+    return setup
+
+
+CASES: List[Case] = [
+    Case('process_request', lambda: _process_request(1)),
+    Case(f'process_request_{INTERLEAVED_TASKS}_interleaved_tasks', lambda: _process_request(INTERLEAVED_TASKS)),
+    Case('validate_payload', _validate_payload),
+    Case('sensor_data_validation', _sensor_data_validation),
+    Case('sensor_data_json_validation', _sensor_data_json_validation),
+    Case('fromisoformat', _fromisoformat),
+    Case('parse_timestamp_iso', _parse_timestamp(READING_TIME)),
+    Case('parse_timestamp_epoch_ms', _parse_timestamp(1688210490000)),
+    *(Case(f'format_history_{size}', _format_history(size, as_string=False)) for size in HISTORY_SIZES),
+    *(Case(f'format_history_as_string_{size}', _format_history(size, as_string=True)) for size in HISTORY_SIZES),
+]
+
+
+def measure(case: Case, repeats=5, min_time=0.2, max_time=10.0) -> Measurement:
+    run = case.setup()
+    # calibrate the number of calls of a run, like timeit's autorange
+    number = 1
+    while True:
+        started = time.perf_counter()
+        run(number)
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time:
+            break
+        number *= 10 if elapsed < min_time / 10 else 2
+    timings = [elapsed]
+    for _ in range(repeats - 1):
+        # slow cases, like formatting a million history entries, are repeated less
+        if sum(timings) >= max_time:
+            break
+        started = time.perf_counter()
+        run(number)
+        timings.append(time.perf_counter() - started)
+    return Measurement(case.name, min(timings) / number, number)
+
+
+def compare(measurements: List[Measurement], baselines: Dict[str, dict],
+            threshold: Optional[float] = None) -> List[dict]:
+    # The threshold given for the run overrides the ones stored with the baselines
+    comparisons = []
+    for measurement in measurements:
+        baseline = baselines.get(measurement.name)
+        comparison = {'case': measurement.name, 'seconds_per_call': measurement.seconds_per_call,
+                      'baseline': None, 'ratio': None, 'regressed': False}
+        if baseline is not None:
+            case_threshold = threshold if threshold is not None else baseline.get('threshold', DEFAULT_THRESHOLD)
+            ratio = measurement.seconds_per_call / baseline['seconds_per_call']
+            comparison.update(baseline=baseline['seconds_per_call'], ratio=ratio, threshold=case_threshold,
+                              regressed=ratio > 1 + case_threshold)
+        comparisons.append(comparison)
+    return comparisons
+
+
+def load_baselines(path: str = BASELINE_PATH) -> Dict[str, dict]:
+    if not os.path.exists(path):
+        return {}
+    with open(path) as baseline_file:
+        return json.load(baseline_file)['cases']
+
+
+def save_baselines(measurements: List[Measurement], path: str = BASELINE_PATH):
+    # Stored thresholds of the cases are kept
+    cases = load_baselines(path)
+    for measurement in measurements:
+        cases[measurement.name] = {**cases.get(measurement.name, {}),
+                                   'seconds_per_call': measurement.seconds_per_call}
+    with open(path, 'w') as baseline_file:
+        json.dump({'python': platform.python_version(), 'platform': platform.platform(), 'cases': cases},
+                  baseline_file, indent=2, sort_keys=True)
+        baseline_file.write('\n')
+
+
+def _format_seconds(seconds: Optional[float]) -> str:
+    if seconds is None:
+        return '-'
+    for unit, scale in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+        if seconds >= scale:
+            return f'{seconds / scale:.3f} {unit}'
+    return f'{seconds / 1e-9:.1f} ns'
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-k', dest='pattern', help='Run only the cases whose name contains this string.')
+    parser.add_argument('--threshold', type=float,
+                        help=f'Allowed slowdown, e.g. 0.2 for 20%% (default: per case, {DEFAULT_THRESHOLD}).')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.2, help='Minimum duration (in seconds) of a run.')
+    parser.add_argument('--max-time', type=float, default=10.0,
+                        help='Duration (in seconds) after which a case is not repeated anymore.')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='Path of the baselines.')
+    parser.add_argument('--save-baseline', action='store_true', help='Store the results as the baselines.')
+    parser.add_argument('--output', help='Path of the JSON results.')
+    args = parser.parse_args(argv)
+
+    measurements = []
+    for case in CASES:
+        if args.pattern and args.pattern not in case.name:
+            continue
+        measurements.append(measure(case, repeats=args.repeats, min_time=args.min_time, max_time=args.max_time))
+    comparisons = compare(measurements, load_baselines(args.baseline), args.threshold)
+    for comparison in comparisons:
+        ratio = '-' if comparison['ratio'] is None else f"{comparison['ratio']:.2f}x"
+        print(f"{comparison['case']:<36} {_format_seconds(comparison['seconds_per_call']):>12} "
+              f"baseline {_format_seconds(comparison['baseline']):>12} {ratio:>7}"
+              f"{'  REGRESSED' if comparison['regressed'] else ''}")
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({'benchmark': 'micro', 'python': platform.python_version(), 'results': comparisons},
+                      output, indent=2)
+    if args.save_baseline:
+        save_baselines(measurements, args.baseline)
+        print(f"Baselines written to {args.baseline}")
+        return 0
+    return 1 if any(comparison['regressed'] for comparison in comparisons) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,14 +1,37 @@
 import asyncio
+import io
+import json
+import logging
+import os
+import pstats
 import time
-from datetime import timedelta
+from datetime import datetime, timedelta
 from unittest.mock import patch
 
 import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
 
+from components.controller.functions.aggregators import MeanAggregator, MedianAggregator, EwmaAggregator
+from components.controller.functions.consumer import ReadingConsumer
 from components.controller.functions.controller_functions import Controller, get_current_time_without_microseconds
-from components.controller.schemas.response import ControllerDecision
-from invian_shared.shared_exceptions import BadPayloadException
+from components.controller.functions.dispatcher import SEQUENCE_PID_BITS, DecisionDispatcher, next_sequence_number
+from components.controller.functions.feed import DecisionFeed
+from components.controller.functions.groups import GroupState, ShardedGroups
+from components.controller.functions.history import (NO_DATA, FileHistoryStore, HistoryRenderer, HistoryStore,
+                                                     render_status)
+from components.controller.functions.scheduler import WindowScheduler
+from components.controller.functions.workers import SharedWindowState, WindowCoordinator
+from components.controller.routers.controller_router import controller_router, _sse_stream
+from components.controller.routers.metrics_router import metrics_router
+from components.controller.schemas.response import ControllerDecision, Status
+from components.sensor.functions.sensors_functions import Sensor
+from invian_shared.shared_exceptions import BadPayloadException, DeliveryRejected
 from invian_shared.shared_schemas import SensorData
+from invian_shared.utils.broker import InMemoryBroker
+from invian_shared.utils.log_config import configure_logging, parse_levels, stop_logging
+from invian_shared.utils.metrics import Histogram
+from invian_shared.utils.timestamps import to_epoch_ms
 
 
 @pytest.fixture(autouse=True)
@@ -109,10 +132,12 @@ async def test_datetime(mock_tcp_client, reset_controller):
         decision = await reset_controller.process_request(data)
         await asyncio.sleep(0.001)
 
-    # Check that the time in the controller's decision matches the current time (ignoring seconds)
+    # Check that the time in the controller's decision matches the current time, to the millisecond
     if not isinstance(decision, ControllerDecision):
         pytest.fail(f"Expected decision to be a ControllerDecision instance but got {type(decision)} instead")
-    assert decision.datetime.replace(second=0) == get_current_time_without_microseconds().replace(second=0)
+    assert abs(datetime.now() - decision.datetime) < timedelta(seconds=1)
+    assert decision.datetime.microsecond % 1000 == 0
+    assert reset_controller.default_group.last_decision_ms == to_epoch_ms(decision.datetime)
 
 
 # Test if the controller correctly ignores outdated data
@@ -125,3 +150,826 @@ async def test_ignore_outdated_data(mock_tcp_client, reset_controller):
     # The controller should ignore this data and not make a decision
     decision = await reset_controller.process_request(outdated_data)
     assert decision is None
+
+
+# Test if a batch is processed exactly like the same readings sent one by one
+@pytest.mark.asyncio
+@patch('components.controller.functions.controller_functions.tcp_client')
+async def test_process_batch_matches_single_requests(mock_tcp_client, reset_controller):
+    mock_tcp_client.return_value = None
+    payloads = [60, 70, 20, 10, 90]
+
+    def make_batch():
+        now = get_current_time_without_microseconds().isoformat()
+        return [SensorData(datetime=now, payload=payload) for payload in payloads]
+
+    reset_controller.last_decision_time -= timedelta(seconds=10)
+    single_decisions = []
+    for data in make_batch():
+        decision = await reset_controller.process_request(data)
+        if decision:
+            single_decisions.append(decision.status)
+    single_history = reset_controller.get_history()
+
+    reset_controller.reset()
+    reset_controller.last_decision_time -= timedelta(seconds=10)
+    result = await reset_controller.process_batch(make_batch())
+
+    assert result.received == len(payloads)
+    assert result.rejected == 0
+    assert [decision.status for decision in result.decisions] == single_decisions == ["up"]
+    assert reset_controller.get_history() == single_history
+
+
+# Test if bad payloads in a batch are rejected without dropping the rest of the batch
+@pytest.mark.asyncio
+@patch('components.controller.functions.controller_functions.tcp_client')
+async def test_process_batch_rejects_bad_payloads(mock_tcp_client, reset_controller):
+    mock_tcp_client.return_value = None
+    now = get_current_time_without_microseconds().isoformat()
+    batch = [SensorData(datetime=now, payload=payload) for payload in (40, 1000, -5, 30)]
+
+    reset_controller.last_decision_time -= timedelta(seconds=10)
+    result = await reset_controller.process_batch(batch)
+
+    assert result.received == 4
+    assert result.rejected == 2
+    assert [decision.status for decision in result.decisions] == ["down"]
+
+
+# Test if the batch endpoint accepts both a JSON list and an NDJSON stream
+@patch('components.controller.functions.controller_functions.tcp_client')
+def test_batch_endpoint_json_and_ndjson(mock_tcp_client, reset_controller):
+    mock_tcp_client.return_value = None
+    app = FastAPI()
+    app.include_router(controller_router, prefix='/api/v1')
+    client = TestClient(app)
+    now = get_current_time_without_microseconds().isoformat()
+    readings = [{"datetime": now, "payload": 10}, {"datetime": now, "payload": 20}]
+
+    response = client.post("/api/v1/controller/data/batch", json=readings)
+    assert response.status_code == 200
+    assert response.json()["received"] == 2
+
+    ndjson = "\n".join(json.dumps(reading) for reading in readings) + "\n"
+    response = client.post("/api/v1/controller/data/batch", content=ndjson,
+                           headers={"Content-Type": "application/x-ndjson"})
+    assert response.status_code == 200
+    assert response.json()["received"] == 2
+
+    response = client.post("/api/v1/controller/data/batch", json=[{"datetime": now}])
+    assert response.status_code == 422
+
+    # a malformed timestamp rejects the whole batch before any of its readings is applied
+    accumulated = reset_controller.aggregator.count
+    response = client.post("/api/v1/controller/data/batch",
+                           json=[{"datetime": now, "payload": 10}, {"datetime": "2023-13-01T00:00:00", "payload": 20}])
+    assert response.status_code == 422
+    assert reset_controller.aggregator.count == accumulated
+
+
+# Test if the streaming aggregates give the same values as the buffered computations
+def test_mean_aggregator():
+    aggregator = MeanAggregator()
+    payloads = [5, 1, 100, 42, 42, 7]
+    for payload in payloads:
+        aggregator.add(payload)
+
+    mean = sum(payloads) / len(payloads)
+    assert aggregator.value() == mean
+    assert aggregator.min == 1 and aggregator.max == 100
+    assert aggregator.variance() == pytest.approx(sum((p - mean) ** 2 for p in payloads) / len(payloads))
+    assert aggregator.close_window() == mean
+    assert aggregator.count == 0
+
+
+def test_median_aggregator():
+    aggregator = MedianAggregator(min_value=1, max_value=100)
+    for payload in [3, 90, 1, 50]:
+        aggregator.add(payload)
+    assert aggregator.value() == 26.5
+    aggregator.add(70)
+    assert aggregator.value() == 50
+
+
+def test_ewma_aggregator_keeps_value_between_windows():
+    aggregator = EwmaAggregator(alpha=0.5)
+    aggregator.add(10)
+    aggregator.add(20)
+    assert aggregator.close_window() == 15
+    aggregator.add(25)
+    assert aggregator.value() == 20
+
+
+# Test if a pluggable aggregator drives the decision
+@pytest.mark.asyncio
+@patch('components.controller.functions.controller_functions.tcp_client')
+async def test_decision_uses_aggregator(mock_tcp_client, reset_controller):
+    mock_tcp_client.return_value = None
+    # the mean of these payloads is below the threshold, but the median is above it
+    payloads = [1, 1, 60, 60, 60]
+    default_aggregator = reset_controller.aggregator
+    reset_controller.aggregator = MedianAggregator()
+    try:
+        now = get_current_time_without_microseconds().isoformat()
+        for payload in payloads:
+            reset_controller.aggregator.add(payload)
+        reset_controller.last_decision_time -= timedelta(seconds=10)
+
+        decision = await reset_controller.process_request(SensorData(datetime=now, payload=60))
+    finally:
+        reset_controller.aggregator = default_aggregator
+
+    assert decision.status == "up"
+
+
+# Test if every sensor group has its own window, threshold, history and manipulator
+@pytest.mark.asyncio
+@patch('components.controller.functions.controller_functions.tcp_client')
+async def test_groups_decide_independently(mock_tcp_client, reset_controller):
+    mock_tcp_client.return_value = True
+    reset_controller.configure_group("site-a", status_threshold=40, manipulator_url="http://manipulator-a:8081/")
+    reset_controller.configure_group("site-b")
+    try:
+        for group in ("site-a", "site-b"):
+            reset_controller.groups.get(group).last_decision_time -= timedelta(seconds=10)
+        now = get_current_time_without_microseconds().isoformat()
+
+        result = await reset_controller.process_batch([SensorData(datetime=now, payload=45, group="site-a"),
+                                                       SensorData(datetime=now, payload=45, group="site-b"),
+                                                       SensorData(datetime=now, payload=45, group="unknown")])
+
+        assert [decision.status for decision in result.decisions] == ["up", "down"]
+        # readings of groups which aren't configured don't create a group
+        assert result.rejected == 1
+        assert reset_controller.groups.find("unknown") is None
+        with pytest.raises(BadPayloadException):
+            await reset_controller.process_request(SensorData(datetime=now, payload=45, group="unknown"))
+        assert reset_controller.get_history(group="site-a")[0].endswith("UP]")
+        assert reset_controller.get_history(group="site-b")[0].endswith("DOWN]")
+        assert reset_controller.get_history() == []
+        assert reset_controller.get_history(group="unknown") == []
+
+        site_a = reset_controller.groups.find("site-a")
+        await reset_controller._send_decision(site_a.dispatcher.queue[-1], site_a)
+        assert mock_tcp_client.call_args.kwargs == {"url": "http://manipulator-a:8081/"}
+    finally:
+        reset_controller.group_settings.clear()
+        reset_controller.reset()
+    assert len(reset_controller.groups) == 1
+
+
+# Test if the dispatchers and links of the groups are stopped when reset() removes the groups
+@pytest.mark.asyncio
+async def test_reset_stops_group_delivery(reset_controller):
+    reset_controller.configure_group("site-a", manipulator_url="ws://127.0.0.1:9/ws")
+    reset_controller.start_delivery()
+    try:
+        site_a = reset_controller.groups.get("site-a")
+        assert site_a.dispatcher.is_running and site_a.manipulator_link._task is not None
+        dispatcher_task, link_task = site_a.dispatcher._task, site_a.manipulator_link._task
+
+        reset_controller.group_settings.clear()
+        reset_controller.reset()
+        await asyncio.sleep(0)
+
+        assert not site_a.dispatcher.is_running
+        assert dispatcher_task.cancelled() and link_task.cancelled()
+    finally:
+        await reset_controller.stop_delivery()
+
+
+# Test if groups in different shards don't share a lock
+def test_sharded_groups_locks():
+    groups = ShardedGroups(lambda group: GroupState(group, MeanAggregator(), HistoryStore(10)), shards=4)
+    names = [f"group-{index}" for index in range(64)]
+    first = names[0]
+    other = next(name for name in names if groups.shard_of(name) != groups.shard_of(first))
+
+    assert groups.lock_for(first) is not groups.lock_for(other)
+    assert groups.get(first) is groups.get(first)
+    assert groups.find(other) is None
+    assert len(groups) == 1
+
+
+# Test if a decision is handed over to the dispatcher instead of being sent while the lock is held
+@pytest.mark.asyncio
+async def test_decision_is_queued_for_dispatch(reset_controller):
+    reset_controller.last_decision_time -= timedelta(seconds=10)
+    now = get_current_time_without_microseconds().isoformat()
+
+    decision = await reset_controller.process_request(SensorData(datetime=now, payload=60))
+
+    assert reset_controller.dispatcher.metrics()["queue_depth"] == 1
+    assert reset_controller.dispatcher.queue[-1].decision == decision
+
+
+# Test if sequence numbers grow and carry the process id, so worker processes never take the same one
+def test_sequence_numbers_are_unique_per_process():
+    numbers = [next_sequence_number() for _ in range(1000)]
+    assert numbers == sorted(set(numbers))
+    mask = (1 << SEQUENCE_PID_BITS) - 1
+    assert {number & mask for number in numbers} == {os.getpid() & mask}
+    assert abs((numbers[0] >> SEQUENCE_PID_BITS) - time.time() * 1000) < 5000
+
+
+# Test if the dispatcher coalesces pending decisions and retries failed deliveries
+@pytest.mark.asyncio
+async def test_dispatcher_coalesces_and_retries():
+    delivered = []
+    attempts = []
+
+    async def send(pending):
+        attempts.append(pending.seq)
+        if len(attempts) == 1:
+            return False
+        delivered.append(pending.decision.status)
+        return True
+
+    dispatcher = DecisionDispatcher(send, retry_initial_delay=0.001)
+    now = get_current_time_without_microseconds()
+    dispatcher.submit(ControllerDecision(datetime=now, status="up"))
+    dispatcher.submit(ControllerDecision(datetime=now, status="down"))
+    dispatcher.start()
+    for _ in range(1000):
+        if delivered:
+            break
+        await asyncio.sleep(0.001)
+    await dispatcher.stop()
+
+    metrics = dispatcher.metrics()
+    assert delivered == ["down"]
+    assert metrics["coalesced"] == 1
+    assert metrics["failed_attempts"] == 1
+    assert metrics["delivered"] == 1
+    assert metrics["queue_depth"] == 0
+    assert metrics["last_delivery_lag_seconds"] is not None
+    assert metrics["p99_delivery_lag_seconds"] == metrics["max_delivery_lag_seconds"]
+
+
+# Test if a decision rejected by the manipulator is counted as rejected and isn't retried
+@pytest.mark.asyncio
+async def test_dispatcher_doesnt_retry_rejected_decisions():
+    attempts = []
+
+    async def send(pending):
+        attempts.append(pending.seq)
+        raise DeliveryRejected("invalid status")
+
+    dispatcher = DecisionDispatcher(send, retry_initial_delay=0.001)
+    dispatcher.submit(ControllerDecision(datetime=get_current_time_without_microseconds(), status="up"))
+    dispatcher.start()
+    for _ in range(1000):
+        if dispatcher.rejected:
+            break
+        await asyncio.sleep(0.001)
+    await asyncio.sleep(0.01)
+    await dispatcher.stop()
+
+    metrics = dispatcher.metrics()
+    assert len(attempts) == 1
+    assert metrics["rejected"] == 1
+    assert metrics["delivered"] == 0
+    assert metrics["failed_attempts"] == 0
+
+
+# Test if the app serves requests while the start signal waits for the broker in the background
+def test_app_starts_while_broker_is_down(reset_controller):
+    from components.controller.main import app
+
+    broker = InMemoryBroker(failed_connects=10 ** 6)
+    app.state.broker = broker
+    try:
+        with TestClient(app) as client:
+            response = client.get("/api/v1/controller/history")
+            assert response.status_code == 200
+            assert not app.state.start_signal_task.done()
+    finally:
+        app.state.broker = None
+    assert broker.queues['start_queue'] == []
+
+
+# Test if sensor groups are refused with several workers, whose windows are merged for the default group only
+def test_groups_refused_with_several_workers(monkeypatch):
+    from components.controller.main import configured_groups
+
+    monkeypatch.setenv('CONTROLLER_GROUPS', '{"site-a": {}}')
+    assert configured_groups() == {"site-a": {}}
+    monkeypatch.setenv('CONTROLLER_SHARED_STATE_PATH', '/dev/shm/invian_controller_windows')
+    with pytest.raises(RuntimeError):
+        configured_groups()
+
+
+# Test if readings published by the sensors through the broker are fed into the controller
+@pytest.mark.asyncio
+async def test_readings_consumed_from_broker(reset_controller):
+    broker = InMemoryBroker()
+    await broker.connect()
+    sensor = Sensor(messages_per_second=1000, transport='amqp', broker=broker, batch_size=5, batch_interval=60,
+                    payload_distribution='constant', payload_mean=80)
+    await sensor.generate_sensor_data(10)
+    assert len(broker.queues['sensor_readings']) == 2
+
+    reset_controller.last_decision_time -= timedelta(seconds=10)
+    consumer = ReadingConsumer(reset_controller, broker, prefetch_count=1)
+    await consumer.start()
+    await broker.publish('sensor_readings', b'{"not": "a batch"}')
+    await broker.join()
+
+    assert broker.acked == 3
+    assert reset_controller.previous_status == "up"
+    assert len(reset_controller.history) == 1
+
+
+# Test if publishing and consuming resume after the broker connection is dropped and restored
+@pytest.mark.asyncio
+async def test_readings_flow_after_broker_reconnects(reset_controller):
+    broker = InMemoryBroker()
+    await broker.connect()
+    reset_controller.window_scheduler = object()
+    try:
+        consumer = ReadingConsumer(reset_controller, broker)
+        await consumer.start()
+        sensor = Sensor(messages_per_second=1000, transport='amqp', broker=broker, payload_distribution='constant',
+                        payload_mean=80, timestamp_format='epoch_ms', reconnect_backoff=0.01)
+        await sensor.generate_sensor_data(2)
+        await broker.join()
+        assert broker.acked == 2
+
+        broker.drop_connection()
+        publishing = asyncio.ensure_future(sensor.generate_sensor_data(3))
+        await asyncio.sleep(0.05)
+        # the sensor keeps its reading and tries to reconnect while the broker is down
+        assert not publishing.done()
+        connect_attempts = broker.connect_attempts
+        broker.restore_connection()
+        await asyncio.wait_for(publishing, 5)
+        await broker.join()
+
+        assert broker.connect_attempts > connect_attempts
+        assert broker.acked == 5
+        assert reset_controller.aggregator.count == 5
+    finally:
+        reset_controller.window_scheduler = None
+
+
+# Test if the history store keeps only the latest entries and answers time-range queries
+def test_history_store_retention_and_query():
+    store = HistoryStore(retention=4)
+    base = datetime(2023, 7, 1, 12, 0, 0)
+    for index in range(6):
+        store.append(base + timedelta(seconds=5 * index), base + timedelta(seconds=5 * index + 5),
+                     "up" if index % 2 else "down")
+
+    assert len(store) == 4
+    assert store.evicted == 2
+    assert store[0].start == base + timedelta(seconds=10)
+    assert store[-1].status == store.last_status() == "up"
+
+    store.update_last_end(base + timedelta(seconds=40))
+    assert store[-1].end == base + timedelta(seconds=40)
+
+    window = store.query(start=base + timedelta(seconds=17), end=base + timedelta(seconds=25))
+    assert [entry.start for entry in window] == [base + timedelta(seconds=15), base + timedelta(seconds=20),
+                                                 base + timedelta(seconds=25)]
+    assert len(store.query(start=base + timedelta(seconds=17), limit=2)) == 2
+    assert store.query(end=base) == []
+
+
+# Test the history endpoint time-range query parameters
+def test_history_endpoint_query(reset_controller):
+    base = datetime(2023, 7, 1, 12, 0, 0)
+    reset_controller.history.append(base, base + timedelta(seconds=5), "down")
+    reset_controller.history.append(base + timedelta(seconds=5), base + timedelta(seconds=10), "up")
+    app = FastAPI()
+    app.include_router(controller_router, prefix='/api/v1')
+    client = TestClient(app)
+
+    response = client.get("/api/v1/controller/history", params={"start": "2023-07-01T12:00:06"})
+    assert response.json() == ["[12:00:05 - 12:00:10 UP]"]
+    response = client.get("/api/v1/controller/history_string", params={"limit": 1})
+    assert response.json() == "[12:00:00 - 12:00:05 DOWN]"
+    assert client.get("/api/v1/controller/history", params={"limit": 0}).status_code == 422
+
+
+# Test if the persistent history is synced in the background, survives reopening and drops a torn record
+def test_file_history_store_recovery(tmp_path):
+    path = str(tmp_path / "history.bin")
+    base = datetime(2023, 7, 1, 12, 0, 0)
+    store = FileHistoryStore(path, fsync_every=2)
+    store.append(base, base + timedelta(seconds=5), "down")
+    store.append(base + timedelta(seconds=5), base + timedelta(seconds=10), "up")
+    store.update_last_end(base + timedelta(seconds=15))
+    # the writes are synced by the background thread, not by the writer
+    deadline = time.monotonic() + 5
+    while store._synced_writes != 3 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert store._synced_writes == 3
+    store.close()
+    # simulate a crash in the middle of writing the next record
+    with open(path, "ab") as history_file:
+        history_file.write(b"\x01\x02\x03")
+
+    reopened = FileHistoryStore(path)
+    try:
+        assert len(reopened) == 2
+        assert reopened[-1] == Status(start=base + timedelta(seconds=5), end=base + timedelta(seconds=15),
+                                      status="up")
+        assert [entry.status for entry in reopened.query(start=base + timedelta(seconds=12))] == ["up"]
+        reopened.append(base + timedelta(seconds=15), base + timedelta(seconds=20), "down")
+        assert reopened.last_status() == "down"
+        reopened.clear()
+        assert len(reopened) == 0
+    finally:
+        reopened.close()
+
+
+# Test if a restarted controller serves the persisted history and starts a new entry after the downtime
+@pytest.mark.asyncio
+async def test_controller_restores_persistent_history(tmp_path, reset_controller):
+    path = str(tmp_path / "history.bin")
+    base = datetime(2023, 7, 1, 12, 0, 0)
+    previous = FileHistoryStore(path)
+    previous.append(base, base + timedelta(seconds=5), "up")
+    previous.close()
+
+    default_history = reset_controller.history
+    reset_controller.history_path = path
+    reset_controller.history = reset_controller._create_history_store()
+    try:
+        assert reset_controller.get_history() == ["[12:00:00 - 12:00:05 UP]"]
+        reset_controller.last_decision_time -= timedelta(seconds=10)
+        now = get_current_time_without_microseconds().isoformat()
+        await reset_controller.process_request(SensorData(datetime=now, payload=60))
+        assert len(reset_controller.history) == 2
+    finally:
+        reset_controller.history.close()
+        reset_controller.history_path = None
+        reset_controller.history = default_history
+
+
+# Test if a group restarted over a persistent history carries on from its last decision
+def test_group_state_restored_from_persistent_history(tmp_path):
+    path = str(tmp_path / "history.bin")
+    base = datetime(2023, 7, 1, 12, 0, 0)
+    previous = FileHistoryStore(path)
+    previous.append(base, base + timedelta(seconds=5), "up")
+    previous.append(base + timedelta(seconds=5), base + timedelta(seconds=15), NO_DATA)
+    previous.close()
+
+    history = FileHistoryStore(path)
+    try:
+        state = GroupState(None, MeanAggregator(), history)
+        assert state.last_decision_time == base + timedelta(seconds=15)
+        assert state.last_decision_ms == to_epoch_ms(base + timedelta(seconds=15))
+        assert state.previous_status == "up"
+        history.clear()
+        state.reset()
+        assert state.previous_status is None
+        assert state.last_decision_time > base
+    finally:
+        history.close()
+
+
+# Test if the partial aggregates of the workers are merged and exactly one worker decides a window
+@pytest.mark.asyncio
+async def test_workers_merge_windows_and_decide_once(tmp_path, reset_controller):
+    path = str(tmp_path / "windows")
+    state = SharedWindowState.create(path)
+    other_worker = SharedWindowState(path)
+    moment = time.time()
+    coordinator = WindowCoordinator(reset_controller, state, clock=lambda: moment)
+    window = coordinator.window_at(moment)
+    reset_controller.window_coordinator = coordinator
+    try:
+        reading_time = (reset_controller.last_decision_time + timedelta(seconds=1)).isoformat()
+        for _ in range(3):
+            assert await reset_controller.process_request(SensorData(datetime=reading_time, payload=40)) is None
+        assert other_worker.add_partial(window, 2, 200)
+
+        decision = await coordinator.close_window(window)
+
+        # (3 * 40 + 200) / 5 = 64
+        assert decision.status == "up"
+        assert len(reset_controller.history) == 1
+        assert other_worker.claim(window) is None
+        assert not other_worker.add_partial(window, 1, 50)
+        assert other_worker.last_decision() == ("up", decision.datetime)
+
+        # an empty window holds the last status over it, as with a single worker
+        assert await coordinator.close_window(window + 1) is None
+        window_end = datetime.fromtimestamp((window + 2) * reset_controller.decision_interval_seconds)
+        assert len(reset_controller.history) == 1
+        assert reset_controller.history[-1].end == window_end
+        assert other_worker.last_decision() == ("up", window_end)
+        coordinator.empty_windows = 'no_data'
+        assert await coordinator.close_window(window + 2) is None
+        assert reset_controller.history.last_status() == NO_DATA
+    finally:
+        reset_controller.window_coordinator = None
+        state.close()
+        other_worker.close()
+
+
+# Test if the scheduler closes the windows and readings are only accumulated while it is set
+@pytest.mark.asyncio
+@pytest.mark.parametrize("empty_windows, expected_history", [
+    ("hold", ["UP]"]),
+    ("no_data", ["UP]", "NO DATA]"]),
+])
+async def test_scheduler_closes_windows(reset_controller, empty_windows, expected_history):
+    scheduler = WindowScheduler(reset_controller, empty_windows=empty_windows)
+    reset_controller.window_scheduler = scheduler
+    try:
+        reset_controller.last_decision_time -= timedelta(seconds=10)
+        now = get_current_time_without_microseconds().isoformat()
+        assert await reset_controller.process_request(SensorData(datetime=now, payload=60)) is None
+        assert reset_controller.aggregator.count == 1
+
+        decisions = await scheduler.close_windows()
+        # the next window gets no readings
+        assert await scheduler.close_windows() == []
+    finally:
+        reset_controller.window_scheduler = None
+
+    assert [decision.status for decision in decisions] == ["up"]
+    history = reset_controller.get_history()
+    assert [entry[-len(suffix):] for entry, suffix in zip(history, expected_history)] == expected_history
+    assert len(history) == len(expected_history)
+    assert scheduler.closed == 2
+
+
+# Test if the scheduler keeps to the window boundaries of its clock and skips the ones it missed
+@pytest.mark.asyncio
+async def test_scheduler_keeps_boundaries(reset_controller):
+    now = [100.0]
+    sleeps = []
+
+    async def sleep(seconds):
+        if len(sleeps) == 3:
+            raise asyncio.CancelledError
+        sleeps.append(seconds)
+        # every wake-up is late, and the second one is late by more than a window
+        now[0] += seconds + (12.0 if len(sleeps) == 2 else 0.3)
+
+    scheduler = WindowScheduler(reset_controller, clock=lambda: now[0], sleep=sleep)
+    with pytest.raises(asyncio.CancelledError):
+        await scheduler._run()
+
+    assert sleeps == [5.0, pytest.approx(4.7), pytest.approx(3.0)]
+    assert scheduler.missed == 2
+    assert scheduler.closed == 3
+
+
+# Test if the incrementally rendered history always matches a full rendering
+def test_history_renderer_matches_full_rendering():
+    store = HistoryStore(retention=3)
+    renderer = HistoryRenderer(store)
+    base = datetime(2023, 7, 1, 12, 0, 0)
+    versions = {renderer.version()}
+
+    def full_rendering():
+        return [render_status(entry) for entry in store]
+
+    for index in range(5):
+        store.append(base + timedelta(seconds=5 * index), base + timedelta(seconds=5 * index + 5),
+                     "up" if index % 2 else "down")
+        assert renderer.as_list() == full_rendering()
+        store.update_last_end(base + timedelta(seconds=5 * index + 7))
+        assert renderer.as_string() == ', '.join(full_rendering())
+        versions.add(renderer.version())
+    # the tail moves and a new entry is added between two renderings
+    store.update_last_end(base + timedelta(seconds=40))
+    store.append(base + timedelta(seconds=40), base + timedelta(seconds=45), "down")
+    assert renderer.as_list() == full_rendering()
+    assert json.loads(renderer.as_json()) == full_rendering()
+    store.clear()
+    assert renderer.as_list() == []
+    assert len(versions | {renderer.version()}) == 7
+
+
+# Test if a file-backed history is rendered in chunks without keeping its segments
+def test_history_renderer_doesnt_keep_file_history(tmp_path):
+    store = FileHistoryStore(str(tmp_path / "history.bin"))
+    renderer = HistoryRenderer(store)
+    renderer.CHUNK_ENTRIES = 2
+    base = datetime(2023, 7, 1, 12, 0, 0)
+    versions = {renderer.version()}
+    try:
+        for index in range(5):
+            store.append(base + timedelta(seconds=5 * index), base + timedelta(seconds=5 * index + 5),
+                         "up" if index % 2 else "down")
+            versions.add(renderer.version())
+        store.update_last_end(base + timedelta(seconds=27))
+        versions.add(renderer.version())
+        full_rendering = [render_status(entry) for entry in store]
+
+        assert not renderer.cached
+        assert renderer.as_list() == full_rendering
+        assert json.loads(renderer.as_json()) == full_rendering
+        assert json.loads(b''.join(renderer.iter_json(as_string=True))) == ', '.join(full_rendering)
+        assert not renderer._segments and not renderer._cache
+        assert len(versions) == 7
+    finally:
+        store.close()
+
+
+# Test if an unchanged history is answered with 304 Not Modified
+def test_history_endpoint_etag(reset_controller):
+    base = datetime(2023, 7, 1, 12, 0, 0)
+    reset_controller.history.append(base, base + timedelta(seconds=5), "down")
+    app = FastAPI()
+    app.include_router(controller_router, prefix='/api/v1')
+    client = TestClient(app)
+
+    response = client.get("/api/v1/controller/history")
+    etag = response.headers["ETag"]
+    assert response.json() == ["[12:00:00 - 12:00:05 DOWN]"]
+    assert client.get("/api/v1/controller/history", headers={"If-None-Match": etag}).status_code == 304
+
+    reset_controller.history.update_last_end(base + timedelta(seconds=10))
+    response = client.get("/api/v1/controller/history_string", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.json() == "[12:00:00 - 12:00:10 DOWN]"
+    assert response.headers["ETag"] != etag
+
+
+# Test if the feed replays missed events on resume and drops slow subscribers
+@pytest.mark.asyncio
+async def test_decision_feed_resume_and_slow_subscriber():
+    feed = DecisionFeed(backlog_size=10, subscriber_buffer=2)
+    slow = feed.subscribe()
+    first = feed.publish("decision", {"status": "up"})
+    feed.publish("decision", {"status": "down"})
+    feed.publish("decision", {"status": "up"})
+
+    assert slow not in feed.subscribers
+    assert feed.dropped == 1
+    # the dropped subscriber still gets its buffered events, then its iteration ends
+    assert [event.seq async for event in slow] == [first, first + 1]
+
+    resumed = feed.subscribe(last_seq=first)
+    assert [(await resumed.get()).seq, (await resumed.get()).seq] == [first + 1, first + 2]
+    assert await resumed.get(timeout=0.01) is None
+    feed.unsubscribe(resumed)
+    assert not feed.subscribers
+    # the feed of a restarted controller continues after the sequence numbers of the previous one
+    assert DecisionFeed().publish("decision", {"status": "down"}) > first + 2
+
+
+# Test if decisions and history updates are pushed as Server-Sent Events
+@pytest.mark.asyncio
+async def test_decisions_are_streamed(reset_controller):
+    feed = reset_controller.feed
+    subscription = feed.subscribe()
+    stream = _sse_stream(feed, subscription)
+    reset_controller.last_decision_time -= timedelta(seconds=10)
+    now = get_current_time_without_microseconds().isoformat()
+
+    await reset_controller.process_request(SensorData(datetime=now, payload=60))
+
+    decision_event = await stream.__anext__()
+    history_event = await stream.__anext__()
+    await stream.aclose()
+    assert b"event: decision\n" in decision_event
+    assert b'"status": "up"' in decision_event
+    assert b"event: history\n" in history_event
+    assert b'"segment": "[' in history_event
+    assert subscription not in feed.subscribers
+
+
+# Test that records are written by the queue listener with the levels of their components
+def test_logging_queue_and_component_levels():
+    root = logging.getLogger()
+    root_level = root.level
+    stream = io.StringIO()
+    configure_logging('INFO', parse_levels('test_component.quiet=warning, test_component.verbose=DEBUG'),
+                      json_format=True, stream=stream)
+    try:
+        logging.getLogger('test_component.quiet').info('dropped %s', 1)
+        logging.getLogger('test_component.quiet').warning('kept %s', 2)
+        logging.getLogger('test_component.verbose').debug('kept %s', 3)
+        logging.getLogger('test_component.other').debug('dropped %s', 4)
+    finally:
+        stop_logging()
+        root.setLevel(root_level)
+        for name in ('test_component.quiet', 'test_component.verbose'):
+            logging.getLogger(name).setLevel(logging.NOTSET)
+    entries = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert [(entry['logger'], entry['level'], entry['message']) for entry in entries] == [
+        ('test_component.quiet', 'WARNING', 'kept 2'),
+        ('test_component.verbose', 'DEBUG', 'kept 3'),
+    ]
+    with pytest.raises(ValueError):
+        parse_levels('test_component')
+
+
+# Test if histograms render cumulative buckets with inclusive upper bounds
+def test_histogram_buckets():
+    histogram = Histogram('test_seconds', 'Test.', buckets=(0.1, 1.0), labelnames=('kind',))
+    child = histogram.labels('a')
+    for value in (0.05, 0.1, 0.5, 3.0):
+        child.observe(value)
+    assert list(histogram.samples()) == [
+        'test_seconds_bucket{kind="a",le="0.1"} 2',
+        'test_seconds_bucket{kind="a",le="1.0"} 3',
+        'test_seconds_bucket{kind="a",le="+Inf"} 4',
+        'test_seconds_sum{kind="a"} 3.65',
+        'test_seconds_count{kind="a"} 4',
+    ]
+
+
+# Test if readings, windows, decisions and deliveries are counted and served at /metrics
+@pytest.mark.asyncio
+@patch('components.controller.functions.controller_functions.tcp_client')
+async def test_metrics_endpoint(mock_tcp_client, reset_controller):
+    mock_tcp_client.return_value = False
+    now = get_current_time_without_microseconds()
+    reset_controller.last_decision_time = now - timedelta(seconds=10)
+    reading = now.isoformat()
+    decision = await reset_controller.process_request(SensorData(datetime=reading, payload=70))
+    assert decision.status == "up"
+    # the reading is as old as the decision
+    assert await reset_controller.process_request(SensorData(datetime=reading, payload=70)) is None
+    with pytest.raises(BadPayloadException):
+        await reset_controller.process_request(SensorData(datetime=reading, payload=1000))
+    assert await reset_controller._send_decision(reset_controller.dispatcher.queue[-1]) is False
+
+    app = FastAPI()
+    app.include_router(metrics_router)
+    response = TestClient(app).get("/metrics")
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    lines = response.text.splitlines()
+    for line in ('controller_readings_total{result="accepted"} 1',
+                 'controller_readings_total{result="bad_payload"} 1',
+                 'controller_readings_total{result="outdated"} 1',
+                 'controller_window_readings_bucket{le="1"} 1',
+                 'controller_window_average_sum 70.0',
+                 'controller_lock_wait_seconds_count 3',
+                 'controller_decisions_total{status="up"} 1',
+                 'controller_decisions_total{status="down"} 0',
+                 'controller_manipulator_send_seconds_count{transport="http"} 1',
+                 'controller_manipulator_send_failures_total{transport="http"} 1',
+                 'controller_history_entries{group=""} 1',
+                 'controller_dispatcher_queue_depth{group=""} 1'):
+        assert line in lines
+
+
+# Test if sampled spans are timed only while enabled and profiles are captured in both formats
+def test_profiling_spans_and_captures(reset_controller, tmp_path):
+    app = FastAPI()
+    app.include_router(controller_router, prefix='/api/v1')
+    client = TestClient(app)
+    reading = {"datetime": get_current_time_without_microseconds().isoformat(), "payload": 50}
+
+    client.post("/api/v1/controller/data", json=reading)
+    assert not list(reset_controller.metrics.spans.samples())
+    status = client.put("/api/v1/controller/profiling", params={"enabled": True, "sample_every": 2}).json()
+    assert status == {"enabled": True, "sample_every": 2, "capturing": False}
+    for _ in range(4):
+        client.post("/api/v1/controller/data", json=reading)
+    samples = list(reset_controller.metrics.spans.samples())
+    assert 'controller_span_seconds_count{span="recieve_request"} 2' in samples
+    assert 'controller_span_seconds_count{span="process_request"} 2' in samples
+    assert client.put("/api/v1/controller/profiling", params={"enabled": False}).json()["enabled"] is False
+
+    response = client.post("/api/v1/controller/profiling/capture", params={"seconds": 0.05})
+    assert response.headers["content-disposition"] == 'attachment; filename="controller.pstats"'
+    (tmp_path / "controller.pstats").write_bytes(response.content)
+    pstats.Stats(str(tmp_path / "controller.pstats"))
+    response = client.post("/api/v1/controller/profiling/capture", params={"seconds": 0.1, "mode": "sample"})
+    lines = response.text.splitlines()
+    assert lines and all(line.rsplit(" ", 1)[1].isdigit() for line in lines)
+    assert client.post("/api/v1/controller/profiling/capture", params={"mode": "perf"}).status_code == 422
+
+
+# Test if epoch millisecond and ISO timestamps are compared with the last decision in milliseconds
+@pytest.mark.asyncio
+async def test_epoch_ms_timestamps(reset_controller):
+    decision_time = datetime(2023, 7, 1, 12, 0, 5)
+    reset_controller.last_decision_time = decision_time
+    decision_ms = round(decision_time.timestamp() * 1000)
+    assert reset_controller.default_group.last_decision_ms == decision_ms
+
+    reset_controller.window_scheduler = object()
+    try:
+        for timestamp, epoch_ms in ((decision_ms, decision_ms), (decision_ms + 1, decision_ms + 1),
+                                    ("2023-07-01T12:00:05", decision_ms), ("2023-07-01T12:00:06", decision_ms + 1000)):
+            data = SensorData(datetime=timestamp, payload=50)
+            # timestamps are normalized to epoch milliseconds when the reading is validated
+            assert data.datetime == data.epoch_ms() == epoch_ms
+            await reset_controller.process_request(data)
+    finally:
+        reset_controller.window_scheduler = None
+    assert reset_controller.aggregator.count == 2
+    samples = list(reset_controller.metrics.registry.render().splitlines())
+    assert 'controller_readings_total{result="outdated"} 2' in samples
+    assert SensorData.model_validate_json('{"datetime": 1688205605000, "payload": 5}').datetime == 1688205605000
+
+    # malformed timestamps and booleans are rejected by the validation of the request
+    app = FastAPI()
+    app.include_router(controller_router, prefix='/api/v1')
+    client = TestClient(app)
+    for timestamp in ("1688205605000", "2023-07-01T25:00:00", "yesterday", True, 1.5):
+        response = client.post("/api/v1/controller/data", json={"datetime": timestamp, "payload": 50})
+        assert response.status_code == 422, timestamp
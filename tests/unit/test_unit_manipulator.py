@@ -1,8 +1,13 @@
+import logging
+from datetime import datetime
 from unittest.mock import AsyncMock
 
 import pytest
+from aiohttp.test_utils import TestClient, TestServer
 
 from components.manipulator.functions.manipulator_functions import Manipulator
+from invian_shared.utils.log_sampling import LogSampler
+from invian_shared.utils.wire import DECISION_FRAMES_CONTENT_TYPE, encode_decision
 
 
 @pytest.mark.asyncio
@@ -38,4 +43,97 @@ async def test_manipulator_handle_request_no_status():
     response = await manipulator.handle_request(request)
 
     assert manipulator.get_status() == ""
-    assert response.status == 400
\ No newline at end of file
+    assert response.status == 400
+
+@pytest.mark.asyncio
+async def test_manipulator_handle_binary_frame():
+    manipulator = Manipulator()
+    request = AsyncMock()
+    request.content_type = DECISION_FRAMES_CONTENT_TYPE
+    request.read.return_value = encode_decision("down", datetime.now(), seq=1)
+
+    response = await manipulator.handle_request(request)
+
+    assert manipulator.get_status() == "down"
+    assert response.status == 200
+
+
+@pytest.mark.asyncio
+async def test_manipulator_batch_endpoint():
+    manipulator = Manipulator()
+    async with TestClient(TestServer(manipulator.create_app())) as client:
+        now = datetime.now()
+        frames = b''.join(encode_decision(status, now, seq) for seq, status in enumerate(("up", "down", "up"), 1))
+        response = await client.post('/batch', data=frames, headers={'Content-Type': DECISION_FRAMES_CONTENT_TYPE})
+        assert await response.json() == {"applied": 3, "rejected": 0}
+        assert manipulator.get_status() == "up"
+
+        response = await client.post('/batch', json=[{"status": "down"}, {"status": "sideways"}, {}])
+        assert await response.json() == {"applied": 1, "rejected": 2}
+        assert manipulator.get_status() == "down"
+
+        response = await client.post('/batch', data=frames[:-1],
+                                     headers={'Content-Type': DECISION_FRAMES_CONTENT_TYPE})
+        assert response.status == 400
+
+
+def test_log_sampler_rate_limits_and_counts_suppressed(caplog):
+    now = [0.0]
+    sampler = LogSampler(rate=2, interval=1.0, clock=lambda: now[0])
+    logger = logging.getLogger('test_log_sampler')
+    logger.setLevel(logging.INFO)
+
+    with caplog.at_level(logging.INFO, logger='test_log_sampler'):
+        emitted = [sampler.log(logger, logging.INFO, "update %d", index) for index in range(5)]
+        now[0] = 1.5
+        sampler.log(logger, logging.INFO, "update %d", 5)
+
+    assert emitted == [True, True, False, False, False]
+    assert [record.getMessage() for record in caplog.records] == [
+        "update 0", "update 1", "update 5 (3 similar messages suppressed)"]
+    assert not sampler.log(logger, logging.DEBUG, "ignored")
+
+
+@pytest.mark.asyncio
+async def test_manipulator_deduplicates_and_reports_state():
+    manipulator = Manipulator()
+    async with TestClient(TestServer(manipulator.create_app())) as client:
+        await client.post('/', json={"seq": 1, "status": "up"})
+        await client.post('/', json={"seq": 2, "status": "down"})
+        # a retried delivery of an applied decision isn't applied again
+        await client.post('/', json={"seq": 1, "status": "up"})
+        await client.post('/', json={"seq": 3, "status": "down"})
+
+        status = await (await client.get('/status')).json()
+        assert status["status"] == "down"
+        assert status["seq"] == 3
+        assert status["since"] is not None
+
+        transitions = await (await client.get('/transitions')).json()
+        assert [(item["previous"], item["status"], item["seq"]) for item in transitions] == [
+            (None, "up", 1), ("up", "down", 2)]
+        assert len(await (await client.get('/transitions', params={"limit": 1})).json()) == 1
+
+        assert await (await client.get('/counters')).json() == {
+            "received": 4, "applied": 3, "duplicates": 1, "rejected": 0, "transitions": 2}
+
+
+@pytest.mark.asyncio
+async def test_manipulator_websocket_malformed_messages():
+    manipulator = Manipulator()
+    async with TestClient(TestServer(manipulator.create_app())) as client:
+        ws = await client.ws_connect(manipulator.WS_ENDPOINT)
+        await ws.send_bytes(encode_decision("up", datetime.now(), seq=1))
+        assert await ws.receive_json() == {"ack": 1}
+        # a message whose sequence number can be read is acknowledged with an error, so it isn't sent again
+        invalid_code = bytearray(encode_decision("down", datetime.now(), seq=2))
+        invalid_code[0] = 9
+        await ws.send_bytes(bytes(invalid_code))
+        ack = await ws.receive_json()
+        assert ack["ack"] == 2 and "Invalid status code" in ack["error"]
+        assert manipulator.get_status() == "up"
+        # otherwise the connection is closed, and the controller sends the message again after reconnecting
+        await ws.send_str("not json")
+        await ws.receive()
+        assert ws.closed
+        assert manipulator.counters["rejected"] == 1
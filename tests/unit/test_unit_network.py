@@ -0,0 +1,128 @@
+import json
+import socket
+from datetime import datetime
+from unittest.mock import AsyncMock, MagicMock
+
+import httpx
+import pytest
+from aiohttp.test_utils import TestServer
+
+from components.manipulator.functions.manipulator_functions import Manipulator
+from invian_shared.shared_exceptions import DeliveryRejected
+from invian_shared.utils.broker import InMemoryBroker, publish_with_retry
+from invian_shared.utils.network import SharedHttpClient, WebSocketLink, shared_http_client, tcp_client
+from invian_shared.utils.wire import encode_decision
+
+
+@pytest.mark.asyncio
+async def test_shared_http_client_lifecycle():
+    client = SharedHttpClient(max_connections=4, max_keepalive_connections=2, timeout=1.0)
+
+    pooled = await client.start()
+
+    assert client.is_started
+    assert await client.start() is pooled
+    with pytest.raises(RuntimeError):
+        client.configure(timeout=2.0)
+    await client.close()
+    assert not client.is_started
+    with pytest.raises(RuntimeError):
+        client.client
+
+
+def test_shared_http_client_rejects_unknown_settings():
+    with pytest.raises(AttributeError):
+        SharedHttpClient().configure(pool_size=10)
+
+
+@pytest.mark.asyncio
+async def test_tcp_client_reuses_given_client():
+    client = MagicMock()
+    client.post = AsyncMock(return_value=httpx.Response(200))
+
+    assert await tcp_client('{"status": "up"}', client=client)
+    assert await tcp_client('{"status": "down"}', client=client)
+
+    assert client.post.call_count == 2
+    # a full URL is posted to as it is, with its scheme, port and path
+    assert await tcp_client('{"status": "up"}', client=client, url='https://manip-b.example/api/decisions')
+    assert client.post.call_args.args == ('https://manip-b.example/api/decisions',)
+
+
+@pytest.mark.asyncio
+async def test_tcp_client_uses_started_shared_client(mocker):
+    post = mocker.patch.object(httpx.AsyncClient, "post", return_value=httpx.Response(503))
+    await shared_http_client.start()
+    try:
+        delivered = await tcp_client('{"status": "up"}')
+    finally:
+        await shared_http_client.close()
+
+    assert not delivered
+    post.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_tcp_client_connect_error():
+    client = MagicMock()
+    client.post = AsyncMock(side_effect=httpx.ConnectError('Error'))
+
+    assert not await tcp_client('{"status": "up"}', client=client)
+
+
+@pytest.mark.asyncio
+async def test_publish_with_retry_waits_for_broker():
+    broker = InMemoryBroker(failed_connects=2)
+
+    await publish_with_retry(broker, 'start_queue', b'start', initial_backoff=0.001)
+
+    assert broker.connect_attempts == 3
+    assert broker.queues['start_queue'] == [b'start']
+    assert not broker.connected
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@pytest.mark.asyncio
+async def test_websocket_link_acks_and_resends_after_reconnect():
+    port = _free_port()
+    manipulator = Manipulator()
+    link = WebSocketLink(f'ws://127.0.0.1:{port}/ws', ack_timeout=0.05, reconnect_initial_delay=0.01,
+                         reconnect_max_delay=0.05)
+    link.start()
+    server = None
+    try:
+        # the manipulator is down, the decision stays unacknowledged
+        assert not await link.send(1, encode_decision("up", datetime.now(), seq=1))
+        assert link.unacked == 1
+
+        server = TestServer(manipulator.create_app(), host='127.0.0.1', port=port)
+        await server.start_server()
+        link.ack_timeout = 1.0
+        # sending the same sequence number again waits for the resent decision
+        assert await link.send(1, encode_decision("up", datetime.now(), seq=1))
+        assert manipulator.get_status() == "up"
+        assert link.resent == 1
+
+        # an acknowledgement over the open connection
+        assert await link.send(2, encode_decision("down", datetime.now(), seq=2))
+        assert manipulator.get_status() == "down"
+        # a rejected decision is acknowledged and not sent again, and its sender learns it was rejected
+        with pytest.raises(DeliveryRejected):
+            await link.send(3, json.dumps({"seq": 3, "status": "sideways"}))
+        # a rejected frame too
+        invalid_code = bytearray(encode_decision("up", datetime.now(), seq=4))
+        invalid_code[0] = 9
+        with pytest.raises(DeliveryRejected):
+            await link.send(4, bytes(invalid_code))
+        assert manipulator.get_status() == "down"
+        assert link.unacked == 0
+        assert link.connects == 1
+    finally:
+        await link.close()
+        if server is not None:
+            await server.close()
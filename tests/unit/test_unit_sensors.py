@@ -1,3 +1,4 @@
+import asyncio
 import logging
 import time
 from unittest.mock import patch, MagicMock, Mock
@@ -6,7 +7,8 @@ import httpx
 import pytest
 from httpx import Response
 
-from components.sensor.functions.sensors_functions import Sensor
+from components.sensor.functions.fleet import FleetConfig, run_sensors, split_sensors
+from components.sensor.functions.sensors_functions import Sensor, RateScheduler
 
 logger = logging.getLogger(__name__)
 
@@ -73,3 +75,168 @@ async def test_connection_error_handling(mock_client, sensor):
     end_time = time.time()
     assert end_time - start_time >= 5
     assert mock_client.return_value.__aenter__.return_value.post.call_count
+
+
+@pytest.mark.asyncio
+@patch('httpx.AsyncClient')
+async def test_client_is_reused(mock_client, sensor):
+    mock_response = MagicMock()
+    mock_response.status_code = 200
+    mock_client.return_value.__aenter__.return_value.post.return_value = mock_response
+    await sensor.generate_sensor_data(10)
+    assert mock_client.call_count == 1
+    assert mock_client.return_value.__aenter__.return_value.post.call_count == 10
+
+
+@pytest.mark.asyncio
+@patch('httpx.AsyncClient')
+async def test_pipelined_requests(mock_client):
+    sensor = Sensor(max_in_flight=4)
+    in_flight = [0, 0]
+
+    async def slow_post(*args, **kwargs):
+        in_flight[0] += 1
+        in_flight[1] = max(in_flight[1], in_flight[0])
+        await asyncio.sleep(0.05)
+        in_flight[0] -= 1
+        return Response(200)
+
+    mock_client.return_value.__aenter__.return_value.post.side_effect = slow_post
+    await sensor.generate_sensor_data(12)
+    assert mock_client.return_value.__aenter__.return_value.post.call_count == 12
+    assert 1 < in_flight[1] <= 4
+    assert in_flight[0] == 0
+
+
+@pytest.mark.asyncio
+@patch('httpx.AsyncClient')
+async def test_batched_requests(mock_client):
+    sensor = Sensor(batch_size=3, batch_interval=60)
+    mock_client.return_value.__aenter__.return_value.post.return_value = Response(200)
+    await sensor.generate_sensor_data(7)
+    calls = mock_client.return_value.__aenter__.return_value.post.call_args_list
+    assert [len(call.kwargs['json']) for call in calls] == [3, 3, 1]
+    assert all(call.args[0] == sensor.controller_batch_endpoint for call in calls)
+    assert sensor.controller_batch_endpoint == "http://controller:8000/api/v1/controller/data/batch"
+
+
+@pytest.mark.asyncio
+@patch('httpx.AsyncClient')
+async def test_latencies_and_acknowledged_readings(mock_client):
+    sensor = Sensor(batch_size=2, batch_interval=60, latency_samples=2)
+    mock_client.return_value.__aenter__.return_value.post.return_value = Response(200)
+    await sensor.generate_sensor_data(5)
+    assert sensor.acknowledged == 5
+    # only the latest samples are kept
+    assert len(sensor.latencies) == 2
+    assert all(latency >= 0 for latency in sensor.latencies)
+    assert Sensor().latencies is None
+
+
+@pytest.mark.asyncio
+@patch('httpx.AsyncClient')
+async def test_epoch_ms_timestamps(mock_client):
+    sensor = Sensor(timestamp_format='epoch_ms')
+    mock_client.return_value.__aenter__.return_value.post.return_value = Response(200)
+    await sensor.generate_sensor_data(3)
+    timestamps = [call.kwargs['json']['datetime'] for call in
+                  mock_client.return_value.__aenter__.return_value.post.call_args_list]
+    assert all(isinstance(timestamp, int) for timestamp in timestamps)
+    assert timestamps == sorted(timestamps)
+    assert abs(timestamps[-1] - time.time() * 1000) < 5000
+    with pytest.raises(ValueError):
+        Sensor(timestamp_format='unix')
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    async def sleep(self, delay):
+        self.now += delay
+
+
+@pytest.mark.asyncio
+async def test_rate_scheduler_keeps_absolute_timeline():
+    clock = FakeClock()
+    scheduler = RateScheduler(100, clock=clock, sleep=clock.sleep)
+    for _ in range(10):
+        await scheduler.wait()
+        # request latency doesn't shift the timeline
+        clock.now += 0.004
+    assert clock.now == pytest.approx(0.094)
+    assert scheduler.achieved_rate() == pytest.approx(10 / 0.094)
+
+
+@pytest.mark.asyncio
+async def test_rate_scheduler_burst_after_stall():
+    clock = FakeClock()
+    scheduler = RateScheduler(10, burst=3, clock=clock, sleep=clock.sleep)
+    await scheduler.wait()
+    clock.now += 1.0
+    for _ in range(3):
+        await scheduler.wait()
+    # three sends went out back to back, the rest of the missed slots were skipped
+    assert clock.now == pytest.approx(1.0)
+    await scheduler.wait()
+    assert clock.now == pytest.approx(1.1)
+    assert scheduler.skipped == 7
+    assert scheduler.stats()["sent"] == 5
+
+
+@pytest.mark.asyncio
+@patch('httpx.AsyncClient')
+async def test_rate_report(mock_client):
+    sensor = Sensor(messages_per_second=200)
+    mock_client.return_value.__aenter__.return_value.post.return_value = Response(200)
+    await sensor.generate_sensor_data(20)
+    report = sensor.rate_report()
+    assert len(report) == 1
+    assert report[0]["sent"] == 20
+    assert report[0]["target_rate"] == 200
+    assert 0 < report[0]["achieved_rate"] <= 200 * 1.1
+
+
+def test_fleet_config_from_env_and_overrides():
+    environ = {"SENSOR_COUNT": "32", "SENSOR_MESSAGES_PER_SECOND": "1000", "SENSOR_PROCESSES": "4",
+               "SENSOR_CONTROLLER_ENDPOINT": "http://localhost:8000/api/v1/controller/data"}
+    config = FleetConfig.from_env(environ, processes=2, batch_size=None)
+    assert config.count == 32
+    assert config.messages_per_second == 1000
+    assert config.processes == 2
+    assert config.batch_size == 1
+    assert config.controller_endpoint == "http://localhost:8000/api/v1/controller/data"
+    assert FleetConfig(count=3, processes=8).process_count() == 3
+
+
+def test_split_sensors():
+    assert split_sensors(10, 4) == [3, 3, 2, 2]
+    assert split_sensors(8, 1) == [8]
+    assert sum(split_sensors(10007, 16)) == 10007
+
+
+@pytest.mark.parametrize("distribution", Sensor.PAYLOAD_DISTRIBUTIONS)
+def test_payload_distributions(distribution):
+    sensor = Sensor(payload_distribution=distribution, payload_mean=90, payload_stddev=30)
+    payloads = [sensor._generate_payload() for _ in range(500)]
+    assert all(Sensor.PAYLOAD_MIN <= payload <= Sensor.PAYLOAD_MAX for payload in payloads)
+    if distribution == 'constant':
+        assert set(payloads) == {90}
+
+
+def test_invalid_payload_distribution():
+    with pytest.raises(ValueError):
+        Sensor(payload_distribution='poisson')
+
+
+@pytest.mark.asyncio
+@patch('httpx.AsyncClient')
+async def test_run_sensors(mock_client):
+    mock_client.return_value.__aenter__.return_value.post.return_value = Response(200)
+    config = FleetConfig(count=3, messages_per_second=500)
+    reports = await run_sensors(config, 3, iterations=4)
+    assert len(reports) == 3
+    assert mock_client.return_value.__aenter__.return_value.post.call_count == 12